@@ -2,6 +2,7 @@
 from flask import Flask
 from flask_cors import CORS
 from dotenv import load_dotenv
+import os
 
 # Load environment variables
 load_dotenv()
@@ -10,14 +11,39 @@ from routes.diet_routes import diet_bp
 from routes.workout_routes import workout_bp
 from routes.user_routes import user_bp
 from routes.tasks_routes import tasks_bp
+from routes.day_routes import day_bp
+from routes.batch_routes import batch_bp
+from routes.system_routes import system_bp
+from routes.analytics_routes import analytics_bp
+from routes.events_routes import events_bp
+from routes.export_routes import export_bp
+from indexes import ensure_indexes
+from json_provider import BSONJSONProvider
+from metrics import instrument
+from compression import compress
+from db import db
 
 app = Flask(__name__)
+app.json = BSONJSONProvider(app)
 CORS(app, resources={r"/api/*": {"origins": "*"}})
+instrument(app)
+compress(app)
 
 app.register_blueprint(diet_bp)
 app.register_blueprint(workout_bp)
 app.register_blueprint(user_bp)
 app.register_blueprint(tasks_bp)  # Register the tasks blueprint
+app.register_blueprint(day_bp)
+app.register_blueprint(batch_bp)
+app.register_blueprint(system_bp)
+app.register_blueprint(analytics_bp)
+app.register_blueprint(events_bp)
+app.register_blueprint(export_bp)
+
+# Index creation is idempotent, but can be left to `python indexes.py` when
+# several workers start at once
+if os.getenv("ENSURE_INDEXES", "false").lower() == "true":
+    ensure_indexes(db)
 
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=5000)
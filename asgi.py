@@ -0,0 +1,49 @@
+# asgi.py
+#
+# Async entry point serving the diet, workout, user, tasks, analytics,
+# events and system routes with the same contract as app.py, on Quart and
+# the asyncio Mongo driver. Requests waiting on Mongo do not hold a thread,
+# so one process can keep many polling or subscribed clients connected. Install
+# requirements-async.txt and run e.g.
+#
+#   hypercorn asgi:app --bind 0.0.0.0:5000
+#
+# app.py remains the WSGI entry point.
+from quart import Quart
+from quart_cors import cors
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+from async_routes.diet_routes import diet_bp
+from async_routes.workout_routes import workout_bp
+from async_routes.user_routes import user_bp
+from async_routes.tasks_routes import tasks_bp
+from async_routes.analytics_routes import analytics_bp
+from async_routes.events_routes import events_bp
+from async_routes.system_routes import system_bp
+from async_routes.common import BSONJSONProvider, instrument
+from async_db import close_async_client
+
+app = Quart(__name__)
+app.json = BSONJSONProvider(app)
+instrument(app)
+app = cors(app, allow_origin="*")
+
+app.register_blueprint(diet_bp)
+app.register_blueprint(workout_bp)
+app.register_blueprint(user_bp)
+app.register_blueprint(tasks_bp)
+app.register_blueprint(analytics_bp)
+app.register_blueprint(events_bp)
+app.register_blueprint(system_bp)
+
+
+@app.after_serving
+async def shutdown():
+    await close_async_client()
+
+
+if __name__ == "__main__":
+    app.run(host="0.0.0.0", port=5000)
@@ -0,0 +1,43 @@
+# async_db.py
+#
+# Non-blocking counterpart of db.py for the ASGI app, built on PyMongo's
+# native asyncio client (the successor of Motor, with the same API). Pool
+# settings, read preference, pool and command metrics are shared with db.py.
+from pymongo import AsyncMongoClient
+from dotenv import load_dotenv
+import os
+
+from db import READ_PREFERENCES, LazyDatabase, client_options, pool_metrics
+from metrics import command_metrics
+
+load_dotenv()
+
+_client = None
+_client_pid = None
+
+
+def get_async_client():
+    # Only ever called from the event loop thread, so no lock is needed
+    global _client, _client_pid
+    if _client is None or _client_pid != os.getpid():
+        _client = AsyncMongoClient(
+            os.getenv("MONGODB_URI"),
+            event_listeners=[pool_metrics, command_metrics],
+            **client_options(),
+        )
+        _client_pid = os.getpid()
+    return _client
+
+
+async def close_async_client():
+    global _client, _client_pid
+    if _client is not None:
+        await _client.close()
+    _client, _client_pid = None, None
+
+
+db = LazyDatabase(client_factory=get_async_client)
+read_db = LazyDatabase(
+    READ_PREFERENCES[os.getenv("MONGO_READ_PREFERENCE", "primary")],
+    client_factory=get_async_client,
+)
@@ -0,0 +1,29 @@
+# analytics_routes.py (Quart Blueprint, see asgi.py)
+from quart import Blueprint, g, jsonify, request
+from async_db import read_db
+from rollups import summarize
+from routes.analytics_routes import parse_rollup_query
+from async_routes.common import authenticate
+
+analytics_bp = Blueprint("analytics", __name__, url_prefix="/api/analytics")
+analytics_bp.before_request(authenticate)
+
+
+@analytics_bp.route("", methods=["GET"])
+async def get_rollups():
+    try:
+        query, limit = parse_rollup_query(g.user_id, request.args)
+    except ValueError as e:
+        return jsonify({"data": None, "success": False, "error": str(e)}), 400
+
+    try:
+        rollups = read_db.rollups.find(query).sort("key", 1).limit(limit)
+        return jsonify(
+            {
+                "data": [summarize(rollup) async for rollup in rollups],
+                "success": True,
+                "error": None,
+            }
+        )
+    except Exception as e:
+        return jsonify({"data": None, "success": False, "error": str(e)}), 500
@@ -0,0 +1,143 @@
+# common.py
+#
+# Quart counterparts of the Flask-bound helpers in auth.py, conditional.py,
+# json_provider.py, metrics.py, ratelimit.py and streaming.py. Token verification, validators, BSON
+# encoding and the response encoder themselves are shared with the sync app.
+from quart import Response, current_app, g, jsonify, request
+from quart.json.provider import DefaultJSONProvider
+import asyncio
+import jwt
+
+from auth import system_token_error, verify_token
+from conditional import is_conditional as _is_conditional
+from conditional import is_not_modified as _is_not_modified
+from conditional import with_validators
+from json_provider import BSONJSONMixin, bson_default
+from metrics import current_request, finish_request, route_label, start_request
+import ratelimit
+from ratelimit import TOO_MANY_REQUESTS, retry_headers
+from streaming import (
+    STREAM_BATCH_SIZE,
+    DocumentStreamEncoder,
+    KeyedByDateEncoder,
+    documents_async,
+    keyed_by_date_async,
+    open_cursor_async,
+)
+
+
+class BSONJSONProvider(BSONJSONMixin, DefaultJSONProvider):
+    default = staticmethod(bson_default(DefaultJSONProvider.default))
+
+
+async def start_metrics():
+    start_request(route_label(request.url_rule), request.method)
+
+
+async def finish_metrics(response):
+    # Streamed bodies have no length here and are counted as 0 bytes, their
+    # duration ends when the handler returns
+    record = current_request.get()
+    if record is not None:
+        finish_request(
+            record,
+            response.status_code,
+            request.content_length or 0,
+            response.content_length or 0,
+        )
+    return response
+
+
+def instrument(app):
+    app.before_request(start_metrics)
+    app.after_request(finish_metrics)
+
+
+async def authenticate():
+    # Preflight requests carry no credentials
+    if request.method == "OPTIONS":
+        return None
+
+    scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        return (
+            jsonify(
+                {"data": None, "success": False, "error": "Authorization required"}
+            ),
+            401,
+        )
+
+    try:
+        g.user_id = verify_token(token.strip())
+    except jwt.InvalidTokenError:
+        return (
+            jsonify(
+                {"data": None, "success": False, "error": "Invalid or expired token"}
+            ),
+            401,
+        )
+
+    return None
+
+
+async def authenticate_system():
+    error = system_token_error(request.headers.get("Authorization", ""))
+    if error is not None:
+        body, status = error
+        return jsonify(body), status
+    return None
+
+
+async def take(rule, key):
+    # See ratelimit.take, shared backends are called off the event loop
+    if ratelimit.backend.blocking:
+        return await asyncio.to_thread(ratelimit.take, rule, key)
+    return ratelimit.take(rule, key)
+
+
+async def limit_reads():
+    if request.method != "GET":
+        return None
+
+    allowed, retry_after = await take("reads", g.user_id)
+    if not allowed:
+        return (
+            jsonify({"data": None, "success": False, "error": TOO_MANY_REQUESTS}),
+            429,
+            retry_headers(retry_after),
+        )
+    return None
+
+
+def is_conditional():
+    return _is_conditional(request.headers)
+
+
+def is_not_modified(etag, last_modified=None):
+    return _is_not_modified(etag, last_modified, request.headers)
+
+
+def not_modified_response(etag, last_modified=None):
+    return with_validators(Response("", status=304), etag, last_modified)
+
+
+def conditional_jsonify(payload, etag, last_modified=None):
+    if is_not_modified(etag, last_modified):
+        return not_modified_response(etag, last_modified)
+    return with_validators(jsonify(payload), etag, last_modified)
+
+
+async def stream_keyed_by_date(cursor, limit, prepare, grouped=False):
+    # See streaming.stream_keyed_by_date
+    docs = await open_cursor_async(cursor)
+    encoder = KeyedByDateEncoder(limit, prepare, grouped, current_app.json.dumps)
+    return Response(
+        keyed_by_date_async(cursor, docs, encoder), mimetype="application/json"
+    )
+
+
+async def stream_documents(cursor, prepare, ndjson=False):
+    # See streaming.stream_documents
+    docs = await open_cursor_async(cursor.batch_size(STREAM_BATCH_SIZE))
+    encoder = DocumentStreamEncoder(prepare, current_app.json.dumps, ndjson)
+    return Response(documents_async(cursor, docs, encoder), mimetype=encoder.mimetype)
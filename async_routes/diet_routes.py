@@ -0,0 +1,345 @@
+# diet_routes.py (Quart Blueprint, see asgi.py)
+from quart import Blueprint, g, jsonify, request
+from datetime import datetime
+from pymongo import ReturnDocument
+from pymongo.errors import OperationFailure
+from async_db import db, read_db
+from cache import cached_async, invalidate, is_cached
+from events import publish, publish_deleted, publish_reload
+from rollups import schedule_rollup
+from fields import project
+from patches import MISSING_TARGET, diet_patch
+from streaming import date_range_query
+from validation import has_date_range, parse_date_range
+from routes.diet_routes import (
+    COMPLETION_PROJECTION,
+    PATCH_PROJECTION,
+    PLAN_CHANGED,
+    completed_meals_after,
+    diet_plan_etag,
+    diet_plan_update,
+    meal_completion_write,
+    parse_diet_plan_fields,
+    patched_totals_update,
+)
+from async_routes.common import (
+    authenticate,
+    limit_reads,
+    conditional_jsonify,
+    is_conditional,
+    is_not_modified,
+    not_modified_response,
+    stream_keyed_by_date,
+)
+
+diet_bp = Blueprint("diet", __name__, url_prefix="/api/diet")
+diet_bp.before_request(authenticate)
+diet_bp.before_request(limit_reads)
+
+
+@diet_bp.route("", methods=["GET"])
+async def get_diet_plan():
+    date_str = request.args.get("date")
+    if not date_str and has_date_range(request.args):
+        return await get_diet_plans_in_range()
+    if not date_str:
+        return (
+            jsonify(
+                {"data": None, "success": False, "error": "Date parameter is required"}
+            ),
+            400,
+        )
+
+    try:
+        datetime.strptime(date_str, "%Y-%m-%d")
+    except ValueError:
+        return (
+            jsonify(
+                {
+                    "data": None,
+                    "success": False,
+                    "error": "Invalid date format. Use YYYY-MM-DD",
+                }
+            ),
+            400,
+        )
+
+    try:
+        projection = parse_diet_plan_fields(request.args)
+    except ValueError as e:
+        return jsonify({"data": None, "success": False, "error": str(e)}), 400
+
+    # Revalidations that miss the cache are decided from lastUpdated alone
+    if is_conditional() and not is_cached("diet_plans", (g.user_id, date_str)):
+        version = await load_diet_plan_version(g.user_id, date_str)
+        if version is not None:
+            etag = diet_plan_etag(version, projection)
+            if is_not_modified(etag, version.get("lastUpdated")):
+                return not_modified_response(etag, version.get("lastUpdated"))
+
+    diet_plan = await load_diet_plan(g.user_id, date_str, projection)
+    if not diet_plan:
+        return jsonify({"data": None, "success": True, "error": None})
+
+    return conditional_jsonify(
+        {"data": diet_plan, "success": True, "error": None},
+        diet_plan_etag(diet_plan, projection),
+        diet_plan.get("lastUpdated"),
+    )
+
+
+async def load_diet_plan_version(user_id, date_str):
+    # Single-flight and cached like the plans themselves
+    return await cached_async(
+        "diet_plan_versions",
+        (user_id, date_str),
+        lambda: db.diet_plans.find_one(
+            {"user_id": user_id, "date": date_str}, projection={"lastUpdated": 1}
+        ),
+    )
+
+
+async def load_diet_plan(user_id, date_str, projection=None):
+    if projection is not None and not is_cached("diet_plans", (user_id, date_str)):
+        return await db.diet_plans.find_one(
+            {"user_id": user_id, "date": date_str}, projection=projection
+        )
+
+    diet_plan = await cached_async(
+        "diet_plans",
+        (user_id, date_str),
+        lambda: db.diet_plans.find_one({"user_id": user_id, "date": date_str}),
+    )
+    return project(diet_plan, projection)
+
+
+async def get_diet_plans_in_range():
+    try:
+        start, end, limit = parse_date_range(request.args)
+        projection = parse_diet_plan_fields(request.args)
+    except ValueError as e:
+        return jsonify({"data": None, "success": False, "error": str(e)}), 400
+
+    try:
+        cursor = (
+            read_db.diet_plans.find(
+                date_range_query(g.user_id, start, end), projection=projection
+            )
+            .sort("date", 1)
+            .limit(limit + 1)
+            .batch_size(limit + 1)
+        )
+        return await stream_keyed_by_date(cursor, limit, None)
+    except Exception as e:
+        return jsonify({"data": None, "success": False, "error": str(e)}), 500
+
+
+async def set_meal_completion(completed):
+    data = await request.get_json()
+    if not data or "date" not in data or "mealTime" not in data:
+        return (
+            jsonify(
+                {
+                    "data": None,
+                    "success": False,
+                    "error": "Date and mealTime are required",
+                }
+            ),
+            400,
+        )
+
+    diet_plan = await db.diet_plans.find_one_and_update(
+        *meal_completion_write(g.user_id, data["date"], data["mealTime"], completed),
+        projection=COMPLETION_PROJECTION,
+    )
+    invalidate("diet_plans", (g.user_id, data["date"]))
+    schedule_rollup(g.user_id, data["date"])
+
+    if diet_plan is None:
+        return (
+            jsonify(
+                {
+                    "data": None,
+                    "success": False,
+                    "error": "Failed to update meal status",
+                }
+            ),
+            400,
+        )
+
+    publish(
+        g.user_id,
+        "diet",
+        data["date"],
+        completedMeals=completed_meals_after(diet_plan, data["mealTime"], completed),
+    )
+    return jsonify({"data": None, "success": True, "error": None})
+
+
+@diet_bp.route("/complete", methods=["POST"])
+async def mark_meal_complete():
+    return await set_meal_completion(True)
+
+
+@diet_bp.route("/incomplete", methods=["DELETE"])
+async def mark_meal_incomplete():
+    return await set_meal_completion(False)
+
+
+@diet_bp.route("/update", methods=["PUT"])
+async def update_diet_plan():
+    data = await request.get_json()
+    if not data or "date" not in data or "meals" not in data:
+        return (
+            jsonify(
+                {
+                    "data": None,
+                    "success": False,
+                    "error": "Date and meals data are required",
+                }
+            ),
+            400,
+        )
+
+    try:
+        update = diet_plan_update(data)
+    except ValueError as e:
+        return jsonify({"data": None, "success": False, "error": str(e)}), 400
+
+    result = await db.diet_plans.update_one(
+        {"user_id": g.user_id, "date": data["date"]}, update, upsert=True
+    )
+    invalidate("diet_plans", (g.user_id, data["date"]))
+    schedule_rollup(g.user_id, data["date"])
+    publish_reload(g.user_id, "diet", data["date"])
+
+    if result.modified_count == 0 and not result.upserted_id:
+        return (
+            jsonify(
+                {"data": None, "success": False, "error": "Failed to update diet plan"}
+            ),
+            400,
+        )
+
+    return jsonify({"data": None, "success": True, "error": None})
+
+
+@diet_bp.route("", methods=["PATCH"])
+async def patch_diet_plan():
+    # Applies a list of operations (see patches.py) to the plan of ?date=.
+    # With If-Match, only to the version that ETag was given for.
+    date_str = request.args.get("date")
+    if not date_str:
+        return (
+            jsonify(
+                {"data": None, "success": False, "error": "Date parameter is required"}
+            ),
+            400,
+        )
+
+    try:
+        update, array_filters, required = diet_patch(
+            await request.get_json(silent=True), datetime.utcnow()
+        )
+    except ValueError as e:
+        return jsonify({"data": None, "success": False, "error": str(e)}), 400
+
+    query = {"user_id": g.user_id, "date": date_str}
+    try:
+        if request.if_match:
+            version = await db.diet_plans.find_one(query, projection={"lastUpdated": 1})
+            if version is None:
+                return (
+                    jsonify(
+                        {"data": None, "success": False, "error": "Diet plan not found"}
+                    ),
+                    404,
+                )
+            if not request.if_match.contains(diet_plan_etag(version)):
+                return (
+                    jsonify({"data": None, "success": False, "error": PLAN_CHANGED}),
+                    412,
+                )
+            query["lastUpdated"] = version.get("lastUpdated")
+
+        diet_plan = await db.diet_plans.find_one_and_update(
+            {**query, **required},
+            update,
+            array_filters=array_filters or None,
+            projection=PATCH_PROJECTION,
+            return_document=ReturnDocument.AFTER,
+        )
+
+        if diet_plan is None:
+            # The plan is there but not all that the patch addresses
+            if required and await db.diet_plans.find_one(query, projection={"_id": 1}):
+                return (
+                    jsonify({"data": None, "success": False, "error": MISSING_TARGET}),
+                    409,
+                )
+            if request.if_match:
+                return (
+                    jsonify({"data": None, "success": False, "error": PLAN_CHANGED}),
+                    412,
+                )
+            return (
+                jsonify(
+                    {"data": None, "success": False, "error": "Diet plan not found"}
+                ),
+                404,
+            )
+
+        # Totals follow in a second write, which a newer write supersedes
+        totals_update = patched_totals_update(diet_plan)
+        if totals_update is not None:
+            result = await db.diet_plans.update_one(
+                {"_id": diet_plan["_id"], "lastUpdated": diet_plan["lastUpdated"]},
+                totals_update,
+            )
+            if result.modified_count:
+                diet_plan["lastUpdated"] = totals_update["$set"]["lastUpdated"]
+        invalidate("diet_plans", (g.user_id, date_str))
+        schedule_rollup(g.user_id, date_str)
+        publish_reload(g.user_id, "diet", date_str)
+
+        response = jsonify({"data": None, "success": True, "error": None})
+        response.set_etag(diet_plan_etag(diet_plan))
+        return response
+    except OperationFailure as e:
+        # Paths that do not fit the stored plan, or operations in conflict.
+        # A WriteError may come without details.
+        error = (e.details or {}).get("errmsg") or str(e)
+        return jsonify({"data": None, "success": False, "error": error}), 400
+    except Exception as e:
+        return jsonify({"data": None, "success": False, "error": str(e)}), 500
+
+
+@diet_bp.route("/", methods=["DELETE"])
+async def delete_diet_plan():
+    date_str = request.args.get("date")
+    if not date_str:
+        return (
+            jsonify(
+                {"data": None, "success": False, "error": "Date parameter is required"}
+            ),
+            400,
+        )
+
+    result = await db.diet_plans.delete_one({"user_id": g.user_id, "date": date_str})
+    invalidate("diet_plans", (g.user_id, date_str))
+    schedule_rollup(g.user_id, date_str)
+    publish_deleted(g.user_id, "diet", date_str, reload=True)
+
+    if result.deleted_count == 0:
+        return (
+            jsonify(
+                {
+                    "data": None,
+                    "success": False,
+                    "error": "No diet plan found for this date",
+                }
+            ),
+            404,
+        )
+
+    return jsonify({"data": None, "success": True, "error": None})
@@ -0,0 +1,38 @@
+# events_routes.py (Quart Blueprint, see asgi.py)
+from quart import Blueprint, Response, current_app, g, jsonify, request
+import asyncio
+from events import SubscriberLimit, stream_events_async, subscribe
+from routes.events_routes import EVENT_STREAM_HEADERS, parse_subscription
+from async_routes.common import authenticate
+
+events_bp = Blueprint("events", __name__, url_prefix="/api/events")
+events_bp.before_request(authenticate)
+
+
+@events_bp.route("", methods=["GET"])
+async def get_events():
+    # Events are published from request and change stream threads, which
+    # wake the stream through the loop
+    loop = asyncio.get_running_loop()
+    ready = asyncio.Event()
+    try:
+        subscription = parse_subscription(
+            g.user_id, request.args, lambda: loop.call_soon_threadsafe(ready.set)
+        )
+    except ValueError as e:
+        return jsonify({"data": None, "success": False, "error": str(e)}), 400
+
+    try:
+        # Opening the change stream on first use blocks
+        await asyncio.to_thread(subscribe, subscription)
+    except SubscriberLimit as e:
+        return jsonify({"data": None, "success": False, "error": str(e)}), 503
+
+    response = Response(
+        stream_events_async(subscription, ready, current_app.json.dumps),
+        mimetype="text/event-stream",
+        headers=EVENT_STREAM_HEADERS,
+    )
+    # Streams stay open for as long as the client listens
+    response.timeout = None
+    return response
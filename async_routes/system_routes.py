@@ -0,0 +1,36 @@
+# system_routes.py (Quart Blueprint, see asgi.py)
+from quart import Blueprint, Response, jsonify
+from async_routes.common import authenticate_system
+from cache import cache_stats
+from db import pool_metrics
+from events import event_stats
+from metrics import registry
+from passwords import hash_metrics
+
+system_bp = Blueprint("system", __name__, url_prefix="/api/system")
+system_bp.before_request(authenticate_system)
+
+
+@system_bp.route("/cache", methods=["GET"])
+async def get_cache_stats():
+    return jsonify({"data": cache_stats(), "success": True, "error": None})
+
+
+@system_bp.route("/pool", methods=["GET"])
+async def get_pool_stats():
+    return jsonify({"data": pool_metrics.stats(), "success": True, "error": None})
+
+
+@system_bp.route("/passwords", methods=["GET"])
+async def get_password_stats():
+    return jsonify({"data": hash_metrics.stats(), "success": True, "error": None})
+
+
+@system_bp.route("/events", methods=["GET"])
+async def get_event_stats():
+    return jsonify({"data": event_stats(), "success": True, "error": None})
+
+
+@system_bp.route("/metrics", methods=["GET"])
+async def get_metrics():
+    return Response(registry.render(), mimetype="text/plain; version=0.0.4")
@@ -0,0 +1,459 @@
+# tasks_routes.py (Quart Blueprint, see asgi.py)
+from quart import Blueprint, g, jsonify, request
+from datetime import datetime
+from bson import ObjectId
+from bson.errors import InvalidId
+import asyncio
+from pymongo import ReturnDocument, UpdateOne
+from async_db import db, read_db
+from cache import cached_async, invalidate, is_cached
+from fields import project
+from conditional import make_etag
+from streaming import date_range_query
+from events import publish, publish_deleted, publish_reload
+from rollups import schedule_rollup
+from ranking import rank_between, rebalanced_ranks
+from validation import has_date_range, parse_date_range, parse_limit
+from routes.tasks_routes import (
+    MAX_RANK_LENGTH,
+    PROTECTED_FIELDS,
+    STREAM_FORMATS,
+    TASK_ORDER,
+    parse_task_cursor,
+    parse_task_fields,
+    prepare_task,
+    task_cursor,
+    task_page_query,
+    task_pipeline,
+)
+from async_routes.common import (
+    authenticate,
+    limit_reads,
+    conditional_jsonify,
+    is_not_modified,
+    not_modified_response,
+    stream_documents,
+    stream_keyed_by_date,
+)
+
+tasks_bp = Blueprint("tasks", __name__, url_prefix="/api/tasks")
+tasks_bp.before_request(authenticate)
+tasks_bp.before_request(limit_reads)
+
+
+@tasks_bp.route("", methods=["GET"])
+async def get_tasks():
+    date_str = request.args.get("date")
+    if not date_str and has_date_range(request.args):
+        return await get_tasks_in_range()
+
+    try:
+        projection = parse_task_fields(request.args)
+    except ValueError as e:
+        return jsonify({"data": None, "success": False, "error": str(e)}), 400
+
+    if not date_str:
+        if "stream" in request.args:
+            return await stream_all_tasks(projection)
+        return await get_tasks_page(projection)
+
+    try:
+        version = await load_task_version(g.user_id, date_str)
+        etag = make_etag(
+            "tasks", g.user_id, date_str, version["version"], *(projection or ())
+        )
+        if is_not_modified(etag, version.get("updatedAt")):
+            return not_modified_response(etag, version.get("updatedAt"))
+
+        tasks = await load_tasks_for_date(g.user_id, date_str, projection)
+        return conditional_jsonify(
+            {"data": tasks, "success": True, "error": None},
+            etag,
+            version.get("updatedAt"),
+        )
+    except Exception as e:
+        return jsonify({"data": None, "success": False, "error": str(e)}), 500
+
+
+async def get_tasks_page(projection):
+    try:
+        limit = parse_limit(request.args.get("limit"))
+        after = parse_task_cursor(request.args.get("cursor"))
+    except ValueError as e:
+        return jsonify({"data": None, "success": False, "error": str(e)}), 400
+
+    try:
+        tasks = await load_tasks(
+            task_page_query(g.user_id, after), limit + 1, projection
+        )
+        next_cursor = None
+        if len(tasks) > limit:
+            tasks = tasks[:limit]
+            next_cursor = task_cursor(tasks[-1])
+
+        return jsonify(
+            {"data": tasks, "next": next_cursor, "success": True, "error": None}
+        )
+    except Exception as e:
+        return jsonify({"data": None, "success": False, "error": str(e)}), 500
+
+
+async def stream_all_tasks(projection):
+    stream_format = request.args.get("stream") or "ndjson"
+    if stream_format not in STREAM_FORMATS:
+        return (
+            jsonify(
+                {
+                    "data": None,
+                    "success": False,
+                    "error": "stream must be ndjson or array",
+                }
+            ),
+            400,
+        )
+
+    try:
+        cursor = read_db.tasks.find({"user_id": g.user_id}, projection=projection)
+        return await stream_documents(
+            cursor.sort(TASK_ORDER), prepare_task, stream_format == "ndjson"
+        )
+    except Exception as e:
+        return jsonify({"data": None, "success": False, "error": str(e)}), 500
+
+
+async def load_aggregate(collection, pipeline):
+    cursor = await collection.aggregate(pipeline)
+    return await cursor.to_list()
+
+
+async def load_tasks(query, limit=0, projection=None):
+    return await load_aggregate(read_db.tasks, task_pipeline(query, limit, projection))
+
+
+async def load_tasks_for_date(user_id, date_str, projection=None):
+    query = {"user_id": user_id, "date": date_str}
+    if projection is not None and not is_cached("tasks", (user_id, date_str)):
+        return await load_aggregate(
+            db.tasks, task_pipeline(query, projection=projection)
+        )
+
+    tasks = await cached_async(
+        "tasks",
+        (user_id, date_str),
+        lambda: load_aggregate(db.tasks, task_pipeline(query)),
+    )
+    if projection is not None:
+        tasks = [prepare_task(project(task, projection)) for task in tasks]
+    return tasks
+
+
+async def load_task_version(user_id, date_str):
+    version = await cached_async(
+        "task_versions",
+        (user_id, date_str),
+        lambda: db.task_versions.find_one(
+            {"user_id": user_id, "date": date_str},
+            projection={"_id": 0, "version": 1, "updatedAt": 1},
+        ),
+    )
+    return version or {"version": 0}
+
+
+async def tasks_changed(user_id, *dates):
+    # Bumps the per-date version behind the tasks ETag and drops cached reads
+    now = datetime.utcnow()
+    for date in {date for date in dates if date}:
+        await db.task_versions.update_one(
+            {"user_id": user_id, "date": date},
+            {"$inc": {"version": 1}, "$set": {"updatedAt": now}},
+            upsert=True,
+        )
+        invalidate("tasks", (user_id, date))
+        invalidate("task_versions", (user_id, date))
+    schedule_rollup(user_id, *dates)
+
+
+async def neighbour_ranks(query, index):
+    # Ranks of the tasks that will sit before and after position `index`
+    cursor = db.tasks.find(query, projection={"rank": 1}).sort(TASK_ORDER)
+    if index == 0:
+        after = await anext(cursor.limit(1), None)
+        return None, after and after.get("rank", "")
+
+    window = await cursor.skip(index - 1).limit(2).to_list()
+    if not window:
+        # Past the end of the list
+        last = await db.tasks.find_one(
+            query, projection={"rank": 1}, sort=[("rank", -1), ("_id", -1)]
+        )
+        return (last and last.get("rank", "")), None
+
+    # Unranked tasks map to "", which rank_between rejects as an upper bound
+    before = window[0].get("rank", "")
+    after = window[1].get("rank", "") if len(window) > 1 else None
+    if not before:
+        raise ValueError("Unranked task")
+    return before, after
+
+
+async def rebalance_tasks(user_id, date_str):
+    # Rewrites every rank of one day with short, evenly spaced keys,
+    # keeping the current order
+    tasks = (
+        await db.tasks.find(
+            {"user_id": user_id, "date": date_str}, projection={"_id": 1}
+        )
+        .sort(TASK_ORDER)
+        .to_list()
+    )
+    if tasks:
+        await db.tasks.bulk_write(
+            [
+                UpdateOne({"_id": task["_id"]}, {"$set": {"rank": rank}})
+                for task, rank in zip(tasks, rebalanced_ranks(len(tasks)))
+            ],
+            ordered=False,
+        )
+    await tasks_changed(user_id, date_str)
+    publish_reload(user_id, "tasks", date_str)
+
+
+# Background rebalances, keyed by (user_id, date). The event loop only keeps
+# weak references to tasks, so they are held here until done.
+pending_rebalances = {}
+
+
+def schedule_rebalance(user_id, date_str):
+    key = (user_id, date_str)
+    if key in pending_rebalances:
+        return
+
+    task = asyncio.create_task(rebalance_tasks(user_id, date_str))
+    pending_rebalances[key] = task
+    task.add_done_callback(lambda _: pending_rebalances.pop(key, None))
+
+
+async def get_tasks_in_range():
+    try:
+        start, end, limit = parse_date_range(request.args)
+        projection = parse_task_fields(request.args)
+    except ValueError as e:
+        return jsonify({"data": None, "success": False, "error": str(e)}), 400
+
+    try:
+        cursor = (
+            read_db.tasks.find(
+                date_range_query(g.user_id, start, end), projection=projection
+            )
+            .sort(TASK_ORDER)
+            .batch_size(limit + 1)
+        )
+        return await stream_keyed_by_date(cursor, limit, prepare_task, grouped=True)
+    except Exception as e:
+        return jsonify({"data": None, "success": False, "error": str(e)}), 500
+
+
+@tasks_bp.route("", methods=["POST"])
+async def create_task():
+    try:
+        data = await request.get_json()
+        if not data or "title" not in data or "date" not in data:
+            return (
+                jsonify(
+                    {
+                        "data": None,
+                        "success": False,
+                        "error": "Title and date are required",
+                    }
+                ),
+                400,
+            )
+
+        # New tasks go to the end of their day
+        last = await db.tasks.find_one(
+            {"user_id": g.user_id, "date": data["date"]},
+            projection={"rank": 1},
+            sort=[("rank", -1), ("_id", -1)],
+        )
+        data["rank"] = rank_between(last.get("rank") if last else None, None)
+
+        data["user_id"] = g.user_id
+        await db.tasks.insert_one(data)
+        if len(data["rank"]) > MAX_RANK_LENGTH:
+            schedule_rebalance(g.user_id, data["date"])
+        await tasks_changed(g.user_id, data["date"])
+        new_task = prepare_task(data)
+        publish(g.user_id, "tasks", data["date"], task=new_task)
+
+        return jsonify({"data": new_task, "success": True, "error": None})
+    except Exception as e:
+        return jsonify({"data": None, "success": False, "error": str(e)}), 500
+
+
+@tasks_bp.route("/<task_id>", methods=["PUT"])
+async def update_task(task_id):
+    try:
+        data = await request.get_json() or {}
+        changes = {
+            key: value for key, value in data.items() if key not in PROTECTED_FIELDS
+        }
+        if not changes:
+            return (
+                jsonify({"data": None, "success": False, "error": "No data provided"}),
+                400,
+            )
+
+        # See the sync update_task for why moves return the previous document
+        moves = "date" in changes
+        updated_task = await db.tasks.find_one_and_update(
+            {"_id": ObjectId(task_id), "user_id": g.user_id},
+            {"$set": changes},
+            return_document=ReturnDocument.BEFORE if moves else ReturnDocument.AFTER,
+        )
+
+        if updated_task is None:
+            return (
+                jsonify({"data": None, "success": False, "error": "Task not found"}),
+                404,
+            )
+
+        previous_date = updated_task.get("date")
+        if moves:
+            updated_task.update(changes)
+
+        await tasks_changed(g.user_id, previous_date, updated_task.get("date"))
+        updated_task = prepare_task(updated_task)
+        publish(g.user_id, "tasks", updated_task.get("date"), task=updated_task)
+
+        return jsonify({"data": updated_task, "success": True, "error": None})
+    except Exception as e:
+        return jsonify({"data": None, "success": False, "error": str(e)}), 500
+
+
+@tasks_bp.route("/<task_id>", methods=["DELETE"])
+async def delete_task(task_id):
+    try:
+        deleted = await db.tasks.find_one_and_delete(
+            {"_id": ObjectId(task_id), "user_id": g.user_id}, projection={"date": 1}
+        )
+
+        if deleted is None:
+            return (
+                jsonify({"data": None, "success": False, "error": "Task not found"}),
+                404,
+            )
+
+        await tasks_changed(g.user_id, deleted.get("date"))
+        publish_deleted(g.user_id, "tasks", deleted.get("date"), deletedTask=task_id)
+        return jsonify({"data": None, "success": True, "error": None})
+    except Exception as e:
+        return jsonify({"data": None, "success": False, "error": str(e)}), 500
+
+
+@tasks_bp.route("/<task_id>/completion", methods=["PATCH"])
+async def toggle_task_completion(task_id):
+    try:
+        data = await request.get_json()
+        if "completed" not in data:
+            return (
+                jsonify(
+                    {
+                        "data": None,
+                        "success": False,
+                        "error": "Completed status is required",
+                    }
+                ),
+                400,
+            )
+
+        updated_task = await db.tasks.find_one_and_update(
+            {"_id": ObjectId(task_id), "user_id": g.user_id},
+            {"$set": {"completed": data["completed"]}},
+            return_document=ReturnDocument.AFTER,
+        )
+
+        if updated_task is None:
+            return (
+                jsonify({"data": None, "success": False, "error": "Task not found"}),
+                404,
+            )
+
+        await tasks_changed(g.user_id, updated_task.get("date"))
+        updated_task = prepare_task(updated_task)
+        publish(g.user_id, "tasks", updated_task.get("date"), task=updated_task)
+
+        return jsonify({"data": updated_task, "success": True, "error": None})
+    except Exception as e:
+        return jsonify({"data": None, "success": False, "error": str(e)}), 500
+
+
+@tasks_bp.route("/reorder", methods=["PATCH"])
+async def reorder_tasks():
+    try:
+        data = await request.get_json()
+        if "taskId" not in data or "newIndex" not in data:
+            return (
+                jsonify(
+                    {
+                        "data": None,
+                        "success": False,
+                        "error": "Task ID and new index are required",
+                    }
+                ),
+                400,
+            )
+
+        try:
+            task_id = ObjectId(data["taskId"])
+            new_index = int(data["newIndex"])
+            if new_index < 0:
+                raise ValueError
+        except (InvalidId, TypeError, ValueError):
+            return (
+                jsonify(
+                    {
+                        "data": None,
+                        "success": False,
+                        "error": "Invalid task ID or new index",
+                    }
+                ),
+                400,
+            )
+
+        task = await db.tasks.find_one(
+            {"_id": task_id, "user_id": g.user_id}, projection={"date": 1}
+        )
+        if task is None:
+            return (
+                jsonify({"data": None, "success": False, "error": "Task not found"}),
+                404,
+            )
+
+        siblings = {"user_id": g.user_id, "date": task["date"], "_id": {"$ne": task_id}}
+        try:
+            rank = rank_between(*await neighbour_ranks(siblings, new_index))
+        except ValueError:
+            # Unranked (older) tasks or a tie left by concurrent moves
+            await rebalance_tasks(g.user_id, task["date"])
+            rank = rank_between(*await neighbour_ranks(siblings, new_index))
+
+        moved = await db.tasks.find_one_and_update(
+            {"_id": task_id},
+            {"$set": {"rank": rank}},
+            return_document=ReturnDocument.AFTER,
+        )
+        await tasks_changed(g.user_id, task["date"])
+        if moved is not None:
+            publish(g.user_id, "tasks", task["date"], task=prepare_task(moved))
+        if len(rank) > MAX_RANK_LENGTH:
+            schedule_rebalance(g.user_id, task["date"])
+
+        return jsonify(
+            {
+                "data": {"id": str(task_id), "rank": rank},
+                "success": True,
+                "error": None,
+            }
+        )
+    except Exception as e:
+        return jsonify({"data": None, "success": False, "error": str(e)}), 500
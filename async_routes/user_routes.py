@@ -0,0 +1,131 @@
+# user_routes.py (Quart Blueprint, see asgi.py)
+from quart import Blueprint, request, jsonify
+from datetime import datetime
+from pymongo.errors import DuplicateKeyError
+from async_db import db
+from passwords import PoolBusy, hash_password_async, verify_password_async
+from ratelimit import TOO_MANY_REQUESTS, retry_headers
+from async_routes.common import take
+from routes.user_routes import REQUIRED_FIELDS, issue_token, new_user, user_summary
+
+user_bp = Blueprint("user", __name__, url_prefix="/api/user")
+
+
+@user_bp.route("/register", methods=["POST"])
+async def register():
+    data = await request.get_json()
+
+    # Validate required fields
+    if not all(field in data for field in REQUIRED_FIELDS):
+        return (
+            jsonify(
+                {
+                    "success": False,
+                    "error": "All fields are required",
+                    "missing_fields": [
+                        field for field in REQUIRED_FIELDS if field not in data
+                    ],
+                }
+            ),
+            400,
+        )
+
+    # Check if user already exists
+    if await db.users.find_one(
+        {"$or": [{"email": data["email"]}, {"username": data["username"]}]}
+    ):
+        return (
+            jsonify(
+                {
+                    "success": False,
+                    "error": "User with this email or username already exists",
+                }
+            ),
+            409,
+        )
+
+    # Hashing is CPU bound, it runs on the password pool
+    try:
+        hashed_password = await hash_password_async(data["password"])
+    except PoolBusy as e:
+        return jsonify({"success": False, "error": str(e)}), 503, {"Retry-After": "1"}
+    user = new_user(data, hashed_password)
+
+    # The unique indexes decide between two registrations racing past the
+    # check above
+    try:
+        result = await db.users.insert_one(user)
+    except DuplicateKeyError:
+        return (
+            jsonify(
+                {
+                    "success": False,
+                    "error": "User with this email or username already exists",
+                }
+            ),
+            409,
+        )
+
+    return (
+        jsonify(
+            {
+                "success": True,
+                "token": issue_token(result.inserted_id),
+                "user": user_summary(result.inserted_id, user),
+            }
+        ),
+        201,
+    )
+
+
+@user_bp.route("/login", methods=["POST"])
+async def login():
+    data = await request.get_json()
+
+    # Validate required fields
+    if not data or "email" not in data or "password" not in data:
+        return (
+            jsonify({"success": False, "error": "Email and password are required"}),
+            400,
+        )
+
+    # Every attempt costs a password hash, limit them per client
+    allowed, retry_after = await take("login", request.remote_addr)
+    if not allowed:
+        return (
+            jsonify({"success": False, "error": TOO_MANY_REQUESTS}),
+            429,
+            retry_headers(retry_after),
+        )
+
+    user = await db.users.find_one({"email": data["email"]})
+
+    if not user:
+        return jsonify({"success": False, "error": "Email not registered"}), 401
+
+    try:
+        matches, rehashed = await verify_password_async(
+            user["password"], data["password"]
+        )
+    except PoolBusy as e:
+        return jsonify({"success": False, "error": str(e)}), 503, {"Retry-After": "1"}
+
+    if not matches:
+        return jsonify({"success": False, "error": "Invalid email or password"}), 401
+
+    if rehashed:
+        await db.users.update_one(
+            {"_id": user["_id"], "password": user["password"]},
+            {"$set": {"password": rehashed, "updatedAt": datetime.utcnow()}},
+        )
+
+    return (
+        jsonify(
+            {
+                "success": True,
+                "token": issue_token(user["_id"]),
+                "user": user_summary(user["_id"], user),
+            }
+        ),
+        200,
+    )
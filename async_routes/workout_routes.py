@@ -0,0 +1,413 @@
+# workout_routes.py (Quart Blueprint, see asgi.py)
+from quart import Blueprint, g, jsonify, request
+from datetime import datetime
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError, OperationFailure
+from async_db import db, read_db
+from cache import cached_async, invalidate, is_cached
+from events import completion_event, publish, publish_reload
+from rollups import schedule_rollup
+from fields import project
+from patches import MISSING_TARGET, workout_patch
+from streaming import date_range_query
+from validation import has_date_range, parse_date_range
+from workout_templates import exercise_ids, plan_from_template, template_day
+from routes.workout_routes import (
+    COMPLETION_PROJECTION,
+    PLAN_CHANGED,
+    exercise_completion_write,
+    parse_workout_plan_fields,
+    prepare_workout_plan,
+    virtual_plan,
+    virtual_plan_etag,
+    workout_plan_etag,
+)
+from async_routes.common import (
+    authenticate,
+    limit_reads,
+    conditional_jsonify,
+    is_conditional,
+    is_not_modified,
+    not_modified_response,
+    stream_keyed_by_date,
+)
+
+workout_bp = Blueprint("workout", __name__, url_prefix="/api/workout")
+workout_bp.before_request(authenticate)
+workout_bp.before_request(limit_reads)
+
+
+@workout_bp.route("", methods=["GET"])
+async def get_workout_plan():
+    date_str = request.args.get("date")
+    if not date_str and has_date_range(request.args):
+        return await get_workout_plans_in_range()
+    if not date_str:
+        return (
+            jsonify(
+                {"data": None, "success": False, "error": "Date parameter is required"}
+            ),
+            400,
+        )
+
+    try:
+        projection = parse_workout_plan_fields(request.args)
+    except ValueError as e:
+        return jsonify({"data": None, "success": False, "error": str(e)}), 400
+
+    try:
+        # Revalidations that miss the cache are decided from updatedAt alone
+        if is_conditional() and not is_cached("workout_plans", (g.user_id, date_str)):
+            version = await load_workout_plan_version(g.user_id, date_str)
+            if version is not None:
+                etag = workout_plan_etag(version["_id"], version, projection)
+                if is_not_modified(etag, version.get("updatedAt")):
+                    return not_modified_response(etag, version.get("updatedAt"))
+
+        workout_plan = await load_workout_plan(g.user_id, date_str, projection)
+        if not workout_plan:
+            return jsonify({"data": None, "success": True, "error": None})
+
+        # A virtual plan is versioned by its template until it is stored
+        template = workout_plan.pop("template", None)
+        if template is not None:
+            etag = virtual_plan_etag(template, projection)
+        else:
+            etag = workout_plan_etag(workout_plan["id"], workout_plan, projection)
+        return conditional_jsonify(
+            {"data": workout_plan, "success": True, "error": None},
+            etag,
+            workout_plan.get("updatedAt"),
+        )
+
+    except Exception as e:
+        return jsonify({"data": None, "success": False, "error": str(e)}), 500
+
+
+async def load_template(date_str):
+    day_of_week = template_day(date_str)
+    return await cached_async(
+        "workout_templates",
+        day_of_week,
+        lambda: db.workout_templates.find_one({"day": day_of_week}),
+    )
+
+
+async def load_workout_plan_version(user_id, date_str):
+    # Single-flight and cached like the plans themselves
+    return await cached_async(
+        "workout_plan_versions",
+        (user_id, date_str),
+        lambda: db.workout_plans.find_one(
+            {"user_id": user_id, "date": date_str}, projection={"updatedAt": 1}
+        ),
+    )
+
+
+async def load_workout_plan(user_id, date_str, projection=None):
+    if projection is not None and not is_cached("workout_plans", (user_id, date_str)):
+        workout_plan = await db.workout_plans.find_one(
+            {"user_id": user_id, "date": date_str}, projection=projection
+        )
+        if workout_plan:
+            return prepare_workout_plan(workout_plan)
+
+    workout_plan = await cached_async(
+        "workout_plans",
+        (user_id, date_str),
+        lambda: db.workout_plans.find_one({"user_id": user_id, "date": date_str}),
+    )
+
+    if not workout_plan:
+        template = await load_template(date_str)
+        if not template:
+            return None
+        return virtual_plan(user_id, date_str, template, projection)
+
+    return prepare_workout_plan(project(workout_plan, projection))
+
+
+async def materialize_workout_plan(user_id, date_str):
+    template = await load_template(date_str)
+    if not template:
+        return None
+    query = {"user_id": user_id, "date": date_str}
+    try:
+        return await db.workout_plans.find_one_and_update(
+            query,
+            plan_from_template(template, datetime.utcnow()),
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+    except DuplicateKeyError:
+        # Two upserts raced to insert, the unique index let one through
+        return await db.workout_plans.find_one(query)
+
+
+async def get_workout_plans_in_range():
+    try:
+        start, end, limit = parse_date_range(request.args)
+        projection = parse_workout_plan_fields(request.args)
+    except ValueError as e:
+        return jsonify({"data": None, "success": False, "error": str(e)}), 400
+
+    try:
+        cursor = (
+            read_db.workout_plans.find(
+                date_range_query(g.user_id, start, end), projection=projection
+            )
+            .sort("date", 1)
+            .limit(limit + 1)
+            .batch_size(limit + 1)
+        )
+        return await stream_keyed_by_date(cursor, limit, prepare_workout_plan)
+    except Exception as e:
+        return jsonify({"data": None, "success": False, "error": str(e)}), 500
+
+
+@workout_bp.route("", methods=["POST"])
+async def create_workout_plan():
+    data = await request.get_json()
+    if not data or "date" not in data or "workouts" not in data:
+        return (
+            jsonify(
+                {
+                    "data": None,
+                    "success": False,
+                    "error": "Date and workouts data are required",
+                }
+            ),
+            400,
+        )
+
+    try:
+        result = await db.workout_plans.insert_one(
+            {
+                "user_id": g.user_id,
+                "date": data["date"],
+                "workouts": data["workouts"],
+                "createdAt": datetime.utcnow(),
+                "updatedAt": datetime.utcnow(),
+            }
+        )
+        invalidate("workout_plans", (g.user_id, data["date"]))
+        schedule_rollup(g.user_id, data["date"])
+        publish_reload(g.user_id, "workout", data["date"])
+
+        return jsonify(
+            {"data": str(result.inserted_id), "success": True, "error": None}
+        )
+
+    except DuplicateKeyError:
+        # The unique (user_id, date) index, use PUT or PATCH to change it
+        return (
+            jsonify(
+                {
+                    "data": None,
+                    "success": False,
+                    "error": "A workout plan for this date already exists",
+                }
+            ),
+            409,
+        )
+    except Exception as e:
+        return jsonify({"data": None, "success": False, "error": str(e)}), 500
+
+
+@workout_bp.route("", methods=["PUT"])
+async def update_workout_plan():
+    data = await request.get_json()
+    if not data or "date" not in data or "workouts" not in data:
+        return (
+            jsonify(
+                {
+                    "data": None,
+                    "success": False,
+                    "error": "Date and workouts data are required",
+                }
+            ),
+            400,
+        )
+
+    try:
+        await db.workout_plans.update_one(
+            {"user_id": g.user_id, "date": data["date"]},
+            {"$set": {"workouts": data["workouts"], "updatedAt": datetime.utcnow()}},
+            upsert=True,
+        )
+        invalidate("workout_plans", (g.user_id, data["date"]))
+        schedule_rollup(g.user_id, data["date"])
+        publish_reload(g.user_id, "workout", data["date"])
+
+        return jsonify({"data": data["date"], "success": True, "error": None})
+
+    except Exception as e:
+        return jsonify({"data": None, "success": False, "error": str(e)}), 500
+
+
+@workout_bp.route("", methods=["PATCH"])
+async def patch_workout_plan():
+    # Applies a list of operations (see patches.py) to the plan of ?date=.
+    # With If-Match, only to the version that ETag was given for.
+    date_str = request.args.get("date")
+    if not date_str:
+        return (
+            jsonify(
+                {"data": None, "success": False, "error": "Date parameter is required"}
+            ),
+            400,
+        )
+
+    try:
+        update, array_filters, required = workout_patch(
+            await request.get_json(silent=True), datetime.utcnow()
+        )
+    except ValueError as e:
+        return jsonify({"data": None, "success": False, "error": str(e)}), 400
+
+    query = {"user_id": g.user_id, "date": date_str}
+    try:
+        if request.if_match:
+            version = await db.workout_plans.find_one(
+                query, projection={"updatedAt": 1}
+            )
+            if version is not None:
+                matches = request.if_match.contains(
+                    workout_plan_etag(version["_id"], version)
+                )
+            else:
+                # A virtual plan is stored first, if the ETag is its own
+                template = await load_template(date_str)
+                if not template:
+                    return (
+                        jsonify(
+                            {
+                                "data": None,
+                                "success": False,
+                                "error": "Workout plan not found",
+                            }
+                        ),
+                        404,
+                    )
+                matches = request.if_match.contains(virtual_plan_etag(template))
+                if matches:
+                    version = await materialize_workout_plan(g.user_id, date_str)
+                    # Unless another write stored and changed it meanwhile
+                    matches = version.get("updatedAt") == version.get("createdAt")
+            if not matches:
+                return (
+                    jsonify({"data": None, "success": False, "error": PLAN_CHANGED}),
+                    412,
+                )
+            query["updatedAt"] = version.get("updatedAt")
+
+        def write():
+            return db.workout_plans.find_one_and_update(
+                {**query, **required},
+                update,
+                array_filters=array_filters or None,
+                projection={"updatedAt": 1},
+                return_document=ReturnDocument.AFTER,
+            )
+
+        workout_plan = await write()
+        if workout_plan is None and not request.if_match:
+            # A virtual plan is stored by its first write
+            if await materialize_workout_plan(g.user_id, date_str) is not None:
+                workout_plan = await write()
+
+        if workout_plan is None:
+            # The plan is there but not all that the patch addresses
+            if required and await db.workout_plans.find_one(
+                query, projection={"_id": 1}
+            ):
+                return (
+                    jsonify({"data": None, "success": False, "error": MISSING_TARGET}),
+                    409,
+                )
+            if request.if_match:
+                return (
+                    jsonify({"data": None, "success": False, "error": PLAN_CHANGED}),
+                    412,
+                )
+            return (
+                jsonify(
+                    {"data": None, "success": False, "error": "Workout plan not found"}
+                ),
+                404,
+            )
+
+        invalidate("workout_plans", (g.user_id, date_str))
+        schedule_rollup(g.user_id, date_str)
+        publish_reload(g.user_id, "workout", date_str)
+
+        response = jsonify({"data": None, "success": True, "error": None})
+        response.set_etag(workout_plan_etag(workout_plan["_id"], workout_plan))
+        return response
+    except OperationFailure as e:
+        # Paths that do not fit the stored plan, or operations in conflict.
+        # A WriteError may come without details.
+        error = (e.details or {}).get("errmsg") or str(e)
+        return jsonify({"data": None, "success": False, "error": error}), 400
+    except Exception as e:
+        return jsonify({"data": None, "success": False, "error": str(e)}), 500
+
+
+@workout_bp.route("/complete", methods=["POST"])
+async def mark_exercise_complete():
+    data = await request.get_json()
+    if not data or "date" not in data or "exerciseId" not in data:
+        return (
+            jsonify(
+                {
+                    "data": None,
+                    "success": False,
+                    "error": "Date and exerciseId are required",
+                }
+            ),
+            400,
+        )
+
+    try:
+        query, update, array_filters = exercise_completion_write(
+            g.user_id, data["date"], data["exerciseId"]
+        )
+
+        def write():
+            return db.workout_plans.find_one_and_update(
+                query,
+                update,
+                array_filters=array_filters,
+                projection=COMPLETION_PROJECTION,
+                return_document=ReturnDocument.AFTER,
+            )
+
+        workout_plan = await write()
+        if workout_plan is None:
+            # A virtual plan is stored by its first write, unless the exercise
+            # is not in it and the write would not apply
+            template = await load_template(data["date"])
+            if template and data["exerciseId"] in exercise_ids(template["categories"]):
+                if await materialize_workout_plan(g.user_id, data["date"]) is not None:
+                    workout_plan = await write()
+        invalidate("workout_plans", (g.user_id, data["date"]))
+        schedule_rollup(g.user_id, data["date"])
+
+        if workout_plan is None:
+            return (
+                jsonify(
+                    {"data": None, "success": False, "error": "Exercise not found"}
+                ),
+                404,
+            )
+
+        publish(
+            g.user_id,
+            "workout",
+            data["date"],
+            **completion_event("workout", workout_plan),
+        )
+        return jsonify({"data": None, "success": True, "error": None})
+
+    except Exception as e:
+        return jsonify({"data": None, "success": False, "error": str(e)}), 500
@@ -0,0 +1,92 @@
+# auth.py
+#
+# Verifies the HS256 tokens issued by the user routes. Registered as a
+# before_request hook on every blueprint that serves user data; the verified
+# user id is available as g.user_id and scopes every query.
+#
+# The /api/system routes (cache, pool and request metrics) are for operators
+# and scrapers rather than users: they take SYSTEM_TOKEN as their Bearer
+# token, and are disabled while it is not set.
+from datetime import datetime, timezone
+from dotenv import load_dotenv
+from flask import g, jsonify, request
+import hmac
+import jwt
+import os
+
+from cache import MISSING, TTLCache
+
+load_dotenv()
+
+JWT_SECRET = os.getenv("JWT_SECRET")
+SYSTEM_TOKEN = os.getenv("SYSTEM_TOKEN")
+
+# Tokens that already passed signature verification, so the hot path skips
+# the HMAC and JSON decoding. Expiry is still checked on every request.
+verified_tokens = TTLCache(
+    int(os.getenv("TOKEN_CACHE_SIZE", 4096)),
+    float(os.getenv("TOKEN_CACHE_TTL", 300)),
+)
+
+
+def verify_token(token):
+    entry = verified_tokens.get(token)
+    if entry is MISSING:
+        payload = jwt.decode(token, JWT_SECRET, algorithms=["HS256"])
+        if "user_id" not in payload:
+            raise jwt.InvalidTokenError("Token has no user_id")
+        entry = (payload["user_id"], payload.get("exp"))
+        verified_tokens.set(token, entry)
+
+    user_id, expires = entry
+    if expires is not None and expires <= datetime.now(timezone.utc).timestamp():
+        verified_tokens.invalidate(token)
+        raise jwt.ExpiredSignatureError("Signature has expired")
+    return user_id
+
+
+def authenticate():
+    # Preflight requests carry no credentials
+    if request.method == "OPTIONS":
+        return None
+
+    scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        return (
+            jsonify(
+                {"data": None, "success": False, "error": "Authorization required"}
+            ),
+            401,
+        )
+
+    try:
+        g.user_id = verify_token(token.strip())
+    except jwt.InvalidTokenError:
+        return (
+            jsonify(
+                {"data": None, "success": False, "error": "Invalid or expired token"}
+            ),
+            401,
+        )
+
+    return None
+
+
+def system_token_error(authorization):
+    # (body, status) refusing a request to the system routes, or None
+    if not SYSTEM_TOKEN:
+        return {"data": None, "success": False, "error": "Not found"}, 404
+    scheme, _, token = authorization.partition(" ")
+    if scheme.lower() != "bearer" or not hmac.compare_digest(
+        token.strip().encode(), SYSTEM_TOKEN.encode()
+    ):
+        return {"data": None, "success": False, "error": "Authorization required"}, 401
+    return None
+
+
+def authenticate_system():
+    error = system_token_error(request.headers.get("Authorization", ""))
+    if error is not None:
+        body, status = error
+        return jsonify(body), status
+    return None
@@ -0,0 +1,105 @@
+# json_serialization.py
+#
+# Time to serialize a tasks response of 1k-10k documents: the old path
+# (ObjectIds converted to strings in a loop, then Flask's default provider)
+# against json_provider.BSONJSONProvider on the stdlib and orjson backends.
+# Needs no database:
+#
+#   python benchmarks/json_serialization.py --sizes 1000 5000 10000
+import argparse
+import os
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bson import ObjectId
+from flask import Flask
+from flask.json.provider import DefaultJSONProvider
+
+from json_provider import BSONJSONProvider, orjson
+
+
+def make_tasks(count):
+    created = datetime(2024, 1, 1, 8, 30)
+    return [
+        {
+            "_id": ObjectId(),
+            "id": None,
+            "user_id": "bench",
+            "date": f"2024-01-{i % 28 + 1:02d}",
+            "title": f"Task {i}",
+            "description": "Stretch for ten minutes after the workout",
+            "completed": i % 3 == 0,
+            "rank": "V" + str(i),
+            "createdAt": created + timedelta(minutes=i),
+            "updatedAt": created + timedelta(minutes=i, seconds=30),
+        }
+        for i in range(count)
+    ]
+
+
+def legacy(provider, tasks):
+    for task in tasks:
+        task["_id"] = str(task["_id"])
+        task["id"] = str(task["_id"])
+    return provider.dumps(
+        {"data": tasks, "success": True, "error": None}, separators=(",", ":")
+    )
+
+
+def current(provider, tasks):
+    for task in tasks:
+        task["id"] = task["_id"]
+    return provider.dumps(
+        {"data": tasks, "success": True, "error": None}, separators=(",", ":")
+    )
+
+
+def measure(runs, size, serialize):
+    timings = []
+    for _ in range(runs):
+        tasks = make_tasks(size)
+        started = time.perf_counter()
+        serialize(tasks)
+        timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    return statistics.median(timings), timings[min(runs - 1, int(runs * 0.99))]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark JSON serialization")
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[1000, 5000, 10000], help="tasks"
+    )
+    parser.add_argument("-n", type=int, default=50, help="runs per scenario")
+    args = parser.parse_args(argv)
+
+    app = Flask(__name__)
+    default = DefaultJSONProvider(app)
+    stdlib = BSONJSONProvider(app)
+    stdlib.use_orjson = False
+    scenarios = [
+        ("legacy", lambda tasks: legacy(default, tasks)),
+        ("bson stdlib", lambda tasks: current(stdlib, tasks)),
+    ]
+    if orjson is not None:
+        fast = BSONJSONProvider(app)
+        fast.use_orjson = True
+        scenarios.append(("bson orjson", lambda tasks: current(fast, tasks)))
+    else:
+        print("orjson is not installed, skipping its backend")
+
+    print(f"{'scenario':<14}{'tasks':>8}{'p50 ms':>10}{'p99 ms':>10}")
+    for size in args.sizes:
+        for name, serialize in scenarios:
+            p50, p99 = measure(args.n, size, serialize)
+            print(f"{name:<14}{size:>8}{p50:>10.2f}{p99:>10.2f}")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,539 @@
+# load.py
+#
+# Throughput, latency percentiles and Mongo round trips per request for the
+# diet, workout, tasks and user routes, driven through the Flask test client
+# (one request at a time) or a threaded WSGI server on localhost (with
+# --concurrency clients). By default the app runs on an in-process mongomock
+# client installed through db.use_client; --backend mongo uses MONGODB_URI
+# with a scratch database that is dropped afterwards.
+#
+#   pip install mongomock
+#   python benchmarks/load.py --size 1000 --baseline-out baseline.json
+#   python benchmarks/load.py --size 1000 --compare baseline.json
+#   python benchmarks/load.py --backend mongo --size 1000000 --server
+#
+# mongomock scans (and copies) every document on each query, so beyond a
+# few thousand documents it measures itself more than the routes: use it
+# for --size 1000 and --backend mongo for the 100k and 1M datasets. Results
+# are only comparable with runs of the same size, backend and machine.
+# Round trips are command events on a real server and collection calls on
+# mongomock, including the rollup refreshes a scenario's writes schedule.
+# mongomock has no array filters, so "workout complete" answers 500 there.
+import argparse
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from http.client import HTTPConnection
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dotenv import load_dotenv
+from pymongo import monitoring
+
+load_dotenv()
+
+# Logins would otherwise be throttled and the CPU is shared with the server
+os.environ.setdefault("RATE_LIMIT_ENABLED", "false")
+os.environ.setdefault("PASSWORD_HASH_WORKERS", "1")
+
+USER = "bench0"
+PASSWORD = "bench-password"
+DAYS = 30
+START = datetime(2024, 1, 1)
+
+
+class RoundTrips(monitoring.CommandListener):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.count = 0
+
+    def add(self):
+        with self._lock:
+            self.count += 1
+
+    def started(self, event):
+        self.add()
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+class CountingCollection:
+    # mongomock publishes no command events, count its operations instead
+    OPERATIONS = {
+        "aggregate",
+        "bulk_write",
+        "count_documents",
+        "delete_many",
+        "delete_one",
+        "find",
+        "find_one",
+        "find_one_and_delete",
+        "find_one_and_replace",
+        "find_one_and_update",
+        "insert_many",
+        "insert_one",
+        "replace_one",
+        "update_many",
+        "update_one",
+    }
+
+    def __init__(self, collection, counter):
+        self._collection = collection
+        self._counter = counter
+
+    def __getattr__(self, name):
+        value = getattr(self._collection, name)
+        if name in self.OPERATIONS:
+            self._counter.add()
+        return value
+
+
+class CountingDatabase:
+    def __init__(self, database, counter):
+        self._database = database
+        self._counter = counter
+
+    def __getitem__(self, name):
+        return CountingCollection(self._database[name], self._counter)
+
+    def __getattr__(self, name):
+        if name.startswith("_") or name in ("name", "client", "command"):
+            return getattr(self._database, name)
+        return self[name]
+
+
+class CountingClient:
+    def __init__(self, client, counter):
+        self._client = client
+        self._counter = counter
+
+    def get_database(self, name=None, **kwargs):
+        return CountingDatabase(
+            self._client.get_database(name, **kwargs), self._counter
+        )
+
+    def __getitem__(self, name):
+        return self.get_database(name)
+
+    def drop_database(self, name):
+        self._client.drop_database(name)
+
+
+def date(i):
+    return (START + timedelta(days=i % DAYS)).strftime("%Y-%m-%d")
+
+
+def seed(db, size, batch=10000):
+    # `size` documents across diet plans, workout plans and tasks, in
+    # 1000-document users with one plan of each kind and three tasks a day
+    from passwords import hash_password
+
+    users = max(1, size // (DAYS * 5))
+    db.users.insert_one(
+        {
+            "email": f"{USER}@example.com",
+            "username": USER,
+            "firstName": "Bench",
+            "lastName": "User",
+            "password": hash_password(PASSWORD),
+        }
+    )
+
+    def documents():
+        count = 0
+        for u in range(users):
+            user_id = f"bench{u}"
+            for d in range(DAYS):
+                meals = {
+                    meal_time: {"items": [{"name": meal_time, "calories": 400 + d}]}
+                    for meal_time in ("breakfast", "lunch", "dinner")
+                }
+                yield "diet_plans", {
+                    "user_id": user_id,
+                    "date": date(d),
+                    "meals": meals,
+                    "dailyTotal": {"calories": 3 * (400 + d)},
+                    "completedMeals": [],
+                    "lastUpdated": START,
+                }
+                yield "workout_plans", {
+                    "user_id": user_id,
+                    "date": date(d),
+                    "workouts": [
+                        {
+                            "exercises": [
+                                {"id": f"e{i}", "completed": False} for i in range(4)
+                            ]
+                        }
+                    ],
+                    "createdAt": START,
+                    "updatedAt": START,
+                }
+                for t in range(3):
+                    yield "tasks", {
+                        "user_id": user_id,
+                        "date": date(d),
+                        "title": f"Task {t}",
+                        "completed": False,
+                        "rank": "V" + "n" * t,
+                        "createdAt": START,
+                    }
+                count += 5
+                if count >= size:
+                    return
+
+    pending = {}
+    for collection, doc in documents():
+        pending.setdefault(collection, []).append(doc)
+        if len(pending[collection]) >= batch:
+            db[collection].insert_many(pending.pop(collection), ordered=False)
+    for collection, docs in pending.items():
+        db[collection].insert_many(docs, ordered=False)
+
+
+def scenarios(headers, state):
+    # (name, method, path or callable returning it, json body or callable)
+    def task_id(i):
+        return state["tasks"][i % len(state["tasks"])]
+
+    return [
+        ("diet get", "GET", lambda i: f"/api/diet?date={date(i)}", None),
+        ("diet range", "GET", "/api/diet?from=2024-01-01&to=2024-01-30", None),
+        (
+            "diet complete",
+            "POST",
+            "/api/diet/complete",
+            lambda i: {"date": date(i), "mealTime": "lunch"},
+        ),
+        (
+            "diet incomplete",
+            "DELETE",
+            "/api/diet/incomplete",
+            lambda i: {"date": date(i), "mealTime": "lunch"},
+        ),
+        (
+            "diet update",
+            "PUT",
+            "/api/diet/update",
+            lambda i: {
+                "date": date(i),
+                "meals": {"lunch": {"items": [{"name": "Soup", "calories": 300 + i}]}},
+            },
+        ),
+        ("diet delete", "DELETE", lambda i: f"/api/diet/?date={date(i)}", None),
+        ("workout get", "GET", lambda i: f"/api/workout?date={date(i)}", None),
+        ("workout range", "GET", "/api/workout?from=2024-01-01&to=2024-01-30", None),
+        (
+            "workout create",
+            "POST",
+            "/api/workout",
+            lambda i: {
+                "date": (START + timedelta(days=DAYS + i)).strftime("%Y-%m-%d"),
+                "workouts": [{"exercises": [{"id": "e0", "completed": False}]}],
+            },
+        ),
+        (
+            "workout put",
+            "PUT",
+            "/api/workout",
+            lambda i: {
+                "date": date(i),
+                "workouts": [{"exercises": [{"id": "e0", "completed": False}]}],
+            },
+        ),
+        (
+            "workout complete",
+            "POST",
+            "/api/workout/complete",
+            lambda i: {"date": date(i), "exerciseId": "e0"},
+        ),
+        ("tasks get", "GET", lambda i: f"/api/tasks?date={date(i)}", None),
+        ("tasks range", "GET", "/api/tasks?from=2024-01-01&to=2024-01-30", None),
+        ("tasks page", "GET", "/api/tasks?limit=50", None),
+        ("tasks stream", "GET", "/api/tasks?stream=ndjson", None),
+        (
+            "tasks create",
+            "POST",
+            "/api/tasks",
+            lambda i: {"date": date(i), "title": f"Bench {i}"},
+        ),
+        ("tasks update", "PUT", lambda i: f"/api/tasks/{task_id(i)}", {"title": "x"}),
+        (
+            "tasks toggle",
+            "PATCH",
+            lambda i: f"/api/tasks/{task_id(i)}/completion",
+            lambda i: {"completed": i % 2 == 0},
+        ),
+        (
+            "tasks reorder",
+            "PATCH",
+            "/api/tasks/reorder",
+            lambda i: {"taskId": task_id(i), "newIndex": 0},
+        ),
+        ("tasks delete", "DELETE", lambda i: f"/api/tasks/{task_id(i)}", None),
+        (
+            "user login",
+            "POST",
+            "/api/user/login",
+            {"email": f"{USER}@example.com", "password": PASSWORD},
+        ),
+        (
+            "user register",
+            "POST",
+            "/api/user/register",
+            lambda i: {
+                "email": f"new{i}-{state['run']}@example.com",
+                "username": f"new{i}-{state['run']}",
+                "firstName": "New",
+                "lastName": "User",
+                "age": 30,
+                "birthDate": "1994-01-01",
+                "weight": 70,
+                "height": 175,
+                "password": PASSWORD,
+            },
+        ),
+    ]
+
+
+def resolve(value, i):
+    return value(i) if callable(value) else value
+
+
+class TestClientDriver:
+    def __init__(self, app, headers):
+        self.client = app.test_client()
+        self.headers = headers
+
+    def request(self, method, path, body):
+        response = self.client.open(
+            path, method=method, json=body, headers=self.headers
+        )
+        response.get_data()
+        response.close()
+        return response.status_code
+
+
+class ServerDriver:
+    # Threaded werkzeug server on an ephemeral port, one connection per client
+    # thread
+    def __init__(self, app, headers):
+        from werkzeug.serving import WSGIRequestHandler, make_server
+
+        class QuietHandler(WSGIRequestHandler):
+            def log_request(self, *args):
+                pass
+
+        self.server = make_server(
+            "127.0.0.1", 0, app, threaded=True, request_handler=QuietHandler
+        )
+        self.port = self.server.server_port
+        self.headers = {**headers, "Content-Type": "application/json"}
+        self.local = threading.local()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def request(self, method, path, body):
+        if not hasattr(self.local, "connection"):
+            self.local.connection = HTTPConnection("127.0.0.1", self.port)
+        connection = self.local.connection
+        payload = json.dumps(body) if body is not None else None
+        connection.request(method, path, body=payload, headers=self.headers)
+        response = connection.getresponse()
+        response.read()
+        return response.status
+
+    def close(self):
+        self.server.shutdown()
+
+
+def run_scenario(driver, counter, scenario, n, concurrency):
+    from rollups import rollup_executor
+
+    name, method, path, body = scenario
+    timings, statuses = [], {}
+    lock = threading.Lock()
+
+    def one(i):
+        started = time.perf_counter()
+        status = driver.request(method, resolve(path, i), resolve(body, i))
+        elapsed = (time.perf_counter() - started) * 1000
+        with lock:
+            timings.append(elapsed)
+            statuses[status] = statuses.get(status, 0) + 1
+
+    before = counter.count
+    started = time.perf_counter()
+    if concurrency > 1:
+        with ThreadPoolExecutor(concurrency) as executor:
+            list(executor.map(one, range(n)))
+    else:
+        for i in range(n):
+            one(i)
+    wall = time.perf_counter() - started
+    # Rollup refreshes the writes scheduled count towards them, not towards
+    # the next scenario
+    rollup_executor.submit(lambda: None).result()
+
+    timings.sort()
+    return {
+        "requests": n,
+        "throughput": n / wall,
+        "p50": statistics.median(timings),
+        "p95": timings[min(n - 1, int(n * 0.95))],
+        "p99": timings[min(n - 1, int(n * 0.99))],
+        "round_trips": (counter.count - before) / n,
+        "statuses": {str(status): count for status, count in sorted(statuses.items())},
+    }
+
+
+def compare(results, baseline, tolerance):
+    # Scenarios whose p50 grew by more than `tolerance` (a fraction)
+    regressions = []
+    for name, result in results.items():
+        previous = baseline.get("results", {}).get(name)
+        if previous is None:
+            continue
+        change = result["p50"] / previous["p50"] - 1 if previous["p50"] else 0
+        marker = " REGRESSION" if change > tolerance else ""
+        print(
+            f"{name:<18}{previous['p50']:>10.2f}{result['p50']:>10.2f}{change:>+9.0%}{marker}"
+        )
+        if marker:
+            regressions.append(name)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test the API routes")
+    parser.add_argument(
+        "--backend", choices=("mongomock", "mongo"), default="mongomock"
+    )
+    parser.add_argument(
+        "--size",
+        type=int,
+        default=1000,
+        help="seeded documents, e.g. 1000, 100000, 1000000",
+    )
+    parser.add_argument("-n", type=int, default=200, help="requests per scenario")
+    parser.add_argument(
+        "--auth-n", type=int, default=10, help="requests per user scenario"
+    )
+    parser.add_argument(
+        "--server", action="store_true", help="go through a WSGI server"
+    )
+    parser.add_argument(
+        "--concurrency", type=int, default=8, help="clients with --server"
+    )
+    parser.add_argument("--only", nargs="+", help="scenario names to run")
+    parser.add_argument("--baseline-out", help="write results as JSON to this file")
+    parser.add_argument("--compare", help="baseline JSON to compare p50s against")
+    parser.add_argument(
+        "--tolerance", type=float, default=0.2, help="allowed p50 growth"
+    )
+    args = parser.parse_args(argv)
+
+    counter = RoundTrips()
+    if args.backend == "mongo":
+        # Must be in place before the lazily created client connects
+        monitoring.register(counter)
+        os.environ["DB_NAME"] = os.getenv("BENCH_DB_NAME", "dietbackend_bench")
+    else:
+        os.environ.setdefault("DB_NAME", "bench")
+
+    import jwt
+    import db as database
+    from indexes import ensure_indexes
+
+    if args.backend == "mongomock":
+        import mongomock
+
+        database.use_client(CountingClient(mongomock.MongoClient(), counter))
+    db = database.db
+    database.get_client().drop_database(os.environ["DB_NAME"])
+
+    from app import app
+
+    started = time.perf_counter()
+    if args.backend == "mongo":
+        ensure_indexes(db)
+    seed(db, args.size)
+    print(f"Seeded {args.size} documents in {time.perf_counter() - started:.1f}s")
+
+    token = jwt.encode(
+        {"user_id": USER, "exp": datetime.utcnow() + timedelta(hours=1)},
+        os.getenv("JWT_SECRET"),
+        algorithm="HS256",
+    )
+    headers = {"Authorization": f"Bearer {token}"}
+    state = {
+        "tasks": [
+            str(task["_id"]) for task in db.tasks.find({"user_id": USER}, {"_id": 1})
+        ],
+        "run": int(time.time()),
+    }
+
+    driver = (
+        ServerDriver(app, headers) if args.server else TestClientDriver(app, headers)
+    )
+    concurrency = args.concurrency if args.server else 1
+
+    results = {}
+    print(
+        f"{'scenario':<18}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}"
+        f"{'trips':>7}  statuses"
+    )
+    try:
+        for scenario in scenarios(headers, state):
+            name = scenario[0]
+            if args.only and name not in args.only:
+                continue
+            n = args.auth_n if name.startswith("user") else args.n
+            result = run_scenario(driver, counter, scenario, n, concurrency)
+            results[name] = result
+            print(
+                f"{name:<18}{result['throughput']:>9.1f}{result['p50']:>9.2f}"
+                f"{result['p95']:>9.2f}{result['p99']:>9.2f}"
+                f"{result['round_trips']:>7.2f}  {result['statuses']}"
+            )
+    finally:
+        if args.server:
+            driver.close()
+        if args.backend == "mongo":
+            database.get_client().drop_database(os.environ["DB_NAME"])
+
+    run = {
+        "backend": args.backend,
+        "size": args.size,
+        "server": args.server,
+        "concurrency": concurrency,
+        "createdAt": datetime.utcnow().isoformat() + "Z",
+        "results": results,
+    }
+    if args.baseline_out:
+        with open(args.baseline_out, "w") as f:
+            json.dump(run, f, indent=2)
+        print(f"Wrote {args.baseline_out}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if (baseline.get("backend"), baseline.get("size")) != (args.backend, args.size):
+            print("Baseline was recorded with another backend or size")
+        print(f"{'scenario':<18}{'base p50':>10}{'p50':>10}{'change':>9}")
+        if compare(results, baseline, args.tolerance):
+            return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
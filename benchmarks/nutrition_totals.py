@@ -0,0 +1,94 @@
+# nutrition_totals.py
+#
+# Time to compute daily totals for 1, 100 and 100k diet plans: one
+# nutrition.plan_totals call per plan against the batched
+# nutrition.daily_totals, on numpy and on its pure Python fallback. Needs no
+# database:
+#
+#   python benchmarks/nutrition_totals.py --sizes 1 100 100000
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import nutrition
+from nutrition import NUTRIENTS, daily_totals, plan_totals
+
+MEAL_TIMES = ("breakfast", "lunch", "snack", "dinner")
+
+
+def make_plans(count, seed=1):
+    rng = random.Random(seed)
+    return [
+        {
+            meal_time: {
+                "items": [
+                    {
+                        "name": f"Food {i}",
+                        **{name: rng.randint(0, 400) for name in NUTRIENTS},
+                    }
+                    for i in range(rng.randint(1, 4))
+                ]
+            }
+            for meal_time in MEAL_TIMES
+        }
+        for _ in range(count)
+    ]
+
+
+def per_plan(plans):
+    return [totals and totals[1] for totals in map(plan_totals, plans)]
+
+
+def batched_python(plans):
+    numpy, nutrition.numpy = nutrition.numpy, None
+    try:
+        return daily_totals(plans)
+    finally:
+        nutrition.numpy = numpy
+
+
+def measure(runs, plans, compute):
+    timings = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        compute(plans)
+        timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    return statistics.median(timings), timings[min(runs - 1, int(runs * 0.99))]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark nutrition totals")
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[1, 100, 100000], help="plans"
+    )
+    parser.add_argument("-n", type=int, default=20, help="runs per scenario")
+    args = parser.parse_args(argv)
+
+    scenarios = [("per plan", per_plan), ("batch python", batched_python)]
+    if nutrition.numpy is not None:
+        scenarios.append(("batch numpy", daily_totals))
+    else:
+        print("numpy is not installed, skipping the array backend")
+
+    print(f"{'scenario':<14}{'plans':>8}{'p50 ms':>10}{'p99 ms':>10}")
+    for size in args.sizes:
+        plans = make_plans(size)
+        expected = per_plan(plans)
+        for name, compute in scenarios:
+            if compute(plans) != expected:
+                raise SystemExit(f"{name} disagrees with per plan totals")
+            runs = args.n if size < 10000 else max(1, args.n // 4)
+            p50, p99 = measure(runs, plans, compute)
+            print(f"{name:<14}{size:>8}{p50:>10.2f}{p99:>10.2f}")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
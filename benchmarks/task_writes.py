@@ -0,0 +1,164 @@
+# task_writes.py
+#
+# Mongo round trips and latency of the task write paths, comparing the old
+# write-then-read sequences with the find_one_and_update versions the routes
+# use now, plus the full routes through the Flask test client (which also
+# bump the per-date task version). Runs against MONGODB_URI in a scratch
+# database that is dropped afterwards:
+#
+#   BENCH_DB_NAME=dietbackend_bench python benchmarks/task_writes.py -n 500
+import argparse
+import os
+import statistics
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dotenv import load_dotenv
+from pymongo import ReturnDocument, monitoring
+
+load_dotenv()
+
+
+class CommandCounter(monitoring.CommandListener):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.count = 0
+
+    def started(self, event):
+        with self._lock:
+            self.count += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+def legacy_create(tasks, i):
+    result = tasks.insert_one({"user_id": "bench", "date": "2024-01-01", "title": i})
+    return tasks.find_one({"_id": result.inserted_id})
+
+
+def legacy_update(tasks, task_id):
+    tasks.update_one({"_id": task_id}, {"$set": {"title": "updated"}})
+    return tasks.find_one({"_id": task_id})
+
+
+def legacy_toggle(tasks, task_id):
+    tasks.update_one({"_id": task_id}, {"$set": {"completed": True}})
+    return tasks.find_one({"_id": task_id})
+
+
+def atomic_create(tasks, i):
+    task = {"user_id": "bench", "date": "2024-01-01", "title": i}
+    tasks.insert_one(task)
+    return task
+
+
+def atomic_update(tasks, task_id):
+    return tasks.find_one_and_update(
+        {"_id": task_id, "user_id": "bench"},
+        {"$set": {"title": "updated"}},
+        return_document=ReturnDocument.AFTER,
+    )
+
+
+def atomic_toggle(tasks, task_id):
+    return tasks.find_one_and_update(
+        {"_id": task_id, "user_id": "bench"},
+        {"$set": {"completed": True}},
+        return_document=ReturnDocument.AFTER,
+    )
+
+
+def measure(counter, n, operation):
+    timings = []
+    before = counter.count
+    for i in range(n):
+        started = time.perf_counter()
+        operation(i)
+        timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    return {
+        "round_trips": (counter.count - before) / n,
+        "p50": statistics.median(timings),
+        "p99": timings[min(n - 1, int(n * 0.99))],
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark task write paths")
+    parser.add_argument("-n", type=int, default=200, help="operations per scenario")
+    args = parser.parse_args(argv)
+
+    # Must be in place before the lazily created client connects
+    counter = CommandCounter()
+    monitoring.register(counter)
+    os.environ["DB_NAME"] = os.getenv("BENCH_DB_NAME", "dietbackend_bench")
+
+    import jwt
+    from app import app
+    from db import db
+
+    tasks = db.tasks
+    db.client.drop_database(os.environ["DB_NAME"])
+    ids = [legacy_create(tasks, i)["_id"] for i in range(args.n)]
+
+    token = jwt.encode(
+        {"user_id": "bench", "exp": datetime.utcnow() + timedelta(hours=1)},
+        os.getenv("JWT_SECRET"),
+        algorithm="HS256",
+    )
+    headers = {"Authorization": f"Bearer {token}"}
+    client = app.test_client()
+
+    scenarios = [
+        ("create  legacy", lambda i: legacy_create(tasks, i)),
+        ("create  atomic", lambda i: atomic_create(tasks, i)),
+        (
+            "create  route",
+            lambda i: client.post(
+                "/api/tasks", json={"date": "2024-01-01", "title": i}, headers=headers
+            ),
+        ),
+        ("update  legacy", lambda i: legacy_update(tasks, ids[i])),
+        ("update  atomic", lambda i: atomic_update(tasks, ids[i])),
+        (
+            "update  route",
+            lambda i: client.put(
+                f"/api/tasks/{ids[i]}", json={"title": "route"}, headers=headers
+            ),
+        ),
+        ("toggle  legacy", lambda i: legacy_toggle(tasks, ids[i])),
+        ("toggle  atomic", lambda i: atomic_toggle(tasks, ids[i])),
+        (
+            "toggle  route",
+            lambda i: client.patch(
+                f"/api/tasks/{ids[i]}/completion",
+                json={"completed": False},
+                headers=headers,
+            ),
+        ),
+    ]
+
+    print(f"{'scenario':<16}{'trips/op':>10}{'p50 ms':>10}{'p99 ms':>10}")
+    try:
+        for name, operation in scenarios:
+            result = measure(counter, args.n, operation)
+            print(
+                f"{name:<16}{result['round_trips']:>10.2f}"
+                f"{result['p50']:>10.2f}{result['p99']:>10.2f}"
+            )
+    finally:
+        db.client.drop_database(os.environ["DB_NAME"])
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
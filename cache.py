@@ -0,0 +1,224 @@
+# cache.py
+#
+# Bounded in-process read cache in front of `db`. Each collection gets its own
+# TTL/LRU cache; the write routes invalidate exactly the keys they change.
+# Caches are per process, so with several workers a write made through one
+# worker is seen by the others after at most the collection's TTL. Loaders
+# read from the primary (`db`, not `read_db`) so that a lagging secondary
+# cannot put a pre-write value back into the cache.
+#
+# Misses are single-flight: requests missing the same key at the same time
+# (polling clients) wait for one loader call instead of each querying Mongo.
+import asyncio
+from collections import OrderedDict
+from copy import deepcopy
+from dotenv import load_dotenv
+import os
+import threading
+import time
+
+load_dotenv()
+
+MISSING = object()
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class SingleFlight:
+    # Concurrent calls for the same key share the first caller's result.
+    # Threads and the ASGI app's event loop have separate in-flight tables.
+
+    def __init__(self):
+        self.shared = 0
+        self._calls = {}
+        self._futures = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, loader):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                self.shared += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.value
+
+        try:
+            call.value = loader()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.value
+
+    async def do_async(self, key, loader):
+        # The load runs as its own task, so a client disconnecting (which
+        # cancels its request) does not cancel the load for the others
+        task = self._futures.get(key)
+        if task is None:
+            task = asyncio.ensure_future(loader())
+            self._futures[key] = task
+            task.add_done_callback(lambda _: self._futures.pop(key, None))
+        else:
+            self.shared += 1
+        return await asyncio.shield(task)
+
+
+class TTLCache:
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.flights = SingleFlight()
+        # Bumped on every invalidation so that a load racing with a write
+        # does not store the value it read before the write
+        self.generation = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return MISSING
+
+    def contains(self, key):
+        # Peeks without touching the LRU order or counting a hit/miss
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry is not None and entry[0] > time.monotonic()
+
+    def set(self, key, value, generation=None):
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self.generation += 1
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "coalesced": self.flights.shared,
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+            }
+
+
+def _configured(name, maxsize, ttl):
+    prefix = f"CACHE_{name.upper()}"
+    return TTLCache(
+        int(os.getenv(f"{prefix}_SIZE", maxsize)),
+        float(os.getenv(f"{prefix}_TTL", ttl)),
+    )
+
+
+# Seven templates that almost never change, and plans that are read far more
+# often than written
+caches = {
+    "workout_templates": _configured("workout_templates", 16, 3600),
+    "diet_plans": _configured("diet_plans", 2048, 300),
+    "workout_plans": _configured("workout_plans", 2048, 300),
+    "tasks": _configured("tasks", 2048, 60),
+    "task_versions": _configured("task_versions", 2048, 60),
+    # _id and version of the plans, which is all a revalidation reads
+    "diet_plan_versions": _configured("diet_plan_versions", 8192, 300),
+    "workout_plan_versions": _configured("workout_plan_versions", 8192, 300),
+}
+
+# Invalidating a plan also drops its version
+VERSION_CACHES = {
+    "diet_plans": "diet_plan_versions",
+    "workout_plans": "workout_plan_versions",
+}
+
+
+def cached(collection, key, loader):
+    # Callers get their own copy, the route handlers mutate what they return.
+    # Loads are shared per generation, a request arriving after a write does
+    # not join a load that started before it.
+    cache = caches[collection]
+    value = cache.get(key)
+    if value is MISSING:
+        generation = cache.generation
+
+        def load():
+            value = loader()
+            cache.set(key, value, generation)
+            return value
+
+        value = cache.flights.do((key, generation), load)
+    return deepcopy(value)
+
+
+async def cached_async(collection, key, loader):
+    # Same as cached, for the ASGI app's coroutine loaders
+    cache = caches[collection]
+    value = cache.get(key)
+    if value is MISSING:
+        generation = cache.generation
+
+        async def load():
+            value = await loader()
+            cache.set(key, value, generation)
+            return value
+
+        value = await cache.flights.do_async((key, generation), load)
+    return deepcopy(value)
+
+
+def is_cached(collection, key):
+    return caches[collection].contains(key)
+
+
+def store(collection, key, value):
+    caches[collection].set(key, deepcopy(value))
+
+
+def invalidate(collection, *keys):
+    for key in keys:
+        caches[collection].invalidate(key)
+        if collection in VERSION_CACHES:
+            caches[VERSION_CACHES[collection]].invalidate(key)
+
+
+def cache_stats():
+    return {name: cache.stats() for name, cache in caches.items()}
@@ -0,0 +1,290 @@
+# compression.py
+#
+# Response compression for app.py. Bodies of COMPRESSION_MIN_SIZE bytes or
+# more (JSON, NDJSON and text) are compressed with the client's preferred
+# encoding of COMPRESSION_ENCODINGS, those of them that are installed:
+#
+#   gzip   always available, COMPRESSION_GZIP_LEVEL (default 6)
+#   br     pip install brotli, COMPRESSION_BR_LEVEL (default 4)
+#   zstd   pip install zstandard, COMPRESSION_ZSTD_LEVEL (default 3)
+#
+# Streamed bodies are compressed chunk by chunk, each chunk flushed so that
+# the client still receives it as soon as it is written. Event streams are
+# sent as they are.
+#
+# A compressed body is another representation, so its ETag gets the
+# encoding as a suffix ("<etag>-gzip"), which is stripped again from the
+# If-None-Match and If-Match headers before the routes compare them.
+# Compressed bytes of bodies with an ETag are kept in a cache of
+# COMPRESSION_CACHE_BYTES, keyed by a digest of the body, so that a plan
+# served again as the same bytes is not compressed again.
+from collections import OrderedDict
+from dotenv import load_dotenv
+from flask import request
+from werkzeug.http import parse_etags
+from hashlib import blake2b
+import os
+import re
+import threading
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+load_dotenv()
+
+MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", 1024))
+CACHE_BYTES = int(os.getenv("COMPRESSION_CACHE_BYTES", 16 * 1024 * 1024))
+LEVELS = {
+    "gzip": int(os.getenv("COMPRESSION_GZIP_LEVEL", 6)),
+    "br": int(os.getenv("COMPRESSION_BR_LEVEL", 4)),
+    "zstd": int(os.getenv("COMPRESSION_ZSTD_LEVEL", 3)),
+}
+AVAILABLE = {"gzip": True, "br": brotli is not None, "zstd": zstandard is not None}
+# Server preference among encodings the client accepts equally
+ENCODINGS = [
+    encoding.strip()
+    for encoding in os.getenv("COMPRESSION_ENCODINGS", "zstd,br,gzip").split(",")
+    if AVAILABLE.get(encoding.strip())
+]
+
+COMPRESSIBLE_TYPES = ("application/json", "application/x-ndjson")
+UNCOMPRESSED_TYPES = ("text/event-stream",)
+
+ETAG_SUFFIX = re.compile(r'-(?:gzip|br|zstd)"')
+
+
+class Compressor:
+    # One stream's compressor: compress() returns what is ready for a chunk,
+    # finish() the end of the stream
+
+    def __init__(self, encoding):
+        level = LEVELS[encoding]
+        self.encoding = encoding
+        if encoding == "gzip":
+            # wbits 31 writes the gzip header and trailer
+            self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+        elif encoding == "br":
+            self._compressor = brotli.Compressor(quality=level)
+        else:
+            self._compressor = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data):
+        if self.encoding == "gzip":
+            return self._compressor.compress(data) + self._compressor.flush(
+                zlib.Z_SYNC_FLUSH
+            )
+        if self.encoding == "br":
+            return self._compressor.process(data) + self._compressor.flush()
+        return self._compressor.compress(data) + self._compressor.flush(
+            zstandard.COMPRESSOBJ_FLUSH_BLOCK
+        )
+
+    def finish(self):
+        if self.encoding == "gzip":
+            return self._compressor.flush()
+        if self.encoding == "br":
+            return self._compressor.finish()
+        return self._compressor.flush()
+
+
+def compress_body(encoding, data):
+    level = LEVELS[encoding]
+    if encoding == "gzip":
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+        return compressor.compress(data) + compressor.flush()
+    if encoding == "br":
+        return brotli.compress(data, quality=level)
+    return zstandard.ZstdCompressor(level=level).compress(data)
+
+
+class CompressedCache:
+    # LRU of compressed bodies, bounded by their total size
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._size -= len(previous)
+            self._entries[key] = value
+            self._size += len(value)
+            while self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self._size}
+
+
+class CompressionMetrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.responses = {}
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def record(self, encoding, bytes_in, bytes_out):
+        with self._lock:
+            self.responses[encoding] = self.responses.get(encoding, 0) + 1
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+
+    def stats(self):
+        with self._lock:
+            return {
+                "encodings": ENCODINGS,
+                "minSize": MIN_SIZE,
+                "levels": {encoding: LEVELS[encoding] for encoding in ENCODINGS},
+                "responses": dict(self.responses),
+                "bytesIn": self.bytes_in,
+                "bytesOut": self.bytes_out,
+                "ratio": self.bytes_out / self.bytes_in if self.bytes_in else None,
+                "cache": {
+                    **cache.stats(),
+                    "hits": cache.hits,
+                    "misses": cache.misses,
+                },
+            }
+
+
+cache = CompressedCache(CACHE_BYTES)
+compression_metrics = CompressionMetrics()
+
+
+def compression_stats():
+    return compression_metrics.stats()
+
+
+def negotiate(accept_encodings):
+    # The accepted encoding of the highest quality, ties going to the
+    # server's order
+    best, best_quality = None, 0
+    for encoding in ENCODINGS:
+        quality = accept_encodings.quality(encoding)
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def is_compressible(response):
+    if response.status_code < 200 or response.status_code in (204, 304):
+        return False
+    if response.direct_passthrough or "Content-Encoding" in response.headers:
+        return False
+    mimetype = response.mimetype or ""
+    if mimetype in UNCOMPRESSED_TYPES:
+        return False
+    return mimetype in COMPRESSIBLE_TYPES or mimetype.startswith("text/")
+
+
+def _strip_etag_suffixes():
+    # The routes compare the ETags of the uncompressed bodies
+    for header in ("HTTP_IF_NONE_MATCH", "HTTP_IF_MATCH"):
+        value = request.environ.get(header)
+        if value:
+            request.environ["compression." + header] = value
+            request.environ[header] = ETAG_SUFFIX.sub('"', value)
+
+
+def _not_modified_etag(response):
+    # A 304 keeps the ETag of the representation the client holds
+    response.vary.add("Accept-Encoding")
+    etag, weak = response.get_etag()
+    sent = parse_etags(request.environ.get("compression.HTTP_IF_NONE_MATCH"))
+    for encoding in ENCODINGS:
+        if etag and sent.contains_weak(f"{etag}-{encoding}"):
+            response.set_etag(f"{etag}-{encoding}", weak)
+            break
+    return response
+
+
+def _compressed_stream(body, compressor, sizes):
+    try:
+        for chunk in body:
+            if isinstance(chunk, str):
+                chunk = chunk.encode()
+            sizes[0] += len(chunk)
+            data = compressor.compress(chunk)
+            sizes[1] += len(data)
+            if data:
+                yield data
+        data = compressor.finish()
+        sizes[1] += len(data)
+        yield data
+    finally:
+        compression_metrics.record(compressor.encoding, *sizes)
+
+
+def _compress_response(response):
+    if response.status_code == 304:
+        return _not_modified_etag(response)
+    if not is_compressible(response):
+        return response
+    response.vary.add("Accept-Encoding")
+    encoding = negotiate(request.accept_encodings)
+    if encoding is None:
+        return response
+
+    if response.is_streamed:
+        body = response.response
+        response.response = _compressed_stream(body, Compressor(encoding), [0, 0])
+        if hasattr(body, "close"):
+            # Also when the client leaves before the first chunk
+            response.call_on_close(body.close)
+        response.headers.pop("Content-Length", None)
+    else:
+        data = response.get_data()
+        if len(data) < MIN_SIZE:
+            return response
+        etag = response.get_etag()[0]
+        compressed = None
+        if etag:
+            key = (encoding, blake2b(data, digest_size=16).digest())
+            compressed = cache.get(key)
+        if compressed is None:
+            compressed = compress_body(encoding, data)
+            if etag:
+                cache.set(key, compressed)
+        compression_metrics.record(encoding, len(data), len(compressed))
+        response.set_data(compressed)
+
+    response.headers["Content-Encoding"] = encoding
+    etag, weak = response.get_etag()
+    if etag:
+        response.set_etag(f"{etag}-{encoding}", weak)
+    return response
+
+
+def compress(app):
+    # Registered after metrics.instrument, so that the metrics count the
+    # bytes actually sent
+    app.before_request(_strip_etag_suffixes)
+    app.after_request(_compress_response)
@@ -0,0 +1,64 @@
+# conditional.py
+#
+# Strong ETags and Last-Modified handling for GET routes. The validators are
+# derived from a document's version fields, so a route can answer 304 from a
+# projection-only query without fetching the full document.
+from datetime import datetime, timezone
+from hashlib import sha1
+from flask import Response, jsonify, request
+from werkzeug.sansio.http import is_resource_modified
+
+
+def _etag_part(part):
+    # BSON datetimes only keep milliseconds, a document built locally must
+    # hash the same as the one read back
+    if isinstance(part, datetime):
+        return part.replace(microsecond=part.microsecond // 1000 * 1000).isoformat()
+    return str(part)
+
+
+def make_etag(*parts):
+    return sha1(":".join(_etag_part(part) for part in parts).encode()).hexdigest()
+
+
+def _as_utc(value):
+    # BSON datetimes come back naive but are always UTC
+    if value is not None and value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value
+
+
+def is_conditional(headers=None):
+    # Takes the request headers explicitly when called outside Flask, e.g.
+    # from the ASGI app
+    headers = request.headers if headers is None else headers
+    return bool(headers.get("If-None-Match") or headers.get("If-Modified-Since"))
+
+
+def is_not_modified(etag, last_modified=None, headers=None):
+    headers = request.headers if headers is None else headers
+    if not is_conditional(headers):
+        return False
+    return not is_resource_modified(
+        http_if_modified_since=headers.get("If-Modified-Since"),
+        http_if_none_match=headers.get("If-None-Match"),
+        etag=etag,
+        last_modified=_as_utc(last_modified),
+    )
+
+
+def with_validators(response, etag, last_modified):
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = _as_utc(last_modified)
+    return response
+
+
+def not_modified_response(etag, last_modified=None):
+    return with_validators(Response(status=304), etag, last_modified)
+
+
+def conditional_jsonify(payload, etag, last_modified=None):
+    if is_not_modified(etag, last_modified):
+        return not_modified_response(etag, last_modified)
+    return with_validators(jsonify(payload), etag, last_modified)
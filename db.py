@@ -1,8 +1,190 @@
-from pymongo import MongoClient
+from pymongo import MongoClient, monitoring
+from pymongo.read_preferences import ReadPreference
 from dotenv import load_dotenv
 import os
+import threading
+
+from metrics import command_metrics
 
 load_dotenv()
 
-client = MongoClient(os.getenv("MONGODB_URI"))
-db = client[os.getenv("DB_NAME")]
+READ_PREFERENCES = {
+    "primary": ReadPreference.PRIMARY,
+    "primaryPreferred": ReadPreference.PRIMARY_PREFERRED,
+    "secondary": ReadPreference.SECONDARY,
+    "secondaryPreferred": ReadPreference.SECONDARY_PREFERRED,
+    "nearest": ReadPreference.NEAREST,
+}
+
+
+def client_options():
+    # Every option is optional, unset ones keep the driver defaults
+    settings = {
+        "maxPoolSize": ("MONGO_MAX_POOL_SIZE", int),
+        "minPoolSize": ("MONGO_MIN_POOL_SIZE", int),
+        "maxIdleTimeMS": ("MONGO_MAX_IDLE_TIME_MS", int),
+        "waitQueueTimeoutMS": ("MONGO_WAIT_QUEUE_TIMEOUT_MS", int),
+        "serverSelectionTimeoutMS": ("MONGO_SERVER_SELECTION_TIMEOUT_MS", int),
+        "connectTimeoutMS": ("MONGO_CONNECT_TIMEOUT_MS", int),
+        "socketTimeoutMS": ("MONGO_SOCKET_TIMEOUT_MS", int),
+        # e.g. "zstd,snappy", needs the zstandard / python-snappy packages
+        "compressors": ("MONGO_COMPRESSORS", str),
+    }
+    options = {}
+    for option, (variable, cast) in settings.items():
+        value = os.getenv(variable)
+        if value:
+            options[option] = cast(value)
+    return options
+
+
+class PoolMetrics(monitoring.ConnectionPoolListener):
+    # Connection checkout counters, including how long requests waited for a
+    # connection when the pool was exhausted
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.checkouts = 0
+            self.checkout_failures = 0
+            self.checked_out = 0
+            self.connections = 0
+            self.total_wait = 0.0
+            self.max_wait = 0.0
+
+    def _waited(self, event):
+        wait = getattr(event, "duration", 0.0) or 0.0
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+
+    def connection_checked_out(self, event):
+        with self._lock:
+            self.checkouts += 1
+            self.checked_out += 1
+            self._waited(event)
+
+    def connection_check_out_failed(self, event):
+        with self._lock:
+            self.checkout_failures += 1
+            self._waited(event)
+
+    def connection_checked_in(self, event):
+        with self._lock:
+            self.checked_out -= 1
+
+    def connection_created(self, event):
+        with self._lock:
+            self.connections += 1
+
+    def connection_closed(self, event):
+        with self._lock:
+            self.connections -= 1
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def stats(self):
+        with self._lock:
+            attempts = self.checkouts + self.checkout_failures
+            return {
+                "checkouts": self.checkouts,
+                "checkoutFailures": self.checkout_failures,
+                "checkedOut": self.checked_out,
+                "connections": self.connections,
+                "totalWaitSeconds": self.total_wait,
+                "avgWaitSeconds": self.total_wait / attempts if attempts else 0.0,
+                "maxWaitSeconds": self.max_wait,
+            }
+
+
+pool_metrics = PoolMetrics()
+
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    # Created on first use, and again in a forked child: a MongoClient must
+    # not be shared across fork() by pre-fork servers
+    global _client, _client_pid
+    if _client is None or _client_pid != os.getpid():
+        with _client_lock:
+            if _client is None or _client_pid != os.getpid():
+                _client = MongoClient(
+                    os.getenv("MONGODB_URI"),
+                    event_listeners=[pool_metrics, command_metrics],
+                    **client_options(),
+                )
+                _client_pid = os.getpid()
+    return _client
+
+
+def use_client(client):
+    # Replaces the client of this process, e.g. with a mongomock client in
+    # benchmarks/load.py. Every LazyDatabase picks it up on its next access.
+    global _client, _client_pid
+    with _client_lock:
+        _client, _client_pid = client, os.getpid()
+
+
+def _reset_after_fork():
+    global _client, _client_pid, _client_lock
+    _client, _client_pid = None, None
+    _client_lock = threading.Lock()
+    pool_metrics.reset()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+class LazyDatabase:
+    # Stands in for a pymongo Database so that `from db import db` does not
+    # connect at import time. The ASGI app passes a factory for async clients.
+
+    def __init__(self, read_preference=None, client_factory=get_client):
+        self.read_preference = read_preference
+        self.client_factory = client_factory
+        self._client = None
+        self._database = None
+
+    def database(self):
+        client = self.client_factory()
+        if self._client is not client:
+            self._database = client.get_database(
+                os.getenv("DB_NAME"), read_preference=self.read_preference
+            )
+            self._client = client
+        return self._database
+
+    def __getattr__(self, name):
+        return getattr(self.database(), name)
+
+    def __getitem__(self, name):
+        return self.database()[name]
+
+
+db = LazyDatabase()
+
+# Used by the GET routes, e.g. MONGO_READ_PREFERENCE=secondaryPreferred to
+# take read traffic off the primary
+read_db = LazyDatabase(READ_PREFERENCES[os.getenv("MONGO_READ_PREFERENCE", "primary")])
@@ -0,0 +1,435 @@
+# events.py
+#
+# Push of plan and task changes to subscribed clients (GET /api/events, a
+# text/event-stream), so that they no longer poll to notice completions made
+# on another device. Each event describes one date of one user:
+#
+#   {"kind": "diet", "date": ..., "completedMeals": [...]}
+#   {"kind": "workout", "date": ..., "completedExercises": [...]}
+#   {"kind": "tasks", "date": ..., "task": {...}}
+#   {"kind": "tasks", "date": ..., "deletedTask": "<id>"}
+#   {"kind": <kind>, "date": ..., "reload": true}   anything else changed
+#
+# and a {"kind": "resync"} event tells a client that fell too far behind to
+# refetch what it shows.
+#
+# Events reach the process's subscribers through one shared change stream
+# on the database, which also sees the writes of the other workers. Where
+# change streams are unavailable (a standalone server) or disabled with
+# EVENTS_CHANGE_STREAM=false, the write routes' publish() calls feed the
+# subscribers of their own process instead. Deleted plans and tasks carry
+# their user and date in a change stream only with pre-images enabled:
+#
+#   python events.py --enable-pre-images    (MongoDB 6.0+)
+#   EVENTS_PRE_IMAGES=true
+#
+# Until then deletes are published locally whatever the source, and reach
+# the subscribers of the worker that served the delete only.
+#
+# Every subscriber has a buffer of EVENTS_BUFFER events. A subscriber that
+# does not keep up loses its buffer and is sent a resync instead, so a slow
+# client never holds more than that in memory nor slows the others down.
+from collections import deque
+from dotenv import load_dotenv
+from pymongo.errors import OperationFailure, PyMongoError
+import argparse
+import asyncio
+import logging
+import os
+import re
+import threading
+import time
+
+from db import db
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+CHANGE_STREAM = os.getenv("EVENTS_CHANGE_STREAM", "true").lower() == "true"
+PRE_IMAGES = os.getenv("EVENTS_PRE_IMAGES", "false").lower() == "true"
+BUFFER_SIZE = int(os.getenv("EVENTS_BUFFER", 256))
+MAX_SUBSCRIBERS = int(os.getenv("EVENTS_MAX_SUBSCRIBERS", 1000))
+# Comment lines keep proxies from closing idle streams and reveal clients
+# that went away
+HEARTBEAT_SECONDS = float(os.getenv("EVENTS_HEARTBEAT_SECONDS", 15))
+
+KINDS = {"diet_plans": "diet", "workout_plans": "workout", "tasks": "tasks"}
+
+# Updates touching only these fields are sent as their new state, any other
+# update as a reload
+COMPLETION_FIELDS = {
+    "diet_plans": re.compile(r"^(completedMeals(\.\d+)?|lastUpdated)$"),
+    "workout_plans": re.compile(
+        r"^(workouts\.\d+\.exercises\.\d+\.completed|updatedAt)$"
+    ),
+}
+
+# Errors of servers that cannot open change streams at all: not a replica
+# set (40573) or no majority read concern (40324)
+UNSUPPORTED_CODES = (40573, 40324)
+
+
+class SubscriberLimit(Exception):
+    pass
+
+
+def completed_exercises(workout_plan):
+    return [
+        exercise.get("id")
+        for workout in workout_plan.get("workouts") or []
+        for exercise in workout.get("exercises") or []
+        if isinstance(exercise, dict) and exercise.get("completed")
+    ]
+
+
+def completion_event(kind, doc):
+    # The completion state of a plan, as sent to subscribers
+    if kind == "diet":
+        return {"completedMeals": doc.get("completedMeals") or []}
+    return {"completedExercises": completed_exercises(doc)}
+
+
+class Subscription:
+    def __init__(self, user_id, kinds=None, dates=None, wake=None):
+        self.user_id = user_id
+        self.kinds = kinds
+        # A set of dates or a (start, end) range
+        self.dates = dates
+        self.overflowed = False
+        self._events = deque()
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._wake = wake
+
+    def matches(self, event):
+        if self.kinds is not None and event["kind"] not in self.kinds:
+            return False
+        if self.dates is None:
+            return True
+        if isinstance(self.dates, tuple):
+            return self.dates[0] <= event["date"] <= self.dates[1]
+        return event["date"] in self.dates
+
+    def push(self, event):
+        # Returns True when this event overflowed the buffer
+        overflowed = False
+        with self._lock:
+            if self.overflowed:
+                return False
+            if len(self._events) >= BUFFER_SIZE:
+                # Whatever is buffered is stale once a resync is due
+                self._events.clear()
+                self.overflowed = overflowed = True
+            else:
+                self._events.append(event)
+        self._ready.set()
+        if self._wake is not None:
+            self._wake()
+        return overflowed
+
+    def drain(self):
+        # (overflowed, events) since the last drain
+        with self._lock:
+            self._ready.clear()
+            events, overflowed = list(self._events), self.overflowed
+            self._events.clear()
+            self.overflowed = False
+        return overflowed, events
+
+    def wait(self, timeout):
+        return self._ready.wait(timeout)
+
+
+class EventBus:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = {}
+        self.count = 0
+        self.published = 0
+        self.delivered = 0
+        self.overflows = 0
+
+    def subscribe(self, subscription):
+        with self._lock:
+            if self.count >= MAX_SUBSCRIBERS:
+                raise SubscriberLimit("Too many subscribers, try again later")
+            self._subscribers.setdefault(subscription.user_id, set()).add(subscription)
+            self.count += 1
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscriptions = self._subscribers.get(subscription.user_id)
+            if subscriptions is None or subscription not in subscriptions:
+                return
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                del self._subscribers[subscription.user_id]
+            self.count -= 1
+
+    def dispatch(self, user_id, event):
+        with self._lock:
+            self.published += 1
+            subscriptions = list(self._subscribers.get(user_id, ()))
+        delivered = overflows = 0
+        for subscription in subscriptions:
+            if subscription.matches(event):
+                delivered += 1
+                overflows += subscription.push(event)
+        with self._lock:
+            self.delivered += delivered
+            self.overflows += overflows
+
+    def stats(self):
+        with self._lock:
+            return {
+                "source": feed.source,
+                "subscribers": self.count,
+                "users": len(self._subscribers),
+                "published": self.published,
+                "delivered": self.delivered,
+                "overflows": self.overflows,
+                "bufferSize": BUFFER_SIZE,
+                "maxSubscribers": MAX_SUBSCRIBERS,
+            }
+
+
+bus = EventBus()
+
+
+def change_event(change):
+    # (user_id, event) of a change stream document, or None
+    collection = change["ns"]["coll"]
+    kind = KINDS[collection]
+    operation = change["operationType"]
+    doc = change.get("fullDocument")
+    if operation == "delete":
+        doc = change.get("fullDocumentBeforeChange")
+    if not doc or "user_id" not in doc or "date" not in doc:
+        # Deleted without a pre-image, or gone before the lookup
+        return None
+
+    event = {"kind": kind, "date": doc["date"]}
+    if kind == "tasks":
+        if operation == "delete":
+            event["deletedTask"] = str(doc["_id"])
+        else:
+            doc["id"] = doc["_id"]
+            event["task"] = doc
+    elif operation == "update":
+        description = change.get("updateDescription") or {}
+        fields = [
+            *(description.get("updatedFields") or {}),
+            *(description.get("removedFields") or []),
+        ]
+        if all(COMPLETION_FIELDS[collection].match(field) for field in fields):
+            event.update(completion_event(kind, doc))
+        else:
+            event["reload"] = True
+    else:
+        event["reload"] = True
+    return doc["user_id"], event
+
+
+class ChangeStreamFeed:
+    # One thread per process watching the plan and task collections. It
+    # starts with the first subscriber, then resumes after errors from the
+    # last event seen.
+
+    def __init__(self):
+        self.source = "local" if not CHANGE_STREAM else None
+        self._lock = threading.Lock()
+        self._opened = threading.Event()
+        self._thread = None
+
+    @property
+    def active(self):
+        return self.source == "changestream"
+
+    def start(self):
+        if self.source == "local":
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="events", daemon=True
+                )
+                self._thread.start()
+        # Until the stream is open the routes keep publishing locally
+        self._opened.wait(5)
+
+    def _watch(self, resume_token):
+        pipeline = [
+            {
+                "$match": {
+                    "ns.coll": {"$in": list(KINDS)},
+                    "operationType": {"$in": ["insert", "update", "replace", "delete"]},
+                }
+            }
+        ]
+        options = {"full_document": "updateLookup", "resume_after": resume_token}
+        if PRE_IMAGES:
+            options["full_document_before_change"] = "whenAvailable"
+        return db.watch(pipeline, **options)
+
+    def _run(self):
+        resume_token = None
+        delay = 1
+        while True:
+            try:
+                with self._watch(resume_token) as stream:
+                    self.source = "changestream"
+                    self._opened.set()
+                    delay = 1
+                    for change in stream:
+                        resume_token = stream.resume_token
+                        routed = change_event(change)
+                        if routed is not None:
+                            bus.dispatch(*routed)
+            except OperationFailure as e:
+                if not self.active and e.code in UNSUPPORTED_CODES:
+                    self._fall_back(e)
+                    return
+                logger.warning("Change stream failed, reopening: %s", e)
+                if e.has_error_label("NonResumableChangeStreamError"):
+                    resume_token = None
+            except PyMongoError as e:
+                logger.warning("Change stream failed, reopening: %s", e)
+                # Subscribers do not wait on an unreachable server, the
+                # routes publish locally until the stream opens
+                self._opened.set()
+            except Exception as e:
+                # A client without change stream support, e.g. mongomock
+                self._fall_back(e)
+                return
+            time.sleep(delay)
+            delay = min(delay * 2, 30)
+
+    def _fall_back(self, error):
+        logger.warning("Change streams unavailable, publishing locally: %s", error)
+        self.source = "local"
+        self._opened.set()
+
+
+feed = ChangeStreamFeed()
+
+
+def _reset_after_fork():
+    # The parent's feed thread does not exist in the child
+    global bus, feed
+    bus = EventBus()
+    feed = ChangeStreamFeed()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def subscribe(subscription):
+    # Raises SubscriberLimit when the process has too many subscribers
+    feed.start()
+    bus.subscribe(subscription)
+    return subscription
+
+
+def unsubscribe(subscription):
+    bus.unsubscribe(subscription)
+
+
+def event_stats():
+    return bus.stats()
+
+
+def _dispatch(user_id, kind, dates, fields):
+    for date in {date for date in dates if date}:
+        bus.dispatch(user_id, {"kind": kind, "date": date, **fields})
+
+
+def publish(user_id, kind, *dates, **fields):
+    # Called by the write routes after a write. With the change stream
+    # running the write comes back through it, to every worker.
+    if feed.active:
+        return
+    _dispatch(user_id, kind, dates, fields)
+
+
+def publish_deleted(user_id, kind, *dates, **fields):
+    # Called by the delete routes. A delete comes back through the change
+    # stream only with its pre-image, change_event drops it otherwise.
+    if feed.active and PRE_IMAGES:
+        return
+    _dispatch(user_id, kind, dates, fields)
+
+
+def publish_reload(user_id, kind, *dates):
+    publish(user_id, kind, *dates, reload=True)
+
+
+def format_event(event, dumps):
+    return f"event: {event['kind']}\ndata: {dumps(event)}\n\n"
+
+
+def event_chunks(overflowed, events, dumps):
+    if overflowed:
+        return format_event({"kind": "resync"}, dumps)
+    return "".join(format_event(event, dumps) for event in events)
+
+
+HEARTBEAT = ": heartbeat\n\n"
+
+
+def stream_events(subscription, dumps):
+    # Sync generator of the text/event-stream body, unsubscribing once the
+    # client is gone (the server closes the generator)
+    try:
+        yield HEARTBEAT
+        while True:
+            if not subscription.wait(HEARTBEAT_SECONDS):
+                yield HEARTBEAT
+                continue
+            chunk = event_chunks(*subscription.drain(), dumps)
+            if chunk:
+                yield chunk
+    finally:
+        unsubscribe(subscription)
+
+
+async def stream_events_async(subscription, ready, dumps):
+    # Async counterpart of stream_events, woken through `ready` (an
+    # asyncio.Event set from the publishing thread)
+    try:
+        yield HEARTBEAT
+        while True:
+            try:
+                await asyncio.wait_for(ready.wait(), HEARTBEAT_SECONDS)
+            except asyncio.TimeoutError:
+                yield HEARTBEAT
+                continue
+            ready.clear()
+            chunk = event_chunks(*subscription.drain(), dumps)
+            if chunk:
+                yield chunk
+    finally:
+        unsubscribe(subscription)
+
+
+def enable_pre_images(database):
+    for collection in KINDS:
+        database.command(
+            "collMod", collection, changeStreamPreAndPostImages={"enabled": True}
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Change event setup")
+    parser.add_argument(
+        "--enable-pre-images",
+        action="store_true",
+        help="record pre-images so that deletes reach subscribers",
+    )
+    args = parser.parse_args()
+    if args.enable_pre_images:
+        enable_pre_images(db)
+        print(f"Pre-images enabled on {', '.join(KINDS)}")
+    else:
+        parser.print_help()
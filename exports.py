@@ -0,0 +1,335 @@
+# exports.py
+#
+# Export and import of whole histories: diet plans, workout plans, tasks and
+# the user documents, without their password hashes. Exports stream from
+# cursors in batches of EXPORT_BATCH_SIZE and imports write in chunks of
+# IMPORT_BATCH_SIZE, so memory stays constant whatever the size. Every line
+# is one JSON value in MongoDB Extended JSON, which keeps ObjectIds and
+# dates intact:
+#
+#   ndjson     {"collection": "tasks", "document": {...}}       per document
+#   columnar   {"collection": "tasks", "count": 500,             per batch
+#               "columns": {"date": [...], "title": [...], ...}}
+#
+# Columnar lines name each field once per batch, which suits analytics
+# tools and compresses well. A field a document lacks is null in its
+# column, and null values are left out again on import.
+#
+#   python exports.py export [--user ID] [--format columnar] [--out FILE]
+#   python exports.py import FILE [--mode upsert] [--checkpoint FILE]
+#
+# Files ending in .gz are compressed. With --checkpoint, an import records
+# the lines it has written after every chunk, and running the same command
+# again resumes after them. Inserting skips documents whose _id (or, for
+# plans, user and date) already exists; upserting replaces them, and
+# inserts documents without those fields. Run `python rollups.py --rebuild`
+# once an import is done.
+from bson import ObjectId, json_util
+from dotenv import load_dotenv
+from pymongo import ReplaceOne, UpdateOne
+from pymongo.errors import BulkWriteError
+import argparse
+import gzip
+import json
+import os
+import sys
+
+from streaming import batches
+
+load_dotenv()
+
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", 1000))
+IMPORT_BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", 1000))
+
+COLLECTIONS = ("users", "diet_plans", "workout_plans", "tasks")
+FORMATS = ("ndjson", "columnar")
+MODES = ("insert", "upsert")
+
+# Never exported
+EXCLUDED_FIELDS = {"users": {"password": 0}}
+
+# What an upsert matches an imported document on. Plans are unique per user
+# and date, whatever their _id.
+UPSERT_KEYS = {
+    "users": ("_id",),
+    "diet_plans": ("user_id", "date"),
+    "workout_plans": ("user_id", "date"),
+    "tasks": ("_id",),
+}
+
+DUPLICATE_KEY = 11000
+
+
+def parse_collections(value):
+    if not value:
+        return COLLECTIONS
+    collections = [name.strip() for name in value.split(",") if name.strip()]
+    unknown = sorted(set(collections).difference(COLLECTIONS))
+    if unknown:
+        raise ValueError(f"Unknown collections: {', '.join(unknown)}")
+    return collections
+
+
+def export_query(collection, user_id=None):
+    if user_id is None:
+        return {}
+    if collection == "users":
+        return {"_id": ObjectId(user_id) if ObjectId.is_valid(user_id) else user_id}
+    return {"user_id": user_id}
+
+
+def dumps(value):
+    return json_util.dumps(value, separators=(",", ":"))
+
+
+def columnar_batch(collection, docs):
+    # The batch's fields in first-seen order, one value per document each
+    fields = {}
+    for doc in docs:
+        fields.update(dict.fromkeys(doc))
+    return {
+        "collection": collection,
+        "count": len(docs),
+        "columns": {field: [doc.get(field) for doc in docs] for field in fields},
+    }
+
+
+def export_lines(db, collections=COLLECTIONS, user_id=None, columnar=False):
+    # Yields the export one chunk of lines per cursor batch
+    for collection in collections:
+        cursor = (
+            db[collection]
+            .find(
+                export_query(collection, user_id),
+                projection=EXCLUDED_FIELDS.get(collection),
+            )
+            .batch_size(EXPORT_BATCH_SIZE)
+        )
+        try:
+            for batch in batches(cursor, EXPORT_BATCH_SIZE):
+                if columnar:
+                    yield dumps(columnar_batch(collection, batch)) + "\n"
+                else:
+                    yield "".join(
+                        dumps({"collection": collection, "document": doc}) + "\n"
+                        for doc in batch
+                    )
+        finally:
+            cursor.close()
+
+
+def parse_line(line):
+    # (collection, documents) of one export line
+    record = json_util.loads(line)
+    collection = record.get("collection") if isinstance(record, dict) else None
+    if collection not in COLLECTIONS:
+        raise ValueError(f"Unknown collection {collection!r}")
+    if isinstance(record.get("document"), dict):
+        return collection, [record["document"]]
+
+    columns = record.get("columns")
+    if not isinstance(columns, dict):
+        raise ValueError("Lines need a document or columns")
+    rows = [{} for _ in range(record.get("count", 0))]
+    for field, values in columns.items():
+        if len(values) != len(rows):
+            raise ValueError(f"Column {field} does not have {len(rows)} values")
+        for row, value in zip(rows, values):
+            if value is not None:
+                row[field] = value
+    return collection, rows
+
+
+class Importer:
+    # Buffers documents per collection and writes them in chunks. With a
+    # user_id every document is imported as that user's and user documents
+    # are skipped, as for the /api/import route.
+
+    def __init__(self, db, mode="insert", user_id=None, on_write=None):
+        self.db = db
+        self.mode = mode
+        self.user_id = user_id
+        self.on_write = on_write
+        self.pending = {}
+        self.size = 0
+        self.stats = dict.fromkeys(
+            ("inserted", "upserted", "replaced", "duplicates", "skipped"), 0
+        )
+
+    def add(self, collection, doc):
+        if self.user_id is not None:
+            if collection == "users":
+                self.stats["skipped"] += 1
+                return
+            doc["user_id"] = self.user_id
+        self.pending.setdefault(collection, []).append(doc)
+        self.size += 1
+
+    def _insert(self, collection, docs):
+        try:
+            result = self.db[collection].insert_many(docs, ordered=False)
+            self.stats["inserted"] += len(result.inserted_ids)
+        except BulkWriteError as e:
+            # Already imported, e.g. before the checkpoint was recorded
+            errors = e.details.get("writeErrors", [])
+            if any(error["code"] != DUPLICATE_KEY for error in errors):
+                raise
+            self.stats["inserted"] += e.details.get("nInserted", 0)
+            self.stats["duplicates"] += len(errors)
+
+    def _write(self, collection, docs):
+        if self.mode == "insert":
+            self._insert(collection, docs)
+            return
+
+        writes, inserts = [], []
+        keys = UPSERT_KEYS[collection]
+        for doc in docs:
+            if any(doc.get(key) is None for key in keys):
+                # Nothing to match on, upserting would filter on null and
+                # replace the previous document without the key
+                inserts.append(doc)
+                continue
+            query = {key: doc[key] for key in keys}
+            if self.user_id is not None:
+                # Never matches another user's document
+                query["user_id"] = self.user_id
+            if "_id" not in keys:
+                doc.pop("_id", None)
+            if collection == "users":
+                # Keeps the password of an existing user
+                fields = {key: value for key, value in doc.items() if key != "_id"}
+                writes.append(UpdateOne(query, {"$set": fields}, upsert=True))
+            else:
+                writes.append(ReplaceOne(query, doc, upsert=True))
+        if inserts:
+            self._insert(collection, inserts)
+        if not writes:
+            return
+        try:
+            result = self.db[collection].bulk_write(writes, ordered=False)
+            self.stats["upserted"] += result.upserted_count
+            self.stats["replaced"] += result.matched_count
+        except BulkWriteError as e:
+            # Another user's _id, or a plan conflicting with its user and date
+            errors = e.details.get("writeErrors", [])
+            if any(error["code"] != DUPLICATE_KEY for error in errors):
+                raise
+            self.stats["upserted"] += e.details.get("nUpserted", 0)
+            self.stats["replaced"] += e.details.get("nMatched", 0)
+            self.stats["duplicates"] += len(errors)
+
+    def flush(self):
+        for collection, docs in self.pending.items():
+            self._write(collection, docs)
+            if self.on_write is not None:
+                self.on_write(collection, docs)
+        self.pending = {}
+        self.size = 0
+
+
+def import_lines(
+    db, lines, mode="insert", user_id=None, skip=0, on_write=None, on_checkpoint=None
+):
+    # Imports the lines after the first `skip`, returning the stats with the
+    # number of lines done. on_checkpoint(stats) is called whenever
+    # everything up to stats["lines"] is written.
+    importer = Importer(db, mode, user_id, on_write)
+    done = skip
+    for number, line in enumerate(lines, 1):
+        if number <= skip:
+            continue
+        if line.strip():
+            try:
+                collection, docs = parse_line(line)
+            except ValueError as e:
+                raise ValueError(f"Line {number}: {e}") from e
+            for doc in docs:
+                importer.add(collection, doc)
+        done = number
+        if importer.size >= IMPORT_BATCH_SIZE:
+            importer.flush()
+            if on_checkpoint is not None:
+                on_checkpoint({"lines": done, **importer.stats})
+    importer.flush()
+    stats = {"lines": done, **importer.stats}
+    if on_checkpoint is not None:
+        on_checkpoint(stats)
+    return stats
+
+
+def open_file(path, mode):
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+def read_checkpoint(path, source):
+    if not path or not os.path.exists(path):
+        return 0
+    with open(path) as f:
+        checkpoint = json.load(f)
+    if checkpoint.get("source") != source:
+        raise ValueError(f"{path} is the checkpoint of {checkpoint.get('source')}")
+    return checkpoint["lines"]
+
+
+def write_checkpoint(path, source, stats):
+    # Replaced in one step, a crash never leaves half a checkpoint
+    with open(path + ".tmp", "w") as f:
+        json.dump({"source": source, **stats}, f)
+    os.replace(path + ".tmp", path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export and import histories")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = commands.add_parser("export", help="write an export")
+    export_parser.add_argument("--user", help="only this user's documents")
+    export_parser.add_argument(
+        "--collections", help=f"comma separated, of {', '.join(COLLECTIONS)}"
+    )
+    export_parser.add_argument("--format", choices=FORMATS, default="ndjson")
+    export_parser.add_argument("--out", help="file to write, stdout by default")
+
+    import_parser = commands.add_parser("import", help="read an export")
+    import_parser.add_argument("file")
+    import_parser.add_argument("--mode", choices=MODES, default="insert")
+    import_parser.add_argument(
+        "--checkpoint", help="file recording progress, resumed from if it exists"
+    )
+    args = parser.parse_args(argv)
+
+    from db import db
+
+    if args.command == "export":
+        collections = parse_collections(args.collections)
+        out = open_file(args.out, "w") if args.out else sys.stdout
+        try:
+            for chunk in export_lines(
+                db, collections, args.user, args.format == "columnar"
+            ):
+                out.write(chunk)
+        finally:
+            if args.out:
+                out.close()
+        return 0
+
+    source = os.path.abspath(args.file)
+    skip = read_checkpoint(args.checkpoint, source)
+    if skip:
+        print(f"Resuming after line {skip}", file=sys.stderr)
+    on_checkpoint = None
+    if args.checkpoint:
+        on_checkpoint = lambda stats: write_checkpoint(args.checkpoint, source, stats)
+    with open_file(args.file, "r") as lines:
+        stats = import_lines(
+            db, lines, args.mode, skip=skip, on_checkpoint=on_checkpoint
+        )
+    print(json.dumps(stats))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
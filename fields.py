@@ -0,0 +1,65 @@
+# fields.py
+#
+# Sparse fieldsets for the read routes: `?fields=completedMeals,date` is
+# checked against a per-collection whitelist and becomes a Mongo inclusion
+# projection. Documents already held in the cache are projected locally
+# with the same rules instead of being fetched again.
+
+
+def parse_fields(value, allowed, required=()):
+    # Projection for a comma separated `fields` value, or None when absent.
+    # `required` fields are always included, e.g. the ones the ETag or the
+    # date-keyed responses are built from.
+    if value is None or not value.strip():
+        return None
+
+    paths = {path.strip() for path in value.split(",") if path.strip()}
+    unknown = sorted(paths.difference(allowed))
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+
+    paths.update(required)
+    # A parent field already includes its sub-fields, Mongo rejects both
+    paths = {
+        path
+        for path in paths
+        if not any(path.startswith(other + ".") for other in paths)
+    }
+    return {path: 1 for path in sorted(paths)}
+
+
+def _tree(projection):
+    tree = {}
+    for path in projection:
+        node = tree
+        parts = path.split(".")
+        for part in parts[:-1]:
+            node = node.setdefault(part, {})
+        node[parts[-1]] = True
+    return tree
+
+
+def _project(value, tree):
+    if isinstance(value, list):
+        # Sub-fields of an array apply to each embedded document
+        return [_project(item, tree) for item in value if isinstance(item, dict)]
+
+    result = {}
+    for key, subtree in tree.items():
+        if key not in value:
+            continue
+        if subtree is True:
+            result[key] = value[key]
+        elif isinstance(value[key], (dict, list)):
+            result[key] = _project(value[key], subtree)
+    return result
+
+
+def project(doc, projection):
+    # Local equivalent of find(..., projection) for a document in memory
+    if doc is None or projection is None:
+        return doc
+    result = _project(doc, _tree(projection))
+    if "_id" in doc:
+        result["_id"] = doc["_id"]
+    return result
@@ -0,0 +1,249 @@
+# indexes.py
+#
+# Index declarations for every collection the routes touch.
+#
+#   python indexes.py           create missing indexes
+#   python indexes.py --check   create them, then fail if any route query
+#                               shape is still answered by a collection scan
+#                               or needs an in-memory sort
+#
+# Before a unique index is built, the collection is checked for documents it
+# would reject: values held by several documents, and documents from before
+# user scoping without a user_id, which would all collide on null. Those are
+# listed and nothing is built until they are merged or removed.
+import argparse
+import sys
+from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING, IndexModel
+
+INDEXES = {
+    # Everything a user owns is scoped by user_id, with at most one plan per
+    # user and date
+    "diet_plans": [
+        IndexModel([("user_id", ASCENDING), ("date", ASCENDING)], unique=True)
+    ],
+    "workout_plans": [
+        IndexModel([("user_id", ASCENDING), ("date", ASCENDING)], unique=True)
+    ],
+    # Tasks are read per date (or date range) and returned in rank order
+    "tasks": [
+        IndexModel(
+            [
+                ("user_id", ASCENDING),
+                ("date", ASCENDING),
+                ("rank", ASCENDING),
+                ("_id", ASCENDING),
+            ]
+        )
+    ],
+    "users": [
+        IndexModel([("email", ASCENDING)], unique=True),
+        IndexModel([("username", ASCENDING)], unique=True),
+    ],
+    # Templates are shared by every user
+    "workout_templates": [IndexModel([("day", ASCENDING)], unique=True)],
+    # Version counter behind the per-date tasks ETag
+    "task_versions": [
+        IndexModel([("user_id", ASCENDING), ("date", ASCENDING)], unique=True)
+    ],
+    # Token buckets of ratelimit.MongoBackend, an expired bucket is a full one
+    "rate_limits": [IndexModel([("updatedAt", ASCENDING)], expireAfterSeconds=3600)],
+    # Day, week and month totals, see rollups.py
+    "rollups": [
+        IndexModel(
+            [("user_id", ASCENDING), ("period", ASCENDING), ("key", ASCENDING)],
+            unique=True,
+        )
+    ],
+}
+
+# Superseded by the user-scoped indexes above, dropped by ensure_indexes
+OBSOLETE_INDEXES = {
+    "diet_plans": ["date_1"],
+    "workout_plans": ["date_1"],
+    "tasks": ["date_1__id_1", "user_id_1_date_1__id_1"],
+    "task_versions": ["date_1"],
+}
+
+# (collection, filter, sort) for every query a route issues. Marking an
+# exercise complete filters on date and workouts.exercises.id, the unique
+# (user_id, date) index narrows that to a single document.
+SAMPLE_USER = "000000000000000000000000"
+SAMPLE_DATE = {"user_id": SAMPLE_USER, "date": "2024-01-01"}
+SAMPLE_RANGE = {
+    "user_id": SAMPLE_USER,
+    "date": {"$gte": "2024-01-01", "$lte": "2024-01-31"},
+}
+TASK_ORDER = [("date", ASCENDING), ("rank", ASCENDING), ("_id", ASCENDING)]
+LAST_TASK = [("rank", DESCENDING), ("_id", DESCENDING)]
+QUERY_SHAPES = [
+    ("diet_plans", SAMPLE_DATE, None),
+    ("diet_plans", SAMPLE_RANGE, [("date", ASCENDING)]),
+    ("workout_plans", SAMPLE_DATE, None),
+    ("workout_plans", SAMPLE_RANGE, [("date", ASCENDING)]),
+    ("workout_plans", {**SAMPLE_DATE, "workouts.exercises.id": "sample"}, None),
+    ("workout_templates", {"day": "Monday"}, None),
+    ("tasks", SAMPLE_DATE, TASK_ORDER),
+    ("tasks", SAMPLE_RANGE, TASK_ORDER),
+    ("tasks", {"user_id": SAMPLE_USER}, TASK_ORDER),
+    (
+        "tasks",
+        {
+            "user_id": SAMPLE_USER,
+            "date": {"$gte": SAMPLE_DATE["date"]},
+            "$or": [
+                {"date": {"$gt": SAMPLE_DATE["date"]}},
+                {"date": SAMPLE_DATE["date"], "rank": {"$gt": "V"}},
+                {"date": SAMPLE_DATE["date"], "rank": "V", "_id": {"$gt": ObjectId()}},
+            ],
+        },
+        TASK_ORDER,
+    ),
+    ("tasks", SAMPLE_DATE, LAST_TASK),
+    ("tasks", {"_id": ObjectId(), "user_id": SAMPLE_USER}, None),
+    ("task_versions", SAMPLE_DATE, None),
+    (
+        "rollups",
+        {"user_id": SAMPLE_USER, "period": "week", "key": {"$gte": "2024-W01"}},
+        [("key", ASCENDING)],
+    ),
+    ("users", {"email": "sample@example.com"}, None),
+    (
+        "users",
+        {"$or": [{"email": "sample@example.com"}, {"username": "sample"}]},
+        None,
+    ),
+]
+
+
+# Conflicting values listed per index
+MAX_CONFLICTS = 5
+
+
+def unique_conflicts(db):
+    # (collection, index name, description) of what keeps each missing
+    # unique index from being built
+    conflicts = []
+    for collection, indexes in INDEXES.items():
+        existing = db[collection].index_information()
+        for index in indexes:
+            spec = index.document
+            if not spec.get("unique") or spec["name"] in existing:
+                continue
+            fields = list(spec["key"])
+            if "user_id" in fields:
+                legacy = db[collection].count_documents({"user_id": None})
+                if legacy:
+                    conflicts.append(
+                        (collection, spec["name"], f"{legacy} without a user_id")
+                    )
+            duplicates = db[collection].aggregate(
+                [
+                    {
+                        "$group": {
+                            "_id": {field: f"${field}" for field in fields},
+                            "count": {"$sum": 1},
+                        }
+                    },
+                    {"$match": {"count": {"$gt": 1}}},
+                    {"$limit": MAX_CONFLICTS},
+                ],
+                allowDiskUse=True,
+            )
+            for duplicate in duplicates:
+                conflicts.append(
+                    (
+                        collection,
+                        spec["name"],
+                        f"{duplicate['count']} with {duplicate['_id']}",
+                    )
+                )
+    return conflicts
+
+
+def ensure_indexes(db):
+    # Raises ValueError, naming the documents, when a unique index cannot be
+    # built over the existing ones
+    conflicts = unique_conflicts(db)
+    if conflicts:
+        raise ValueError(
+            "Unique indexes conflict with existing documents:\n"
+            + "\n".join(
+                f"  {collection} {name}: {description}"
+                for collection, name, description in conflicts
+            )
+        )
+
+    for collection, names in OBSOLETE_INDEXES.items():
+        existing = db[collection].index_information()
+        for name in names:
+            if name in existing:
+                db[collection].drop_index(name)
+
+    created = {}
+    for collection, indexes in INDEXES.items():
+        created[collection] = db[collection].create_indexes(indexes)
+    return created
+
+
+def plan_stages(plan):
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            yield plan["stage"]
+        for value in plan.values():
+            yield from plan_stages(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            yield from plan_stages(value)
+
+
+# Plan stages meaning a query is not fully served by an index
+UNINDEXED_STAGES = ("COLLSCAN", "SORT")
+
+
+def find_unindexed_queries(db):
+    failures = []
+    for collection, query, sort in QUERY_SHAPES:
+        cursor = db[collection].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        winning_plan = cursor.explain()["queryPlanner"]["winningPlan"]
+        stages = set(plan_stages(winning_plan))
+        for stage in UNINDEXED_STAGES:
+            if stage in stages:
+                failures.append((stage, collection, query, sort))
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Manage MongoDB indexes")
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        help="fail if any route query shape results in a COLLSCAN or SORT",
+    )
+    args = parser.parse_args(argv)
+
+    from db import db
+
+    try:
+        created = ensure_indexes(db)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 1
+    for collection, names in created.items():
+        print(f"{collection}: {', '.join(names)}")
+
+    if args.check:
+        failures = find_unindexed_queries(db)
+        for stage, collection, query, sort in failures:
+            print(f"{stage} on {collection}: filter={query} sort={sort}")
+        if failures:
+            return 1
+        print(f"All {len(QUERY_SHAPES)} query shapes use an index")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,94 @@
+# json_provider.py
+#
+# JSON provider that encodes the BSON types of stored documents (ObjectId,
+# Decimal128, datetimes) while serializing, so routes can return documents
+# straight from the driver. Uses orjson when it is installed, unless
+# JSON_BACKEND=json. Shared by app.py and, through a Quart subclass, asgi.py.
+from bson import Decimal128, ObjectId
+from datetime import datetime, timezone
+from flask.json.provider import DefaultJSONProvider
+from dotenv import load_dotenv
+import os
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+load_dotenv()
+
+USE_ORJSON = orjson is not None and os.getenv("JSON_BACKEND", "orjson") == "orjson"
+
+if orjson is not None:
+    # Datetimes are handed to `default`, which keeps the HTTP date format the
+    # stdlib provider has always sent
+    ORJSON_OPTIONS = orjson.OPT_PASSTHROUGH_DATETIME
+
+
+WEEKDAYS = ("Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun")
+MONTHS = (
+    "Jan",
+    "Feb",
+    "Mar",
+    "Apr",
+    "May",
+    "Jun",
+    "Jul",
+    "Aug",
+    "Sep",
+    "Oct",
+    "Nov",
+    "Dec",
+)
+
+
+def http_datetime(value):
+    # Same output as werkzeug's http_date, which goes through strftime and
+    # dominates the cost of documents with several timestamps. Naive values
+    # are UTC, as BSON datetimes are.
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc)
+    return (
+        f"{WEEKDAYS[value.weekday()]}, {value.day:02d} {MONTHS[value.month - 1]} "
+        f"{value.year:04d} {value.hour:02d}:{value.minute:02d}:{value.second:02d} GMT"
+    )
+
+
+def bson_default(fallback):
+    # Wraps a provider's `default` with the BSON types, checked first since
+    # every document has an ObjectId and timestamps
+    def default(value):
+        if isinstance(value, ObjectId):
+            return str(value)
+        if isinstance(value, datetime):
+            return http_datetime(value)
+        if isinstance(value, Decimal128):
+            return str(value.to_decimal())
+        return fallback(value)
+
+    return default
+
+
+class BSONJSONMixin:
+    use_orjson = USE_ORJSON
+    # Key order carries no meaning for the clients, skip sorting
+    ensure_ascii = False
+    sort_keys = False
+
+    def dumps(self, obj, **kwargs):
+        # Indented output (debug mode) goes through the stdlib encoder
+        if self.use_orjson and "indent" not in kwargs:
+            options = ORJSON_OPTIONS
+            if kwargs.get("sort_keys", self.sort_keys):
+                options |= orjson.OPT_SORT_KEYS
+            return orjson.dumps(obj, default=self.default, option=options).decode()
+        return super().dumps(obj, **kwargs)
+
+    def loads(self, s, **kwargs):
+        if self.use_orjson and not kwargs:
+            return orjson.loads(s)
+        return super().loads(s, **kwargs)
+
+
+class BSONJSONProvider(BSONJSONMixin, DefaultJSONProvider):
+    default = staticmethod(bson_default(DefaultJSONProvider.default))
@@ -0,0 +1,335 @@
+# metrics.py
+#
+# Per-route request metrics in the Prometheus text format, served by
+# GET /api/system/metrics (with SYSTEM_TOKEN, see auth.py):
+#
+#   http_request_duration_seconds   histogram per route and method
+#   http_request_latency_seconds    p50/p95/p99 of the last requests
+#   http_requests_total             per route, method and status
+#   http_request/response_bytes     body sizes
+#   mongo_commands_total            per route and command name, with their
+#   mongo_command_seconds_total     total duration
+#   mongo_commands_per_request      histogram per route
+#   rollup_refreshes_total          background rollup refreshes by result
+#
+# A pymongo CommandListener attributes each command to the request that
+# issued it through a ContextVar, which follows the request's thread (Flask)
+# or task (Quart). Commands issued outside a request count as "background".
+# Requests slower than SLOW_REQUEST_SECONDS are logged, a sampled share of
+# them (SLOW_REQUEST_SAMPLE_RATE) with the shapes of their Mongo queries.
+from bisect import bisect_left
+from collections import deque
+from contextvars import ContextVar
+from dotenv import load_dotenv
+from flask import request
+from pymongo import monitoring
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COMMAND_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 50)
+QUANTILES = (0.5, 0.95, 0.99)
+# Latest durations per route the quantiles are computed from
+RESERVOIR_SIZE = int(os.getenv("METRICS_RESERVOIR_SIZE", 1024))
+
+SLOW_REQUEST_SECONDS = float(os.getenv("SLOW_REQUEST_SECONDS", 1.0))
+SLOW_REQUEST_SAMPLE_RATE = float(os.getenv("SLOW_REQUEST_SAMPLE_RATE", 1.0))
+MAX_QUERY_SHAPES = 20
+
+
+class RequestRecord:
+    # Also updated by the threads a request fans out to (see day_routes.py),
+    # which carry the same record in their copied context
+
+    def __init__(self, route, method):
+        self.route = route
+        self.method = method
+        self.started = time.perf_counter()
+        self.commands = 0
+        self.mongo_seconds = 0.0
+        self.queries = []
+        self._lock = threading.Lock()
+
+    def add_query(self, query):
+        with self._lock:
+            if len(self.queries) < MAX_QUERY_SHAPES:
+                self.queries.append(query)
+
+    def add_command(self, seconds):
+        with self._lock:
+            self.commands += 1
+            self.mongo_seconds += seconds
+
+
+current_request = ContextVar("current_request", default=None)
+
+
+def query_shape(value):
+    # The filter with its values replaced by their type names
+    if isinstance(value, dict):
+        return {key: query_shape(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [query_shape(item) for item in value]
+    return type(value).__name__
+
+
+def _command_filter(command_name, command):
+    if command_name in ("find", "count", "distinct"):
+        return command.get("filter", command.get("query"))
+    if command_name == "findAndModify":
+        return command.get("query")
+    if command_name == "aggregate":
+        return [stage for stage in command.get("pipeline", []) if "$match" in stage]
+    if command_name in ("update", "delete"):
+        statements = command.get("updates") or command.get("deletes") or []
+        return [statement.get("q") for statement in statements[:1]]
+    return None
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.durations = {}
+        self.recent = {}
+        self.requests = {}
+        self.request_bytes = {}
+        self.response_bytes = {}
+        self.commands = {}
+        self.command_seconds = {}
+        self.commands_per_request = {}
+        self.rollup_refreshes = {}
+
+    def observe_command(self, route, command_name, seconds):
+        key = (route, command_name)
+        with self._lock:
+            self.commands[key] = self.commands.get(key, 0) + 1
+            self.command_seconds[key] = self.command_seconds.get(key, 0.0) + seconds
+
+    def observe_rollup(self, result):
+        with self._lock:
+            key = (result,)
+            self.rollup_refreshes[key] = self.rollup_refreshes.get(key, 0) + 1
+
+    def observe_request(self, record, status, request_bytes, response_bytes):
+        duration = time.perf_counter() - record.started
+        key = (record.route, record.method)
+        with self._lock:
+            if key not in self.durations:
+                self.durations[key] = Histogram(LATENCY_BUCKETS)
+                self.recent[key] = deque(maxlen=RESERVOIR_SIZE)
+                self.commands_per_request[key] = Histogram(COMMAND_BUCKETS)
+            self.durations[key].observe(duration)
+            self.recent[key].append(duration)
+            self.commands_per_request[key].observe(record.commands)
+            status_key = (*key, str(status))
+            self.requests[status_key] = self.requests.get(status_key, 0) + 1
+            self.request_bytes[key] = self.request_bytes.get(key, 0) + request_bytes
+            self.response_bytes[key] = self.response_bytes.get(key, 0) + response_bytes
+        return duration
+
+    def render(self):
+        lines = []
+
+        def family(name, kind, help_text):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        def histogram(name, histograms):
+            for (route, method), data in sorted(histograms.items()):
+                labels = f'route="{route}",method="{method}"'
+                cumulative = 0
+                for bound, count in zip(data.buckets + ("+Inf",), data.counts):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+                lines.append(f"{name}_sum{{{labels}}} {data.sum}")
+                lines.append(f"{name}_count{{{labels}}} {data.count}")
+
+        def counter(name, values, label_names):
+            for key, value in sorted(values.items()):
+                labels = ",".join(f'{n}="{v}"' for n, v in zip(label_names, key))
+                lines.append(f"{name}{{{labels}}} {value}")
+
+        with self._lock:
+            family("http_request_duration_seconds", "histogram", "Request duration.")
+            histogram("http_request_duration_seconds", self.durations)
+
+            family(
+                "http_request_latency_seconds",
+                "summary",
+                f"Quantiles of the last {RESERVOIR_SIZE} requests.",
+            )
+            for (route, method), recent in sorted(self.recent.items()):
+                ordered = sorted(recent)
+                labels = f'route="{route}",method="{method}"'
+                for quantile in QUANTILES:
+                    value = ordered[min(len(ordered) - 1, int(quantile * len(ordered)))]
+                    lines.append(
+                        f'http_request_latency_seconds{{{labels},quantile="{quantile}"}} {value}'
+                    )
+
+            family("http_requests_total", "counter", "Requests by status.")
+            counter("http_requests_total", self.requests, ("route", "method", "status"))
+            family("http_request_bytes_total", "counter", "Request body bytes.")
+            counter("http_request_bytes_total", self.request_bytes, ("route", "method"))
+            family("http_response_bytes_total", "counter", "Response body bytes.")
+            counter(
+                "http_response_bytes_total", self.response_bytes, ("route", "method")
+            )
+
+            family("mongo_commands_total", "counter", "Mongo commands by route.")
+            counter("mongo_commands_total", self.commands, ("route", "command"))
+            family("mongo_command_seconds_total", "counter", "Mongo command duration.")
+            counter(
+                "mongo_command_seconds_total",
+                self.command_seconds,
+                ("route", "command"),
+            )
+            family(
+                "mongo_commands_per_request", "histogram", "Mongo commands per request."
+            )
+            histogram("mongo_commands_per_request", self.commands_per_request)
+
+            family("rollup_refreshes_total", "counter", "Rollup refreshes by result.")
+            counter("rollup_refreshes_total", self.rollup_refreshes, ("result",))
+
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+class CommandMetrics(monitoring.CommandListener):
+    def started(self, event):
+        record = current_request.get()
+        if (
+            record is not None
+            and SLOW_REQUEST_SECONDS > 0
+            and len(record.queries) < MAX_QUERY_SHAPES
+        ):
+            record.add_query(
+                (
+                    event.command_name,
+                    event.command.get(event.command_name),
+                    _command_filter(event.command_name, event.command),
+                )
+            )
+
+    def _finished(self, event):
+        record = current_request.get()
+        seconds = event.duration_micros / 1e6
+        if record is not None:
+            record.add_command(seconds)
+        registry.observe_command(
+            record.route if record else "background", event.command_name, seconds
+        )
+
+    def succeeded(self, event):
+        self._finished(event)
+
+    def failed(self, event):
+        self._finished(event)
+
+
+command_metrics = CommandMetrics()
+
+
+def start_request(route, method):
+    record = RequestRecord(route, method)
+    current_request.set(record)
+    return record
+
+
+def finish_request(record, status, request_bytes, response_bytes):
+    # Later commands on this thread or task are no longer the request's
+    current_request.set(None)
+    duration = registry.observe_request(record, status, request_bytes, response_bytes)
+    if (
+        SLOW_REQUEST_SECONDS > 0
+        and duration >= SLOW_REQUEST_SECONDS
+        and random.random() < SLOW_REQUEST_SAMPLE_RATE
+    ):
+        logger.warning(
+            "Slow request %s %s: %.3fs, %d Mongo commands in %.3fs, queries %s",
+            record.method,
+            record.route,
+            duration,
+            record.commands,
+            record.mongo_seconds,
+            json.dumps(
+                [
+                    {"command": name, "collection": collection, "shape": query_shape(f)}
+                    for name, collection, f in record.queries
+                ],
+                default=str,
+            ),
+        )
+
+
+def route_label(url_rule):
+    # The rule, not the path, keeps the label set bounded
+    return url_rule.rule if url_rule is not None else "unmatched"
+
+
+def _start_flask_request():
+    start_request(route_label(request.url_rule), request.method)
+
+
+def _finish_flask_request(response):
+    record = current_request.get()
+    if record is None:
+        return response
+    request_bytes = request.content_length or 0
+
+    if response.is_streamed and response.mimetype != "text/event-stream":
+        # Counted as the body is sent, recorded once it is done. Event
+        # streams last as long as their subscriber and are recorded when
+        # opened, like any response of the ASGI app.
+        sent = [0]
+        body = response.response
+
+        def counted():
+            for chunk in body:
+                sent[0] += len(chunk)
+                yield chunk
+
+        response.response = counted()
+        response.call_on_close(
+            lambda: finish_request(record, response.status_code, request_bytes, sent[0])
+        )
+    elif response.is_streamed:
+        # Measuring the body would consume the stream
+        finish_request(record, response.status_code, request_bytes, 0)
+    else:
+        finish_request(
+            record,
+            response.status_code,
+            request_bytes,
+            response.calculate_content_length() or 0,
+        )
+    return response
+
+
+def instrument(app):
+    app.before_request(_start_flask_request)
+    app.after_request(_finish_flask_request)
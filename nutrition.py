@@ -0,0 +1,203 @@
+# nutrition.py
+#
+# Per-meal and daily nutrition totals computed from a diet plan's `meals`,
+# so that dailyTotal is derived on the server instead of trusted as sent.
+#
+# `meals` is keyed by meal time (a list of meals with a `mealTime` is read
+# the same way). A meal's nutrients are either on the meal itself or on the
+# foods listed under `items` / `foods`:
+#
+#   {"breakfast": {"items": [{"name": "Oats", "calories": 380, ...}]},
+#    "lunch": {"calories": 650, "protein": 40}}
+#
+# plan_totals handles one plan. daily_totals aggregates many plans at once
+# (range exports, rollup rebuilds) as one foods x nutrients array summed per
+# plan, using numpy when it is installed. Every total is the sum of its
+# foods in order, rounded once at the end, so that all of them agree.
+from dotenv import load_dotenv
+import os
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+load_dotenv()
+
+NUTRIENTS = tuple(
+    name.strip()
+    for name in os.getenv("NUTRIENTS", "calories,protein,carbs,fat").split(",")
+    if name.strip()
+)
+FOOD_LISTS = ("items", "foods")
+
+# A dailyTotal sent by the client may differ from the computed one by
+# rounding, anything further is rejected
+DAILY_TOTAL_TOLERANCE = float(os.getenv("DAILY_TOTAL_TOLERANCE", 0.5))
+
+
+NUMBER_TYPES = {int, float, type(None)}
+
+
+def _meal_entries(meals):
+    if isinstance(meals, dict):
+        return meals.items()
+    if isinstance(meals, list):
+        return [
+            (meal.get("mealTime", str(i)) if isinstance(meal, dict) else str(i), meal)
+            for i, meal in enumerate(meals)
+        ]
+    raise ValueError("meals must be an object or a list")
+
+
+def _meal_foods(meal_time, meal):
+    if not isinstance(meal, dict):
+        raise ValueError(f"Meal {meal_time} must be an object")
+    for name in FOOD_LISTS:
+        foods = meal.get(name)
+        if isinstance(foods, list):
+            return [food for food in foods if isinstance(food, dict)]
+    return [meal]
+
+
+def _plan_foods(meals):
+    # (meal times, foods, meal index of each food)
+    meal_times, foods, index = [], [], []
+    for meal_time, meal in _meal_entries(meals):
+        meal_foods = _meal_foods(meal_time, meal)
+        foods.extend(meal_foods)
+        index.extend([len(meal_times)] * len(meal_foods))
+        meal_times.append(str(meal_time))
+    return meal_times, foods, index
+
+
+def _values(foods):
+    # Nutrient values of the foods, flattened in NUTRIENTS order with None
+    # where a food has no value. Only the types are checked here, the sums
+    # are checked for negative values.
+    values = [food.get(name) for food in foods for name in NUTRIENTS]
+    if not NUMBER_TYPES.issuperset(map(type, values)):
+        _invalid(foods)
+    return values
+
+
+def _invalid(foods):
+    # Raises the ValueError naming the first bad value
+    for food in foods:
+        for name in NUTRIENTS:
+            value = food.get(name)
+            if value is None:
+                continue
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                raise ValueError(f"{name} must be a number")
+            if value < 0:
+                raise ValueError(f"{name} must not be negative")
+    raise ValueError("Invalid nutrient values")
+
+
+def round_total(value):
+    # Also used for the sums of totals kept by rollups.py
+    value = round(value, 2)
+    return int(value) if float(value).is_integer() else value
+
+
+def _rounded(values):
+    return {name: round_total(value) for name, value in zip(NUTRIENTS, values)}
+
+
+def _sum_rows(values, index, count):
+    # Per-group sums of the flat values, and whether each group had any value
+    width = len(NUTRIENTS)
+    sums = [[0] * width for _ in range(count)]
+    present = [False] * count
+    for row, i in enumerate(index):
+        totals = sums[i]
+        for k, value in enumerate(values[row * width : (row + 1) * width]):
+            if value is not None:
+                if value < 0:
+                    raise ValueError(f"{NUTRIENTS[k]} must not be negative")
+                totals[k] += value
+                present[i] = True
+    return sums, present
+
+
+def check_foods(foods):
+    # Raises ValueError for nutrient values that are not non-negative numbers
+    _sum_rows(_values(foods), [0] * len(foods), 1)
+
+
+def check_meal(meal_time, meal):
+    check_foods(_meal_foods(meal_time, meal))
+
+
+def plan_totals(meals):
+    # ({meal time: totals}, daily total) of one plan, or None when no meal
+    # carries nutrient values. Raises ValueError for malformed meals.
+    meal_times, foods, index = _plan_foods(meals)
+    values = _values(foods)
+    sums, present = _sum_rows(values, index, len(meal_times))
+    if not any(present):
+        return None
+
+    # Summed from the foods rather than the meal totals, as daily_totals does
+    (daily,), _ = _sum_rows(values, [0] * len(foods), 1)
+    return dict(zip(meal_times, map(_rounded, sums))), _rounded(daily)
+
+
+def daily_totals(plans):
+    # Daily totals of many `meals` values in one pass, None for the plans
+    # without nutrient values. Raises ValueError for malformed meals.
+    foods, counts = [], []
+    for meals in plans:
+        size = len(foods)
+        for meal_time, meal in _meal_entries(meals):
+            foods.extend(_meal_foods(meal_time, meal))
+        counts.append(len(foods) - size)
+    values = _values(foods)
+
+    if numpy is None or not foods:
+        index = [i for i, count in enumerate(counts) for _ in range(count)]
+        sums, present = _sum_rows(values, index, len(plans))
+        return [
+            _rounded(values) if has_values else None
+            for values, has_values in zip(sums, present)
+        ]
+
+    # None becomes NaN, which marks the missing values
+    rows = numpy.array(values, dtype=numpy.float64).reshape(-1, len(NUTRIENTS))
+    missing = numpy.isnan(rows)
+    rows[missing] = 0
+    if (rows < 0).any():
+        _invalid(foods)
+
+    # bincount adds each plan's foods in order, like _sum_rows
+    index = numpy.repeat(numpy.arange(len(plans)), counts)
+    sums = numpy.column_stack(
+        [
+            numpy.bincount(index, weights=rows[:, k], minlength=len(plans))
+            for k in range(len(NUTRIENTS))
+        ]
+    )
+    present = numpy.bincount(index, weights=~missing.all(axis=1), minlength=len(plans))
+    return [
+        _rounded(values) if has_values else None
+        for values, has_values in zip(sums.tolist(), present.tolist())
+    ]
+
+
+def check_daily_total(sent, computed):
+    # Raises ValueError when a dailyTotal sent with the meals disagrees with
+    # the one computed from them
+    if not isinstance(sent, dict):
+        raise ValueError("dailyTotal must be an object")
+    for name, value in computed.items():
+        if name not in sent:
+            continue
+        if (
+            isinstance(sent[name], bool)
+            or not isinstance(sent[name], (int, float))
+            or abs(sent[name] - value) > DAILY_TOTAL_TOLERANCE
+        ):
+            raise ValueError(
+                f"dailyTotal.{name} does not match the meals (expected {value})"
+            )
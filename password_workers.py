@@ -0,0 +1,48 @@
+# password_workers.py
+#
+# What the password pool's processes run (see passwords.py). Workers are
+# spawned and import this module to unpickle their tasks, so it has no
+# settings and no side effects: the hash method is passed with every call,
+# and nothing but werkzeug is imported.
+from werkzeug.security import check_password_hash, generate_password_hash
+import time
+
+
+def _cost(method):
+    # (algorithm, work factor) of a werkzeug method string, with werkzeug's
+    # defaults for the parts left out
+    name, *args = method.split(":")
+    if name == "scrypt":
+        n, r, p = (list(map(int, args)) + [2**15, 8, 1][len(args) :])[:3]
+        return name, n * r * p
+    if name == "pbkdf2":
+        digest = args[0] if args else "sha256"
+        return f"{name}:{digest}", int(args[1]) if len(args) > 1 else 1_000_000
+    return name, 0
+
+
+def needs_rehash(stored_hash, method):
+    wanted_algorithm, wanted_cost = _cost(method)
+    try:
+        algorithm, cost = _cost(stored_hash.split("$", 1)[0])
+    except ValueError:
+        return True
+    return algorithm != wanted_algorithm or cost < wanted_cost
+
+
+def timed_hash(password, method):
+    # (hash, seconds the hashing took)
+    started = time.perf_counter()
+    hashed = generate_password_hash(password, method=method)
+    return hashed, time.perf_counter() - started
+
+
+def timed_verify(stored_hash, password, method):
+    # ((matches, replacement hash or None), seconds), the rehash is done in
+    # the same round trip to the pool
+    started = time.perf_counter()
+    matches = check_password_hash(stored_hash, password)
+    rehashed = None
+    if matches and needs_rehash(stored_hash, method):
+        rehashed = generate_password_hash(password, method=method)
+    return (matches, rehashed), time.perf_counter() - started
@@ -0,0 +1,180 @@
+# passwords.py
+#
+# Password hashing on a bounded process pool, so that a burst of logins
+# cannot starve the other routes of CPU (or, with threads, of the GIL).
+# At most PASSWORD_HASH_QUEUE hashes are queued or running per process;
+# beyond that calls fail fast with PoolBusy and the routes answer 503.
+#
+# PASSWORD_HASH_METHOD takes werkzeug's method strings, e.g.
+# "scrypt:32768:8:1" or "pbkdf2:sha256:1000000". Stored hashes of another
+# algorithm or of a lower cost are replaced on the next successful login.
+#
+# The pool is created on the first hash, never at import. Its processes
+# only run password_workers.py; being spawned, they also import the
+# __main__ module of the server, whose start stays behind
+# `if __name__ == "__main__"`.
+from concurrent.futures import ProcessPoolExecutor
+from dotenv import load_dotenv
+import asyncio
+import multiprocessing
+import os
+import threading
+import time
+
+import password_workers
+from password_workers import timed_hash, timed_verify
+
+load_dotenv()
+
+HASH_METHOD = os.getenv("PASSWORD_HASH_METHOD", "scrypt:32768:8:1")
+HASH_WORKERS = int(
+    os.getenv("PASSWORD_HASH_WORKERS", max(1, (os.cpu_count() or 2) // 2))
+)
+HASH_QUEUE = int(os.getenv("PASSWORD_HASH_QUEUE", HASH_WORKERS * 4))
+
+
+class PoolBusy(Exception):
+    pass
+
+
+def needs_rehash(stored_hash, method=HASH_METHOD):
+    return password_workers.needs_rehash(stored_hash, method)
+
+
+class HashMetrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.completed = 0
+            self.rejected = 0
+            self.rehashed = 0
+            self.depth = 0
+            self.max_depth = 0
+            self.hash_time = 0.0
+            self.max_hash_time = 0.0
+            self.wait_time = 0.0
+
+    def admit(self):
+        with self._lock:
+            if self.depth >= HASH_QUEUE:
+                self.rejected += 1
+                return False
+            self.depth += 1
+            self.max_depth = max(self.max_depth, self.depth)
+            return True
+
+    def record_rehash(self):
+        with self._lock:
+            self.rehashed += 1
+
+    def done(self, hash_time, total_time):
+        with self._lock:
+            self.depth -= 1
+            if hash_time is None:
+                return
+            self.completed += 1
+            self.hash_time += hash_time
+            self.max_hash_time = max(self.max_hash_time, hash_time)
+            self.wait_time += max(0.0, total_time - hash_time)
+
+    def stats(self):
+        with self._lock:
+            completed = self.completed or 1
+            return {
+                "method": HASH_METHOD,
+                "workers": HASH_WORKERS,
+                "queueLimit": HASH_QUEUE,
+                "depth": self.depth,
+                "maxDepth": self.max_depth,
+                "completed": self.completed,
+                "rejected": self.rejected,
+                "rehashed": self.rehashed,
+                "avgHashSeconds": self.hash_time / completed,
+                "maxHashSeconds": self.max_hash_time,
+                "avgWaitSeconds": self.wait_time / completed,
+            }
+
+
+hash_metrics = HashMetrics()
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    # Created on first use and again in a forked child. Workers are spawned,
+    # not forked, so they never inherit the server's threads or sockets.
+    global _pool, _pool_pid
+    if _pool is None or _pool_pid != os.getpid():
+        with _pool_lock:
+            if _pool is None or _pool_pid != os.getpid():
+                _pool = ProcessPoolExecutor(
+                    HASH_WORKERS, mp_context=multiprocessing.get_context("spawn")
+                )
+                _pool_pid = os.getpid()
+    return _pool
+
+
+def _reset_after_fork():
+    global _pool, _pool_pid, _pool_lock
+    _pool, _pool_pid = None, None
+    _pool_lock = threading.Lock()
+    hash_metrics.reset()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _submit(function, *args):
+    # Future of (result, hash seconds), or PoolBusy when the queue is full
+    if not hash_metrics.admit():
+        raise PoolBusy("Too many password checks in progress, try again shortly")
+
+    started = time.perf_counter()
+    try:
+        future = get_pool().submit(function, *args)
+    except Exception:
+        hash_metrics.done(None, 0)
+        raise
+
+    def finished(future):
+        hash_time = None
+        if not future.cancelled() and future.exception() is None:
+            hash_time = future.result()[1]
+        hash_metrics.done(hash_time, time.perf_counter() - started)
+
+    future.add_done_callback(finished)
+    return future
+
+
+def _verified(result):
+    matches, rehashed = result
+    if rehashed is not None:
+        hash_metrics.record_rehash()
+    return matches, rehashed
+
+
+def hash_password(password):
+    return _submit(timed_hash, password, HASH_METHOD).result()[0]
+
+
+def verify_password(stored_hash, password):
+    # (matches, replacement hash to store or None)
+    return _verified(
+        _submit(timed_verify, stored_hash, password, HASH_METHOD).result()[0]
+    )
+
+
+async def hash_password_async(password):
+    result = await asyncio.wrap_future(_submit(timed_hash, password, HASH_METHOD))
+    return result[0]
+
+
+async def verify_password_async(stored_hash, password):
+    future = _submit(timed_verify, stored_hash, password, HASH_METHOD)
+    return _verified((await asyncio.wrap_future(future))[0])
@@ -0,0 +1,276 @@
+# patches.py
+#
+# Partial updates of diet and workout plans (PATCH /api/diet and
+# /api/workout). The body is a list of JSON-Patch style operations, which
+# become one targeted Mongo update with array filters, so that editing one
+# food or exercise sends and writes that element only. Array elements are
+# addressed by a key rather than an index, which stays valid when another
+# device reorders them:
+#
+#   /meals/{mealTime}[/{field}]
+#   /meals/{mealTime}/items/{food name}[/{field}]        or .../foods/...
+#   /meals/{mealTime}/items/-                            appends a food
+#   /workouts/{category name}[/{field}]
+#   /workouts/-                                          appends a category
+#   /workouts/{category name}/exercises/{exercise id}[/{field}]
+#   /workouts/{category name}/exercises/-                appends an exercise
+#
+# Operations are "add", "replace" and "remove", "add" on an existing key
+# replaces it. Keys are JSON-Pointer escaped ("~1" for "/", "~0" for "~").
+# The elements a patch addresses and the fields it removes must exist, the
+# update only matches a plan that has them all.
+from dotenv import load_dotenv
+import os
+
+from nutrition import FOOD_LISTS, NUTRIENTS, check_foods, check_meal
+
+load_dotenv()
+
+MAX_PATCH_OPERATIONS = int(os.getenv("MAX_PATCH_OPERATIONS", 100))
+
+OPERATIONS = ("add", "replace", "remove")
+MISSING_TARGET = "A path of the patch does not exist in the plan"
+FOOD_KEY = "name"
+CATEGORY_KEY = "name"
+EXERCISE_KEY = "id"
+
+
+def parse_operations(body):
+    if not isinstance(body, list) or not body:
+        raise ValueError("Body must be a non-empty list of operations")
+    if len(body) > MAX_PATCH_OPERATIONS:
+        raise ValueError(f"At most {MAX_PATCH_OPERATIONS} operations per patch")
+    for operation in body:
+        if not isinstance(operation, dict) or operation.get("op") not in OPERATIONS:
+            raise ValueError(f"op must be one of {', '.join(OPERATIONS)}")
+        if operation["op"] != "remove" and "value" not in operation:
+            raise ValueError(f"{operation['op']} needs a value")
+    return body
+
+
+def parse_pointer(path):
+    if not isinstance(path, str) or not path.startswith("/"):
+        raise ValueError("path must be a JSON pointer such as /meals/lunch")
+    parts = [part.replace("~1", "/").replace("~0", "~") for part in path[1:].split("/")]
+    for part in parts:
+        # Keys become Mongo field names
+        if not part or "." in part or part.startswith("$"):
+            raise ValueError(f"Invalid path {path}")
+    return parts
+
+
+def _key_values(key):
+    # Path keys are strings, stored ids may be numbers
+    if key.lstrip("-").isdigit():
+        return [key, int(key)]
+    return [key]
+
+
+class PlanPatch:
+    # The operators of one update, built from the operations in order
+
+    def __init__(self):
+        self.set = {}
+        self.unset = {}
+        self.push = {}
+        self.pull = {}
+        self.array_filters = []
+        self.required = []
+        self._identifiers = {}
+        self._elements = {}
+
+    def element(self, array, field, key):
+        # "$[name]" matching the element of `array` whose `field` is `key`,
+        # shared by the operations on the same element
+        name = self._identifiers.get((array, field, key))
+        if name is None:
+            name = self._identifiers[(array, field, key)] = f"e{len(self._identifiers)}"
+            self._elements[name] = (field, _key_values(key))
+            self.array_filters.append({f"{name}.{field}": {"$in": _key_values(key)}})
+            self.required.append(
+                self._within(array, {field: {"$in": _key_values(key)}})
+            )
+        return f"$[{name}]"
+
+    def _within(self, array, match):
+        # Condition on an element of `array` matching `match`, where `array`
+        # may itself be inside elements of the patch
+        parent, marker, rest = array.rpartition(".$[")
+        if not marker:
+            return {array: {"$elemMatch": match}}
+        name, _, subpath = rest.partition("].")
+        field, keys = self._elements[name]
+        return self._within(
+            parent, {field: {"$in": keys}, subpath: {"$elemMatch": match}}
+        )
+
+    def _exists(self, path):
+        parent, marker, rest = path.rpartition(".$[")
+        if not marker:
+            return {path: {"$exists": True}}
+        name, _, subpath = rest.partition("].")
+        field, keys = self._elements[name]
+        return self._within(parent, {field: {"$in": keys}, subpath: {"$exists": True}})
+
+    def _check_unique(self, path):
+        if path in self.set or path in self.unset:
+            raise ValueError(f"{path} is changed twice")
+
+    def assign(self, operation, path):
+        self._check_unique(path)
+        if operation["op"] == "remove":
+            self.unset[path] = ""
+            self.required.append(self._exists(path))
+        else:
+            self.set[path] = operation["value"]
+
+    def append(self, operation, path):
+        if operation["op"] != "add":
+            raise ValueError("Only add can append with -")
+        if not isinstance(operation["value"], dict):
+            raise ValueError("Appended values must be objects")
+        self.push.setdefault(path, []).append(operation["value"])
+
+    def remove(self, path, field, key):
+        self.pull.setdefault(path, (field, []))[1].extend(_key_values(key))
+        self.required.append(self._within(path, {field: {"$in": _key_values(key)}}))
+
+    def update(self, version_field, now):
+        update = {"$set": {**self.set, version_field: now}}
+        if self.unset:
+            update["$unset"] = self.unset
+        if self.push:
+            update["$push"] = {
+                path: {"$each": values} for path, values in self.push.items()
+            }
+        if self.pull:
+            update["$pull"] = {
+                path: {field: {"$in": keys}}
+                for path, (field, keys) in self.pull.items()
+            }
+        return update
+
+    def query(self):
+        # Filter matching only plans with everything the patch addresses
+        return {"$and": self.required} if self.required else {}
+
+
+def _check_value(operation, check):
+    if operation["op"] != "remove":
+        check(operation["value"])
+
+
+def _check_object(value):
+    if not isinstance(value, dict):
+        raise ValueError("Value must be an object")
+
+
+def _check_list(value):
+    if not isinstance(value, list) or not all(isinstance(v, dict) for v in value):
+        raise ValueError("Value must be a list of objects")
+
+
+def _check_foods(value):
+    _check_list(value)
+    check_foods(value)
+
+
+def _check_food(value):
+    _check_object(value)
+    check_foods([value])
+
+
+def _check_field(field):
+    # Nutrient values are checked like those of a whole plan
+    def check(value):
+        if field in NUTRIENTS:
+            check_foods([{field: value}])
+
+    return check
+
+
+def diet_patch(operations, now):
+    # (update, array_filters, query) of a diet plan, the query to be added
+    # to the plan's filter. Raises ValueError.
+    patch = PlanPatch()
+    for operation in parse_operations(operations):
+        parts = parse_pointer(operation.get("path"))
+        if parts[0] != "meals" or len(parts) < 2:
+            raise ValueError("Diet plan paths start with /meals/{mealTime}")
+        meal_time, rest = parts[1], parts[2:]
+        meal = f"meals.{meal_time}"
+
+        if not rest:
+            _check_value(operation, lambda value: check_meal(meal_time, value))
+            patch.assign(operation, meal)
+        elif rest[0] not in FOOD_LISTS:
+            _check_value(operation, _check_field(rest[-1]))
+            patch.assign(operation, f"{meal}.{'.'.join(rest)}")
+        elif len(rest) == 1:
+            _check_value(operation, _check_foods)
+            patch.assign(operation, f"{meal}.{rest[0]}")
+        elif rest[1] == "-":
+            if len(rest) > 2:
+                raise ValueError("Nothing can follow - in a path")
+            _check_value(operation, _check_food)
+            patch.append(operation, f"{meal}.{rest[0]}")
+        elif len(rest) == 2 and operation["op"] == "remove":
+            patch.remove(f"{meal}.{rest[0]}", FOOD_KEY, rest[1])
+        else:
+            foods = f"{meal}.{rest[0]}"
+            food = f"{foods}.{patch.element(foods, FOOD_KEY, rest[1])}"
+            if len(rest) == 2:
+                _check_value(operation, _check_food)
+                patch.assign(operation, food)
+            else:
+                _check_value(operation, _check_field(rest[-1]))
+                patch.assign(operation, f"{food}.{'.'.join(rest[2:])}")
+    return patch.update("lastUpdated", now), patch.array_filters, patch.query()
+
+
+def workout_patch(operations, now):
+    # (update, array_filters, query) of a workout plan. Raises ValueError.
+    patch = PlanPatch()
+    for operation in parse_operations(operations):
+        parts = parse_pointer(operation.get("path"))
+        if parts[0] != "workouts" or len(parts) < 2:
+            raise ValueError("Workout plan paths start with /workouts/{category}")
+        category, rest = parts[1], parts[2:]
+
+        if category == "-":
+            if rest:
+                raise ValueError("Nothing can follow - in a path")
+            patch.append(operation, "workouts")
+            continue
+        if not rest:
+            if operation["op"] == "remove":
+                patch.remove("workouts", CATEGORY_KEY, category)
+            else:
+                _check_value(operation, _check_object)
+                patch.assign(
+                    operation,
+                    f"workouts.{patch.element('workouts', CATEGORY_KEY, category)}",
+                )
+            continue
+
+        base = f"workouts.{patch.element('workouts', CATEGORY_KEY, category)}"
+        if rest[0] != "exercises":
+            patch.assign(operation, f"{base}.{'.'.join(rest)}")
+        elif len(rest) == 1:
+            _check_value(operation, _check_list)
+            patch.assign(operation, f"{base}.exercises")
+        elif rest[1] == "-":
+            if len(rest) > 2:
+                raise ValueError("Nothing can follow - in a path")
+            patch.append(operation, f"{base}.exercises")
+        elif len(rest) == 2 and operation["op"] == "remove":
+            patch.remove(f"{base}.exercises", EXERCISE_KEY, rest[1])
+        else:
+            exercises = f"{base}.exercises"
+            exercise = f"{exercises}.{patch.element(exercises, EXERCISE_KEY, rest[1])}"
+            if len(rest) == 2:
+                _check_value(operation, _check_object)
+                patch.assign(operation, exercise)
+            else:
+                patch.assign(operation, f"{exercise}.{'.'.join(rest[2:])}")
+    return patch.update("updatedAt", now), patch.array_filters, patch.query()
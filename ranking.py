@@ -0,0 +1,76 @@
+# ranking.py
+#
+# Lexicographic rank keys for ordering tasks within a day. A key between any
+# two neighbours can always be generated, so moving a task rewrites only that
+# task. Keys grow when the same gap is split repeatedly; rebalanced_ranks
+# hands out short, evenly spaced keys again. Appending counts up from the
+# last key instead of splitting the gap to the end, so a day's keys only
+# grow by a digit every BASE - 1 appends.
+#
+# Keys are base 62 fractions written without the leading "0." and never end
+# in "0", which keeps every key distinct from its padded forms.
+DIGITS = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+BASE = len(DIGITS)
+
+
+def _midpoint(lower, upper):
+    if upper is not None:
+        # Keep the common prefix and split the remainder
+        n = 0
+        while n < len(upper) and (lower[n] if n < len(lower) else "0") == upper[n]:
+            n += 1
+        if n > 0:
+            return upper[:n] + _midpoint(lower[n:], upper[n:])
+
+    digit_lower = DIGITS.index(lower[0]) if lower else 0
+    digit_upper = DIGITS.index(upper[0]) if upper is not None else BASE
+    if digit_upper - digit_lower > 1:
+        return DIGITS[(digit_lower + digit_upper + 1) // 2]
+    if upper is not None and len(upper) > 1:
+        return upper[:1]
+    return DIGITS[digit_lower] + _midpoint(lower[1:], None)
+
+
+def _increment(lower):
+    # The shortest key after `lower`: its first digit that is not the last
+    # one, plus one
+    n = 0
+    while n < len(lower) and lower[n] == DIGITS[-1]:
+        n += 1
+    if n < len(lower):
+        return lower[:n] + DIGITS[DIGITS.index(lower[n]) + 1]
+    return lower + DIGITS[1]
+
+
+def rank_between(before=None, after=None):
+    # A key sorting strictly after `before` and before `after`, None meaning
+    # the start or end of the list
+    lower = before or ""
+    if after is not None and lower >= after:
+        raise ValueError(f"Cannot rank between {before!r} and {after!r}")
+    if lower.endswith("0") or (after or "").endswith("0"):
+        raise ValueError("Rank keys cannot end in 0")
+    if after is None and lower:
+        return _increment(lower)
+    return _midpoint(lower, after)
+
+
+def rebalanced_ranks(count):
+    # `count` evenly spaced keys of the shortest length leaving room for at
+    # least BASE - 1 further keys between neighbours
+    width = 1
+    while BASE**width < (count + 1) * BASE:
+        width += 1
+
+    step = BASE**width // (count + 1)
+    ranks = []
+    for i in range(1, count + 1):
+        value = i * step
+        if value % BASE == 0:
+            value += 1
+        digits = []
+        for _ in range(width):
+            value, digit = divmod(value, BASE)
+            digits.append(DIGITS[digit])
+        ranks.append("".join(reversed(digits)).rstrip("0"))
+    return ranks
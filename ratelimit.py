@@ -0,0 +1,151 @@
+# ratelimit.py
+#
+# Token bucket rate limits. A rule allows `rate` requests per second per key
+# (a user id or a client address) with bursts of up to `burst`. Buckets live
+# in a backend chosen with RATE_LIMIT_BACKEND:
+#
+#   memory   per process (the default), a worker's share of the limit
+#   mongo    shared by every worker, one atomic update per request in the
+#            rate_limits collection
+#
+# Other backends implement take(key, rate, burst) -> (allowed, retry_after)
+# and are added to BACKENDS.
+from collections import OrderedDict
+from datetime import datetime
+from dotenv import load_dotenv
+from flask import g, jsonify, request
+from pymongo import ReturnDocument
+import math
+import os
+import threading
+import time
+
+from db import db
+
+load_dotenv()
+
+
+def _rule(name, rate, burst):
+    prefix = f"RATE_LIMIT_{name.upper()}"
+    return (
+        float(os.getenv(f"{prefix}_RATE", rate)),
+        float(os.getenv(f"{prefix}_BURST", burst)),
+    )
+
+
+# Polling a plan a few times a second is fine, hammering it is not. Logins
+# are few, and each one costs a deliberately slow password hash.
+RULES = {
+    "reads": _rule("reads", 10, 30),
+    "login": _rule("login", 0.2, 5),
+}
+
+ENABLED = os.getenv("RATE_LIMIT_ENABLED", "true").lower() == "true"
+
+TOO_MANY_REQUESTS = "Too many requests, slow down"
+
+
+class MemoryBackend:
+    # Blocking backends are called off the event loop by the ASGI app
+    blocking = False
+
+    def __init__(self, maxsize=int(os.getenv("RATE_LIMIT_MEMORY_SIZE", 65536))):
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst):
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            # Least recently used keys go first, a forgotten bucket is a full one
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+        return allowed, 0 if allowed else (1 - tokens) / rate
+
+
+class MongoBackend:
+    blocking = True
+
+    def __init__(self, database=db):
+        self.database = database
+
+    def take(self, key, rate, burst):
+        # Refill, then spend a token if there is one, in a single pipeline
+        # update so that concurrent requests on other workers cannot both
+        # spend the last token
+        now = datetime.utcnow()
+        elapsed = {
+            "$divide": [{"$subtract": [now, {"$ifNull": ["$updatedAt", now]}]}, 1000]
+        }
+        tokens = {
+            "$min": [
+                burst,
+                {
+                    "$add": [
+                        {"$ifNull": ["$tokens", burst]},
+                        {"$multiply": [elapsed, rate]},
+                    ]
+                },
+            ]
+        }
+        bucket = self.database.rate_limits.find_one_and_update(
+            {"_id": key},
+            [
+                {"$set": {"tokens": tokens, "updatedAt": now}},
+                {"$set": {"allowed": {"$gte": ["$tokens", 1]}}},
+                {
+                    "$set": {
+                        "tokens": {
+                            "$cond": [
+                                "$allowed",
+                                {"$subtract": ["$tokens", 1]},
+                                "$tokens",
+                            ]
+                        }
+                    }
+                },
+            ],
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        allowed = bucket["allowed"]
+        return allowed, 0 if allowed else (1 - bucket["tokens"]) / rate
+
+
+BACKENDS = {"memory": MemoryBackend, "mongo": MongoBackend}
+
+backend = BACKENDS[os.getenv("RATE_LIMIT_BACKEND", "memory")]()
+
+
+def take(rule, key):
+    # (allowed, seconds until a request would be allowed)
+    if not ENABLED:
+        return True, 0
+    rate, burst = RULES[rule]
+    return backend.take(f"{rule}:{key}", rate, burst)
+
+
+def retry_headers(retry_after):
+    return {"Retry-After": str(max(1, math.ceil(retry_after)))}
+
+
+def limit_reads():
+    # before_request hook for the polled GET routes, registered after
+    # authenticate so that g.user_id is set
+    if request.method != "GET":
+        return None
+
+    allowed, retry_after = take("reads", g.user_id)
+    if not allowed:
+        return (
+            jsonify({"data": None, "success": False, "error": TOO_MANY_REQUESTS}),
+            429,
+            retry_headers(retry_after),
+        )
+    return None
@@ -0,0 +1,446 @@
+# rollups.py
+#
+# Per-user nutrition and adherence totals by day, ISO week and month, kept in
+# the rollups collection so that analytics never scan the plans.
+#
+# Every write to a diet plan, workout plan or task schedules its day. The
+# day's contribution is recomputed from that day's documents, nutrition from
+# the meals as in a rebuild, swapped into the day rollup atomically, and the
+# difference to the previous contribution is $inc'ed into the week and month.
+# Week and month therefore always equal the sum of their days, whatever order
+# concurrent refreshes finish in. Nutrition differences and sums are rounded
+# like the totals themselves, and rounded again when served, so that float
+# error never builds up. Days left with nothing to count, and weeks and
+# months left without days, are deleted, as a rebuild would not have them.
+#
+#   python rollups.py --rebuild [--user USER_ID]   recompute from scratch
+import argparse
+import heapq
+import logging
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from dotenv import load_dotenv
+import os
+from pymongo import ReplaceOne, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from db import db
+from metrics import registry
+from nutrition import daily_totals, round_total
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+PERIODS = ("day", "week", "month")
+
+# Documents per cursor batch and per bulk write of a rebuild
+REBUILD_BATCH_SIZE = int(os.getenv("ROLLUP_REBUILD_BATCH_SIZE", 1000))
+
+
+def period_keys(date_str):
+    # {"day": "2024-01-02", "week": "2024-W01", "month": "2024-01"}
+    date = datetime.strptime(date_str, "%Y-%m-%d")
+    year, week, _ = date.isocalendar()
+    return {
+        "day": date_str,
+        "week": f"{year}-W{week:02d}",
+        "month": date_str[:7],
+    }
+
+
+def _count(value):
+    return len(value) if isinstance(value, (list, dict)) else 0
+
+
+def day_contribution(diet_plan=None, workout_plan=None, task_counts=None):
+    # Flat {field: number} totals of one day, ready for $inc
+    values = {}
+    if diet_plan:
+        for name, amount in (diet_plan.get("dailyTotal") or {}).items():
+            if isinstance(amount, (int, float)) and not isinstance(amount, bool):
+                values[f"nutrition.{name}"] = amount
+        values["meals.planned"] = _count(diet_plan.get("meals"))
+        values["meals.completed"] = _count(diet_plan.get("completedMeals"))
+
+    if workout_plan:
+        exercises = [
+            exercise
+            for workout in workout_plan.get("workouts") or []
+            if isinstance(workout, dict)
+            for exercise in workout.get("exercises") or []
+            if isinstance(exercise, dict)
+        ]
+        values["exercises.planned"] = len(exercises)
+        values["exercises.completed"] = sum(
+            1 for exercise in exercises if exercise.get("completed")
+        )
+
+    if task_counts and task_counts.get("total"):
+        values["tasks.planned"] = task_counts["total"]
+        values["tasks.completed"] = task_counts.get("completed", 0)
+
+    if values:
+        values["days"] = 1
+    return values
+
+
+def _add(field, amount, change):
+    total = amount + change
+    return round_total(total) if field.startswith("nutrition.") else total
+
+
+def _difference(new, old):
+    delta = {}
+    for field in set(new).union(old):
+        change = _add(field, new.get(field, 0), -old.get(field, 0))
+        if change:
+            delta[field] = change
+    return delta
+
+
+def _flatten(doc):
+    # Inverse of the dotted fields used for $inc
+    values = {}
+    for field, value in (doc or {}).items():
+        if isinstance(value, dict):
+            for name, amount in value.items():
+                values[f"{field}.{name}"] = amount
+        elif field == "days":
+            values[field] = value
+    return values
+
+
+def task_count_stage():
+    return {
+        "$group": {
+            "_id": {"user_id": "$user_id", "date": "$date"},
+            "total": {"$sum": 1},
+            "completed": {"$sum": {"$cond": [{"$eq": ["$completed", True]}, 1, 0]}},
+        }
+    }
+
+
+def rollup_document(user_id, period, key, values):
+    doc = {"user_id": user_id, "period": period, "key": key}
+    for field, amount in values.items():
+        group, _, name = field.partition(".")
+        if name:
+            doc.setdefault(group, {})[name] = amount
+        else:
+            doc[field] = amount
+    doc["updatedAt"] = datetime.utcnow()
+    return doc
+
+
+def refresh_day(db, user_id, date_str):
+    refresh_days(db, user_id, [date_str])
+
+
+def refresh_days(db, user_id, dates):
+    # Refreshes some days of a user, reading each collection once and
+    # $inc'ing each week and month they fall in once
+    dates = sorted(set(dates))
+    keys = {date_str: period_keys(date_str) for date_str in dates}
+    match = {"user_id": user_id, "date": {"$in": dates}}
+    # Totals computed from the meals, as in a rebuild
+    diet_plans = {
+        plan["date"]: plan
+        for plan in _with_daily_totals(
+            list(
+                db.diet_plans.find(
+                    match,
+                    projection={
+                        "date": 1,
+                        "dailyTotal": 1,
+                        "meals": 1,
+                        "completedMeals": 1,
+                    },
+                )
+            )
+        )
+    }
+    workout_plans = {
+        plan["date"]: plan
+        for plan in db.workout_plans.find(
+            match, projection={"date": 1, "workouts.exercises.completed": 1}
+        )
+    }
+    task_counts = {
+        counts["_id"]["date"]: counts
+        for counts in db.tasks.aggregate([{"$match": match}, task_count_stage()])
+    }
+
+    deltas = {}
+    for date_str in dates:
+        values = day_contribution(
+            diet_plans.get(date_str),
+            workout_plans.get(date_str),
+            task_counts.get(date_str),
+        )
+        day = keys[date_str]["day"]
+        query = {"user_id": user_id, "period": "day", "key": day}
+        if values:
+            previous = _upsert(
+                db.rollups.find_one_and_replace,
+                query,
+                rollup_document(user_id, "day", day, values),
+                return_document=ReturnDocument.BEFORE,
+            )
+        else:
+            previous = db.rollups.find_one_and_delete(query)
+        for field, change in _difference(values, _flatten(previous)).items():
+            for period in ("week", "month"):
+                delta = deltas.setdefault((period, keys[date_str][period]), {})
+                delta[field] = _add(field, delta.get(field, 0), change)
+
+    for (period, key), delta in deltas.items():
+        delta = {field: change for field, change in delta.items() if change}
+        if not delta:
+            continue
+        query = {"user_id": user_id, "period": period, "key": key}
+        _upsert(
+            db.rollups.update_one,
+            query,
+            {"$inc": delta, "$set": {"updatedAt": datetime.utcnow()}},
+        )
+        if delta.get("days", 0) < 0:
+            # Whatever is left of a period without days is rounding, and
+            # the next day to count in it starts it again from zero
+            db.rollups.delete_one({**query, "days": {"$lte": 0}})
+
+
+def _upsert(write, query, update, **kwargs):
+    # Two processes creating the same rollup race on the unique index, the
+    # loser retries as an update of the winner's document
+    try:
+        return write(query, update, upsert=True, **kwargs)
+    except DuplicateKeyError:
+        return write(query, update, upsert=True, **kwargs)
+
+
+# Refreshes run on one background thread, off the request path. A day
+# already waiting is not queued twice, so bursts of writes cost one refresh.
+rollup_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="rollups")
+pending_days = set()
+pending_days_lock = threading.Lock()
+
+
+def schedule_rollup(user_id, *dates):
+    for date_str in {date for date in dates if date}:
+        key = (user_id, date_str)
+        with pending_days_lock:
+            if key in pending_days:
+                continue
+            pending_days.add(key)
+
+        def run(key=key):
+            with pending_days_lock:
+                pending_days.discard(key)
+            try:
+                period_keys(key[1])
+            except (TypeError, ValueError):
+                # Not a YYYY-MM-DD date, nothing to roll up
+                registry.observe_rollup("skipped")
+                return
+            try:
+                refresh_day(db, *key)
+            except Exception:
+                # Nobody waits on the future, the failure is only seen here
+                logger.exception("Rollup refresh of %s %s failed", *key)
+                registry.observe_rollup("failed")
+            else:
+                registry.observe_rollup("refreshed")
+
+        rollup_executor.submit(run)
+
+
+def _day_documents(cursor, kind):
+    for doc in cursor:
+        yield doc["user_id"], doc["date"], kind, doc
+
+
+def _recomputed_totals(cursor):
+    # Plans written before dailyTotal was computed on the server carry the
+    # client's totals, recompute them from the meals a batch at a time
+    batch = []
+    for doc in cursor:
+        batch.append(doc)
+        if len(batch) == REBUILD_BATCH_SIZE:
+            yield from _with_daily_totals(batch)
+            batch = []
+    yield from _with_daily_totals(batch)
+
+
+def _with_daily_totals(plans):
+    meals = [plan.get("meals") or {} for plan in plans]
+    try:
+        totals = daily_totals(meals)
+    except ValueError:
+        # A malformed plan fails its batch, those keep their stored totals
+        totals = []
+        for plan_meals in meals:
+            try:
+                totals.extend(daily_totals([plan_meals]))
+            except ValueError:
+                totals.append(None)
+
+    for plan, total in zip(plans, totals):
+        if total is not None:
+            plan["dailyTotal"] = {**(plan.get("dailyTotal") or {}), **total}
+        yield plan
+
+
+def _task_documents(cursor):
+    for doc in cursor:
+        yield doc["_id"]["user_id"], doc["_id"]["date"], "tasks", doc
+
+
+def _rollup_documents(db, match):
+    # (user_id, date, contribution) for every day, from three cursors merged
+    # on (user_id, date) so only one day is held at a time. Documents without
+    # a user or date cannot be ordered and are skipped.
+    match = {"user_id": {"$type": "string"}, **match, "date": {"$type": "string"}}
+    order = [("user_id", 1), ("date", 1)]
+    diet_plans = db.diet_plans.find(
+        match,
+        projection={
+            "user_id": 1,
+            "date": 1,
+            "dailyTotal": 1,
+            "meals": 1,
+            "completedMeals": 1,
+        },
+    )
+    workout_plans = db.workout_plans.find(
+        match, projection={"user_id": 1, "date": 1, "workouts.exercises.completed": 1}
+    )
+    tasks = db.tasks.aggregate(
+        [
+            {"$match": match},
+            task_count_stage(),
+            {"$sort": {"_id.user_id": 1, "_id.date": 1}},
+        ],
+        allowDiskUse=True,
+        batchSize=REBUILD_BATCH_SIZE,
+    )
+    streams = heapq.merge(
+        _day_documents(
+            _recomputed_totals(diet_plans.sort(order).batch_size(REBUILD_BATCH_SIZE)),
+            "diet_plan",
+        ),
+        _day_documents(
+            workout_plans.sort(order).batch_size(REBUILD_BATCH_SIZE), "workout_plan"
+        ),
+        _task_documents(tasks),
+        key=lambda entry: (entry[0], entry[1]),
+    )
+
+    day, docs = None, {}
+    for user_id, date_str, kind, doc in streams:
+        if (user_id, date_str) != day:
+            if day is not None:
+                yield (*day, day_contribution(**docs))
+            day, docs = (user_id, date_str), {}
+        docs["task_counts" if kind == "tasks" else kind] = doc
+    if day is not None:
+        yield (*day, day_contribution(**docs))
+
+
+def rebuild(db, user_id=None):
+    # Recomputes every rollup (or one user's) from the plans and tasks.
+    # Week and month totals are flushed whenever the user changes.
+    match = {} if user_id is None else {"user_id": user_id}
+    db.rollups.delete_many(match)
+
+    writes, totals, current_user, days = [], {}, None, 0
+
+    def flush_writes(force=False):
+        if writes and (force or len(writes) >= REBUILD_BATCH_SIZE):
+            db.rollups.bulk_write(writes, ordered=False)
+            writes.clear()
+
+    def flush_totals():
+        for (user, period, key), values in totals.items():
+            writes.append(rollup_replacement(user, period, key, values))
+            flush_writes()
+        totals.clear()
+
+    for user, date_str, values in _rollup_documents(db, match):
+        if not values:
+            continue
+        try:
+            keys = period_keys(date_str)
+        except (TypeError, ValueError):
+            continue
+        if user != current_user:
+            flush_totals()
+            current_user = user
+
+        days += 1
+        writes.append(rollup_replacement(user, "day", keys["day"], values))
+        flush_writes()
+        for period in ("week", "month"):
+            period_values = totals.setdefault((user, period, keys[period]), {})
+            for field, amount in values.items():
+                period_values[field] = _add(field, period_values.get(field, 0), amount)
+
+    flush_totals()
+    flush_writes(force=True)
+    return days
+
+
+def rollup_replacement(user_id, period, key, values):
+    return ReplaceOne(
+        {"user_id": user_id, "period": period, "key": key},
+        rollup_document(user_id, period, key, values),
+        upsert=True,
+    )
+
+
+def summarize(rollup):
+    # API shape of a rollup, with completion rates derived from the counts
+    summary = {
+        "period": rollup["period"],
+        "key": rollup["key"],
+        "days": rollup.get("days", 0),
+        "nutrition": {},
+    }
+    # Sums of rounded differences, rounded again. Nutrients that sum to
+    # zero are left out.
+    for name, amount in (rollup.get("nutrition") or {}).items():
+        amount = round_total(max(amount, 0))
+        if amount:
+            summary["nutrition"][name] = amount
+    for group in ("meals", "exercises", "tasks"):
+        counts = rollup.get(group, {})
+        planned = counts.get("planned", 0)
+        completed = counts.get("completed", 0)
+        summary[group] = {
+            "planned": planned,
+            "completed": completed,
+            "adherence": completed / planned if planned else None,
+        }
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Maintain the rollups collection")
+    parser.add_argument(
+        "--rebuild", action="store_true", help="recompute rollups from scratch"
+    )
+    parser.add_argument("--user", help="only rebuild this user's rollups")
+    args = parser.parse_args(argv)
+    if not args.rebuild:
+        parser.print_help()
+        return 1
+
+    days = rebuild(db, args.user)
+    print(f"Rebuilt rollups from {days} days")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
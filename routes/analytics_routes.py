@@ -0,0 +1,51 @@
+# analytics_routes.py
+from flask import Blueprint, g, jsonify, request
+from auth import authenticate
+from db import read_db
+from rollups import PERIODS, period_keys, summarize
+from validation import parse_date, parse_limit
+
+analytics_bp = Blueprint("analytics", __name__, url_prefix="/api/analytics")
+analytics_bp.before_request(authenticate)
+
+
+def parse_rollup_query(user_id, args):
+    # Rollups of one period between the periods containing `from` and `to`,
+    # e.g. ?period=week&from=2024-01-01&to=2024-03-31
+    period = args.get("period", "day")
+    if period not in PERIODS:
+        raise ValueError(f"period must be one of {', '.join(PERIODS)}")
+    if not args.get("from") or not args.get("to"):
+        raise ValueError("Both from and to parameters are required")
+
+    start = parse_date(args["from"])
+    end = parse_date(args["to"])
+    if end < start:
+        raise ValueError("to must not be before from")
+
+    query = {
+        "user_id": user_id,
+        "period": period,
+        "key": {"$gte": period_keys(start)[period], "$lte": period_keys(end)[period]},
+    }
+    return query, parse_limit(args.get("limit"))
+
+
+@analytics_bp.route("", methods=["GET"])
+def get_rollups():
+    try:
+        query, limit = parse_rollup_query(g.user_id, request.args)
+    except ValueError as e:
+        return jsonify({"data": None, "success": False, "error": str(e)}), 400
+
+    try:
+        rollups = read_db.rollups.find(query).sort("key", 1).limit(limit)
+        return jsonify(
+            {
+                "data": [summarize(rollup) for rollup in rollups],
+                "success": True,
+                "error": None,
+            }
+        )
+    except Exception as e:
+        return jsonify({"data": None, "success": False, "error": str(e)}), 500
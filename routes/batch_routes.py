@@ -0,0 +1,222 @@
+# batch_routes.py
+from bson import ObjectId
+from bson.errors import InvalidId
+from flask import Blueprint, g, jsonify, request
+from dotenv import load_dotenv
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+import os
+
+from auth import authenticate
+from cache import invalidate
+from db import db
+from events import KINDS, publish_reload
+from rollups import schedule_rollup
+from routes.diet_routes import meal_completion_write
+from routes.tasks_routes import tasks_changed
+from routes.workout_routes import (
+    exercise_completion_write,
+    load_template,
+    materialize_workout_plan,
+)
+from workout_templates import exercise_ids
+
+load_dotenv()
+
+batch_bp = Blueprint("batch", __name__, url_prefix="/api/batch")
+batch_bp.before_request(authenticate)
+
+MAX_BATCH_OPERATIONS = int(os.getenv("MAX_BATCH_OPERATIONS", 500))
+
+# Fields each operation needs, by op name
+OPERATIONS = {
+    "meal.complete": ("date", "mealTime"),
+    "meal.incomplete": ("date", "mealTime"),
+    "exercise.complete": ("date", "exerciseId"),
+    "task.completion": ("taskId", "completed"),
+}
+
+
+def build_write(user_id, operation, targets):
+    # (collection, write, affected date) for one operation. Raises
+    # LookupError when there is nothing for it to apply to.
+    op = operation["op"]
+    if op in ("meal.complete", "meal.incomplete"):
+        if operation["date"] not in targets["diet_plans"]:
+            raise LookupError("Not found")
+        query, update = meal_completion_write(
+            user_id, operation["date"], operation["mealTime"], op == "meal.complete"
+        )
+        return "diet_plans", UpdateOne(query, update), operation["date"]
+
+    if op == "exercise.complete":
+        exercise_ids = targets["workout_plans"].get(operation["date"], ())
+        if operation["exerciseId"] not in exercise_ids:
+            raise LookupError("Not found")
+        query, update, array_filters = exercise_completion_write(
+            user_id, operation["date"], operation["exerciseId"]
+        )
+        return (
+            "workout_plans",
+            UpdateOne(query, update, array_filters=array_filters),
+            operation["date"],
+        )
+
+    task_id = ObjectId(operation["taskId"])
+    if task_id not in targets["tasks"]:
+        raise LookupError("Not found")
+    return (
+        "tasks",
+        UpdateOne(
+            {"_id": task_id, "user_id": user_id},
+            {"$set": {"completed": operation["completed"]}},
+        ),
+        targets["tasks"][task_id],
+    )
+
+
+def operation_dates(operations, ops):
+    return {
+        operation.get("date")
+        for operation in operations
+        if isinstance(operation, dict)
+        and operation.get("op") in ops
+        and isinstance(operation.get("date"), str)
+    }
+
+
+def load_targets(user_id, operations):
+    # What the operations can apply to, one query per collection: the dates
+    # with a diet plan, the exercise ids of each workout plan and the dates
+    # of the tasks. An update matching nothing is no error to bulk_write.
+    # Dates without a workout plan have their template's, to be stored
+    # before the writes.
+    targets = {"diet_plans": set(), "workout_plans": {}, "virtual": set()}
+    diet_dates = operation_dates(operations, ("meal.complete", "meal.incomplete"))
+    if diet_dates:
+        plans = db.diet_plans.find(
+            {"user_id": user_id, "date": {"$in": list(diet_dates)}},
+            projection={"date": 1},
+        )
+        targets["diet_plans"] = {plan["date"] for plan in plans}
+
+    workout_dates = operation_dates(operations, ("exercise.complete",))
+    if workout_dates:
+        plans = db.workout_plans.find(
+            {"user_id": user_id, "date": {"$in": list(workout_dates)}},
+            projection={"date": 1, "workouts.exercises.id": 1},
+        )
+        targets["workout_plans"] = {
+            plan["date"]: exercise_ids(plan.get("workouts")) for plan in plans
+        }
+        for date_str in workout_dates.difference(targets["workout_plans"]):
+            template = load_template(date_str)
+            if template:
+                targets["workout_plans"][date_str] = exercise_ids(
+                    template["categories"]
+                )
+                targets["virtual"].add(date_str)
+
+    targets["tasks"] = load_task_dates(user_id, operations)
+    return targets
+
+
+def load_task_dates(user_id, operations):
+    # One query for the dates of every task in the batch, needed to invalidate
+    # their cached days
+    task_ids = set()
+    for operation in operations:
+        if isinstance(operation, dict) and operation.get("op") == "task.completion":
+            try:
+                task_ids.add(ObjectId(operation.get("taskId")))
+            except (InvalidId, TypeError):
+                pass
+    if not task_ids:
+        return {}
+    tasks = db.tasks.find(
+        {"_id": {"$in": list(task_ids)}, "user_id": user_id}, projection={"date": 1}
+    )
+    return {task["_id"]: task.get("date") for task in tasks}
+
+
+@batch_bp.route("", methods=["POST"])
+def run_batch():
+    data = request.json
+    operations = data.get("operations") if isinstance(data, dict) else None
+    if not isinstance(operations, list) or not operations:
+        return (
+            jsonify(
+                {"data": None, "success": False, "error": "Operations are required"}
+            ),
+            400,
+        )
+    if len(operations) > MAX_BATCH_OPERATIONS:
+        return (
+            jsonify(
+                {
+                    "data": None,
+                    "success": False,
+                    "error": f"At most {MAX_BATCH_OPERATIONS} operations per batch",
+                }
+            ),
+            400,
+        )
+
+    try:
+        results = [
+            {"index": i, "success": True, "error": None} for i in range(len(operations))
+        ]
+
+        targets = load_targets(g.user_id, operations)
+
+        # Writes grouped per collection, remembering each one's batch index
+        writes = {}
+        for i, operation in enumerate(operations):
+            op = operation.get("op") if isinstance(operation, dict) else None
+            if not isinstance(op, str) or op not in OPERATIONS:
+                results[i].update(success=False, error=f"Unknown operation {op!r}")
+                continue
+            missing = [field for field in OPERATIONS[op] if field not in operation]
+            if missing:
+                results[i].update(
+                    success=False, error=f"Missing fields: {', '.join(missing)}"
+                )
+                continue
+            try:
+                collection, write, date = build_write(g.user_id, operation, targets)
+            except (InvalidId, TypeError):
+                results[i].update(success=False, error="Invalid taskId")
+                continue
+            except LookupError as e:
+                results[i].update(success=False, error=str(e))
+                continue
+            writes.setdefault(collection, []).append((i, write, date))
+
+        for collection, entries in writes.items():
+            if collection == "workout_plans":
+                # A virtual plan is stored by its first write
+                for date in sorted(
+                    targets["virtual"].intersection(date for _, _, date in entries)
+                ):
+                    materialize_workout_plan(g.user_id, date)
+            try:
+                db[collection].bulk_write(
+                    [write for _, write, _ in entries], ordered=False
+                )
+            except BulkWriteError as e:
+                for error in e.details.get("writeErrors", []):
+                    i = entries[error["index"]][0]
+                    results[i].update(success=False, error=error.get("errmsg"))
+
+            dates = {date for _, _, date in entries}
+            if collection == "tasks":
+                tasks_changed(g.user_id, *dates)
+            else:
+                for date in dates:
+                    invalidate(collection, (g.user_id, date))
+                schedule_rollup(g.user_id, *dates)
+            publish_reload(g.user_id, KINDS[collection], *dates)
+
+        return jsonify({"data": results, "success": True, "error": None})
+    except Exception as e:
+        return jsonify({"data": None, "success": False, "error": str(e)}), 500
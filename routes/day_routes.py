@@ -0,0 +1,141 @@
+# day_routes.py
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+from datetime import datetime, timedelta
+from flask import Blueprint, g, jsonify, request
+from dotenv import load_dotenv
+import os
+
+from auth import authenticate
+from ratelimit import limit_reads
+from routes.diet_routes import load_diet_plan, load_diet_plans_in_range
+from routes.tasks_routes import load_tasks, load_tasks_for_date
+from routes.workout_routes import load_workout_plan, load_workout_plans_in_range
+from streaming import date_range_query
+from validation import DATE_FORMAT, has_date_range, parse_date, parse_date_range
+
+load_dotenv()
+
+day_bp = Blueprint("day", __name__, url_prefix="/api/day")
+day_bp.before_request(authenticate)
+day_bp.before_request(limit_reads)
+
+# Shared by every request so that a burst of /api/day calls cannot open an
+# unbounded number of concurrent Mongo reads
+DAY_FANOUT_WORKERS = int(os.getenv("DAY_FANOUT_WORKERS", 8))
+executor = ThreadPoolExecutor(
+    max_workers=DAY_FANOUT_WORKERS, thread_name_prefix="day-fanout"
+)
+
+
+def following_date(date_str):
+    date = datetime.strptime(date_str, DATE_FORMAT) + timedelta(days=1)
+    return date.strftime(DATE_FORMAT)
+
+
+def fan_out(*calls):
+    # Each call runs in a copy of the request's context, so that its Mongo
+    # commands are attributed to this route in the metrics
+    futures = [
+        executor.submit(copy_context().run, func, *args) for func, *args in calls
+    ]
+    return [future.result() for future in futures]
+
+
+@day_bp.route("", methods=["GET"])
+def get_day():
+    date_str = request.args.get("date")
+    if not date_str and has_date_range(request.args):
+        return get_days_in_range()
+    if not date_str:
+        return (
+            jsonify(
+                {"data": None, "success": False, "error": "Date parameter is required"}
+            ),
+            400,
+        )
+
+    try:
+        date_str = parse_date(date_str)
+    except ValueError as e:
+        return jsonify({"data": None, "success": False, "error": str(e)}), 400
+
+    try:
+        diet_plan, workout_plan, tasks = fan_out(
+            (load_diet_plan, g.user_id, date_str),
+            (load_workout_plan, g.user_id, date_str),
+            (load_tasks_for_date, g.user_id, date_str),
+        )
+
+        return jsonify(
+            {
+                "data": {
+                    "date": date_str,
+                    "diet": diet_plan,
+                    "workout": workout_plan,
+                    "tasks": tasks,
+                },
+                "success": True,
+                "error": None,
+            }
+        )
+    except Exception as e:
+        return jsonify({"data": None, "success": False, "error": str(e)}), 500
+
+
+def get_days_in_range():
+    try:
+        start, end, limit = parse_date_range(request.args)
+    except ValueError as e:
+        return jsonify({"data": None, "success": False, "error": str(e)}), 400
+
+    try:
+        # Plans are one per date and bounded by the range span, tasks are
+        # bounded by the page size (plus one to detect another page)
+        diet_plans, workout_plans, tasks = fan_out(
+            (load_diet_plans_in_range, g.user_id, start, end),
+            (load_workout_plans_in_range, g.user_id, start, end),
+            (load_tasks, date_range_query(g.user_id, start, end), limit + 1),
+        )
+
+        next_date = None
+        if len(tasks) > limit:
+            next_date = tasks[limit]["date"]
+            if tasks[0]["date"] != next_date:
+                # Never split a day across pages, resume from its start instead
+                tasks = [task for task in tasks if task["date"] < next_date]
+                diet_plans = [p for p in diet_plans if p["date"] < next_date]
+                workout_plans = [p for p in workout_plans if p["date"] < next_date]
+            else:
+                # A single day larger than a page is still returned whole
+                tasks = load_tasks_for_date(g.user_id, next_date)
+                diet_plans = [p for p in diet_plans if p["date"] <= next_date]
+                workout_plans = [p for p in workout_plans if p["date"] <= next_date]
+                next_date = following_date(next_date)
+                if next_date > end:
+                    next_date = None
+
+        days = {}
+
+        def day(date):
+            if date not in days:
+                days[date] = {"diet": None, "workout": None, "tasks": []}
+            return days[date]
+
+        for diet_plan in diet_plans:
+            day(diet_plan["date"])["diet"] = diet_plan
+        for workout_plan in workout_plans:
+            day(workout_plan["date"])["workout"] = workout_plan
+        for task in tasks:
+            day(task["date"])["tasks"].append(task)
+
+        return jsonify(
+            {
+                "data": dict(sorted(days.items())),
+                "next": next_date,
+                "success": True,
+                "error": None,
+            }
+        )
+    except Exception as e:
+        return jsonify({"data": None, "success": False, "error": str(e)}), 500
@@ -1,14 +1,52 @@
-from flask import Blueprint, jsonify, request
-from datetime import datetime
+from flask import Blueprint, g, jsonify, request
+from datetime import datetime, timedelta
 from bson import ObjectId
-from db import db
+from pymongo import ReturnDocument
+from pymongo.errors import OperationFailure
+from auth import authenticate
+from ratelimit import limit_reads
+from db import db, read_db
+from cache import cached, invalidate, is_cached
+from conditional import (
+    conditional_jsonify,
+    is_conditional,
+    is_not_modified,
+    make_etag,
+    not_modified_response,
+)
+from events import publish, publish_deleted, publish_reload
+from rollups import schedule_rollup
+from fields import parse_fields, project
+from nutrition import check_daily_total, plan_totals
+from patches import MISSING_TARGET, diet_patch
+from streaming import date_range_query, stream_keyed_by_date
+from validation import has_date_range, parse_date_range
 
 diet_bp = Blueprint("diet", __name__, url_prefix="/api/diet")
+diet_bp.before_request(authenticate)
+diet_bp.before_request(limit_reads)
+
+# Fields a client may ask for with ?fields=, the required ones are always sent
+DIET_PLAN_FIELDS = (
+    "date",
+    "meals",
+    "mealTotals",
+    "dailyTotal",
+    "completedMeals",
+    "lastUpdated",
+)
+DIET_PLAN_REQUIRED_FIELDS = ("date", "lastUpdated")
+COMPLETION_PROJECTION = {"_id": 0, "completedMeals": 1}
+# What a patch needs back to recompute the totals and the ETag
+PATCH_PROJECTION = {"meals": 1, "mealTotals": 1, "dailyTotal": 1, "lastUpdated": 1}
+PLAN_CHANGED = "Diet plan was changed since it was read"
 
 
 @diet_bp.route("", methods=["GET"])
 def get_diet_plan():
     date_str = request.args.get("date")
+    if not date_str and has_date_range(request.args):
+        return get_diet_plans_in_range()
     if not date_str:
         return (
             jsonify(
@@ -31,16 +69,119 @@ def get_diet_plan():
             400,
         )
 
-    # Find diet plan for the date
-    diet_plan = db.diet_plans.find_one({"date": date_str})
+    try:
+        projection = parse_diet_plan_fields(request.args)
+    except ValueError as e:
+        return jsonify({"data": None, "success": False, "error": str(e)}), 400
 
+    # Revalidations that miss the cache are decided from lastUpdated alone, the
+    # meals are only fetched when the client's copy is stale
+    if is_conditional() and not is_cached("diet_plans", (g.user_id, date_str)):
+        version = load_diet_plan_version(g.user_id, date_str)
+        if version is not None:
+            etag = diet_plan_etag(version, projection)
+            if is_not_modified(etag, version.get("lastUpdated")):
+                return not_modified_response(etag, version.get("lastUpdated"))
+
+    diet_plan = load_diet_plan(g.user_id, date_str, projection)
     if not diet_plan:
         return jsonify({"data": None, "success": True, "error": None})
 
-    # Convert ObjectId to string
-    diet_plan["_id"] = str(diet_plan["_id"])
+    return conditional_jsonify(
+        {"data": diet_plan, "success": True, "error": None},
+        diet_plan_etag(diet_plan, projection),
+        diet_plan.get("lastUpdated"),
+    )
 
-    return jsonify({"data": diet_plan, "success": True, "error": None})
+
+def parse_diet_plan_fields(args):
+    return parse_fields(args.get("fields"), DIET_PLAN_FIELDS, DIET_PLAN_REQUIRED_FIELDS)
+
+
+def diet_plan_etag(diet_plan, projection=None):
+    # Every fieldset is a representation of its own
+    return make_etag(
+        diet_plan["_id"], diet_plan.get("lastUpdated"), *(projection or ())
+    )
+
+
+def load_diet_plan_version(user_id, date_str):
+    # Single-flight and cached like the plans themselves
+    return cached(
+        "diet_plan_versions",
+        (user_id, date_str),
+        lambda: db.diet_plans.find_one(
+            {"user_id": user_id, "date": date_str}, projection={"lastUpdated": 1}
+        ),
+    )
+
+
+def load_diet_plan(user_id, date_str, projection=None):
+    if projection is not None and not is_cached("diet_plans", (user_id, date_str)):
+        # Only the requested fields go over the wire, partial documents are
+        # not cached
+        return db.diet_plans.find_one(
+            {"user_id": user_id, "date": date_str}, projection=projection
+        )
+
+    # Find diet plan for the date
+    diet_plan = cached(
+        "diet_plans",
+        (user_id, date_str),
+        lambda: db.diet_plans.find_one({"user_id": user_id, "date": date_str}),
+    )
+    return project(diet_plan, projection)
+
+
+def load_diet_plans_in_range(user_id, start, end):
+    cursor = read_db.diet_plans.find(date_range_query(user_id, start, end))
+    return list(cursor.sort("date", 1))
+
+
+def get_diet_plans_in_range():
+    try:
+        start, end, limit = parse_date_range(request.args)
+        projection = parse_diet_plan_fields(request.args)
+    except ValueError as e:
+        return jsonify({"data": None, "success": False, "error": str(e)}), 400
+
+    try:
+        cursor = (
+            read_db.diet_plans.find(
+                date_range_query(g.user_id, start, end), projection=projection
+            )
+            .sort("date", 1)
+            .limit(limit + 1)
+            .batch_size(limit + 1)
+        )
+        return stream_keyed_by_date(cursor, limit, None)
+    except Exception as e:
+        return jsonify({"data": None, "success": False, "error": str(e)}), 500
+
+
+def meal_completion_write(user_id, date_str, meal_time, completed):
+    # (filter, update) adding or removing a completed meal. The filter only
+    # matches when the meal actually changes so that lastUpdated stays put
+    # otherwise.
+    if completed:
+        query = {"completedMeals": {"$ne": meal_time}}
+        update = {"$addToSet": {"completedMeals": meal_time}}
+    else:
+        query = {"completedMeals": meal_time}
+        update = {"$pull": {"completedMeals": meal_time}}
+
+    query.update({"user_id": user_id, "date": date_str})
+    update["$set"] = {"lastUpdated": datetime.utcnow()}
+    return query, update
+
+
+def completed_meals_after(diet_plan, meal_time, completed):
+    # The completed meals once the write is applied to the plan it matched,
+    # the filter only matches plans the write changes
+    meals = [
+        meal for meal in diet_plan.get("completedMeals") or [] if meal != meal_time
+    ]
+    return meals + [meal_time] if completed else meals
 
 
 @diet_bp.route("/complete", methods=["POST"])
@@ -58,12 +199,16 @@ def mark_meal_complete():
             400,
         )
 
-    # Update completed meals in the database
-    result = db.diet_plans.update_one(
-        {"date": data["date"]}, {"$addToSet": {"completedMeals": data["mealTime"]}}
+    # Update completed meals in the database, the new list is pushed to the
+    # user's other devices
+    diet_plan = db.diet_plans.find_one_and_update(
+        *meal_completion_write(g.user_id, data["date"], data["mealTime"], True),
+        projection=COMPLETION_PROJECTION,
     )
+    invalidate("diet_plans", (g.user_id, data["date"]))
+    schedule_rollup(g.user_id, data["date"])
 
-    if result.modified_count == 0:
+    if diet_plan is None:
         return (
             jsonify(
                 {
@@ -75,6 +220,12 @@ def mark_meal_complete():
             400,
         )
 
+    publish(
+        g.user_id,
+        "diet",
+        data["date"],
+        completedMeals=completed_meals_after(diet_plan, data["mealTime"], True),
+    )
     return jsonify({"data": None, "success": True, "error": None})
 
 
@@ -94,11 +245,14 @@ def mark_meal_incomplete():
         )
 
     # Remove from completed meals in the database
-    result = db.diet_plans.update_one(
-        {"date": data["date"]}, {"$pull": {"completedMeals": data["mealTime"]}}
+    diet_plan = db.diet_plans.find_one_and_update(
+        *meal_completion_write(g.user_id, data["date"], data["mealTime"], False),
+        projection=COMPLETION_PROJECTION,
     )
+    invalidate("diet_plans", (g.user_id, data["date"]))
+    schedule_rollup(g.user_id, data["date"])
 
-    if result.modified_count == 0:
+    if diet_plan is None:
         return (
             jsonify(
                 {
@@ -110,9 +264,33 @@ def mark_meal_incomplete():
             400,
         )
 
+    publish(
+        g.user_id,
+        "diet",
+        data["date"],
+        completedMeals=completed_meals_after(diet_plan, data["mealTime"], False),
+    )
     return jsonify({"data": None, "success": True, "error": None})
 
 
+def diet_plan_update(data):
+    # Totals are computed from the meals whenever they carry nutrient values,
+    # a dailyTotal sent along must agree with them. Raises ValueError.
+    daily_total = data.get("dailyTotal", {})
+    update = {"$set": {"meals": data["meals"], "lastUpdated": datetime.utcnow()}}
+
+    totals = plan_totals(data["meals"])
+    if totals is None:
+        update["$set"]["dailyTotal"] = daily_total
+        update["$unset"] = {"mealTotals": ""}
+    else:
+        meal_totals, computed = totals
+        check_daily_total(daily_total, computed)
+        update["$set"]["dailyTotal"] = {**daily_total, **computed}
+        update["$set"]["mealTotals"] = meal_totals
+    return update
+
+
 @diet_bp.route("/update", methods=["PUT"])
 def update_diet_plan():
     data = request.json
@@ -128,18 +306,18 @@ def update_diet_plan():
             400,
         )
 
+    try:
+        update = diet_plan_update(data)
+    except ValueError as e:
+        return jsonify({"data": None, "success": False, "error": str(e)}), 400
+
     # Update or insert the diet plan
     result = db.diet_plans.update_one(
-        {"date": data["date"]},
-        {
-            "$set": {
-                "meals": data["meals"],
-                "dailyTotal": data.get("dailyTotal", {}),
-                "lastUpdated": datetime.utcnow(),
-            }
-        },
-        upsert=True,
+        {"user_id": g.user_id, "date": data["date"]}, update, upsert=True
     )
+    invalidate("diet_plans", (g.user_id, data["date"]))
+    schedule_rollup(g.user_id, data["date"])
+    publish_reload(g.user_id, "diet", data["date"])
 
     if result.modified_count == 0 and not result.upserted_id:
         return (
@@ -152,6 +330,124 @@ def update_diet_plan():
     return jsonify({"data": None, "success": True, "error": None})
 
 
+def patched_totals_update(diet_plan):
+    # Update bringing mealTotals and dailyTotal in line with the patched
+    # meals, or None when they already are. It is a new version of the plan,
+    # with a lastUpdated of its own even within the same millisecond.
+    try:
+        totals = plan_totals(diet_plan.get("meals") or {})
+    except ValueError:
+        # Invalid values the patch did not touch, kept as they were
+        return None
+    version = {
+        "lastUpdated": max(
+            datetime.utcnow(), diet_plan["lastUpdated"] + timedelta(milliseconds=1)
+        )
+    }
+    if totals is None:
+        if "mealTotals" not in diet_plan:
+            return None
+        return {"$unset": {"mealTotals": ""}, "$set": version}
+
+    meal_totals, computed = totals
+    daily_total = {**(diet_plan.get("dailyTotal") or {}), **computed}
+    if meal_totals == diet_plan.get("mealTotals") and daily_total == diet_plan.get(
+        "dailyTotal"
+    ):
+        return None
+    return {"$set": {"mealTotals": meal_totals, "dailyTotal": daily_total, **version}}
+
+
+@diet_bp.route("", methods=["PATCH"])
+def patch_diet_plan():
+    # Applies a list of operations (see patches.py) to the plan of ?date=.
+    # With If-Match, only to the version that ETag was given for.
+    date_str = request.args.get("date")
+    if not date_str:
+        return (
+            jsonify(
+                {"data": None, "success": False, "error": "Date parameter is required"}
+            ),
+            400,
+        )
+
+    try:
+        update, array_filters, required = diet_patch(
+            request.get_json(silent=True), datetime.utcnow()
+        )
+    except ValueError as e:
+        return jsonify({"data": None, "success": False, "error": str(e)}), 400
+
+    query = {"user_id": g.user_id, "date": date_str}
+    try:
+        if request.if_match:
+            version = db.diet_plans.find_one(query, projection={"lastUpdated": 1})
+            if version is None:
+                return (
+                    jsonify(
+                        {"data": None, "success": False, "error": "Diet plan not found"}
+                    ),
+                    404,
+                )
+            if not request.if_match.contains(diet_plan_etag(version)):
+                return (
+                    jsonify({"data": None, "success": False, "error": PLAN_CHANGED}),
+                    412,
+                )
+            query["lastUpdated"] = version.get("lastUpdated")
+
+        diet_plan = db.diet_plans.find_one_and_update(
+            {**query, **required},
+            update,
+            array_filters=array_filters or None,
+            projection=PATCH_PROJECTION,
+            return_document=ReturnDocument.AFTER,
+        )
+
+        if diet_plan is None:
+            # The plan is there but not all that the patch addresses
+            if required and db.diet_plans.find_one(query, projection={"_id": 1}):
+                return (
+                    jsonify({"data": None, "success": False, "error": MISSING_TARGET}),
+                    409,
+                )
+            if request.if_match:
+                return (
+                    jsonify({"data": None, "success": False, "error": PLAN_CHANGED}),
+                    412,
+                )
+            return (
+                jsonify(
+                    {"data": None, "success": False, "error": "Diet plan not found"}
+                ),
+                404,
+            )
+
+        # Totals follow in a second write, which a newer write supersedes
+        totals_update = patched_totals_update(diet_plan)
+        if totals_update is not None:
+            result = db.diet_plans.update_one(
+                {"_id": diet_plan["_id"], "lastUpdated": diet_plan["lastUpdated"]},
+                totals_update,
+            )
+            if result.modified_count:
+                diet_plan["lastUpdated"] = totals_update["$set"]["lastUpdated"]
+        invalidate("diet_plans", (g.user_id, date_str))
+        schedule_rollup(g.user_id, date_str)
+        publish_reload(g.user_id, "diet", date_str)
+
+        response = jsonify({"data": None, "success": True, "error": None})
+        response.set_etag(diet_plan_etag(diet_plan))
+        return response
+    except OperationFailure as e:
+        # Paths that do not fit the stored plan, or operations in conflict.
+        # A WriteError may come without details.
+        error = (e.details or {}).get("errmsg") or str(e)
+        return jsonify({"data": None, "success": False, "error": error}), 400
+    except Exception as e:
+        return jsonify({"data": None, "success": False, "error": str(e)}), 500
+
+
 @diet_bp.route("/", methods=["DELETE"])
 def delete_diet_plan():
     date_str = request.args.get("date")
@@ -163,7 +459,10 @@ def delete_diet_plan():
             400,
         )
 
-    result = db.diet_plans.delete_one({"date": date_str})
+    result = db.diet_plans.delete_one({"user_id": g.user_id, "date": date_str})
+    invalidate("diet_plans", (g.user_id, date_str))
+    schedule_rollup(g.user_id, date_str)
+    publish_deleted(g.user_id, "diet", date_str, reload=True)
 
     if result.deleted_count == 0:
         return (
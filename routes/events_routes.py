@@ -0,0 +1,48 @@
+# events_routes.py
+from flask import Blueprint, Response, current_app, g, jsonify, request
+from auth import authenticate
+from events import KINDS, SubscriberLimit, Subscription, stream_events, subscribe
+from validation import has_date_range, parse_date, parse_date_range
+
+events_bp = Blueprint("events", __name__, url_prefix="/api/events")
+events_bp.before_request(authenticate)
+
+EVENT_STREAM_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+
+def parse_subscription(user_id, args, wake=None):
+    # Changes of all dates, of ?date= (comma separated) or of ?from=&to=,
+    # optionally of some ?kinds= only
+    kinds = None
+    if args.get("kinds"):
+        kinds = set(args["kinds"].split(","))
+        unknown = kinds - set(KINDS.values())
+        if unknown:
+            raise ValueError(f"Unknown kinds: {', '.join(sorted(unknown))}")
+
+    dates = None
+    if has_date_range(args):
+        dates = parse_date_range(args)[:2]
+    elif args.get("date"):
+        dates = {parse_date(date) for date in args["date"].split(",")}
+    return Subscription(user_id, kinds, dates, wake)
+
+
+@events_bp.route("", methods=["GET"])
+def get_events():
+    try:
+        subscription = parse_subscription(g.user_id, request.args)
+    except ValueError as e:
+        return jsonify({"data": None, "success": False, "error": str(e)}), 400
+
+    try:
+        subscribe(subscription)
+    except SubscriberLimit as e:
+        return jsonify({"data": None, "success": False, "error": str(e)}), 503
+
+    # One worker thread per subscriber, asgi.py holds many more per process
+    return Response(
+        stream_events(subscription, current_app.json.dumps),
+        mimetype="text/event-stream",
+        headers=EVENT_STREAM_HEADERS,
+    )
@@ -0,0 +1,108 @@
+# export_routes.py
+from flask import Blueprint, Response, g, jsonify, request, stream_with_context
+
+from auth import authenticate
+from ratelimit import limit_reads
+from cache import invalidate
+from db import db, read_db
+from events import KINDS, publish_reload
+from exports import FORMATS, MODES, export_lines, import_lines, parse_collections
+from rollups import schedule_rollup
+from routes.tasks_routes import tasks_changed
+
+export_bp = Blueprint("export", __name__, url_prefix="/api")
+export_bp.before_request(authenticate)
+export_bp.before_request(limit_reads)
+
+
+@export_bp.route("/export", methods=["GET"])
+def export_history():
+    # The user's whole history as NDJSON, see exports.py for the formats
+    export_format = request.args.get("format", "ndjson")
+    if export_format not in FORMATS:
+        return (
+            jsonify(
+                {
+                    "data": None,
+                    "success": False,
+                    "error": f"format must be one of {', '.join(FORMATS)}",
+                }
+            ),
+            400,
+        )
+    try:
+        collections = parse_collections(request.args.get("collections"))
+    except ValueError as e:
+        return jsonify({"data": None, "success": False, "error": str(e)}), 400
+
+    chunks = export_lines(read_db, collections, g.user_id, export_format == "columnar")
+    response = Response(stream_with_context(chunks), mimetype="application/x-ndjson")
+    filename = (
+        "history.ndjson" if export_format == "ndjson" else "history.columnar.ndjson"
+    )
+    response.headers["Content-Disposition"] = f'attachment; filename="{filename}"'
+    return response
+
+
+def imported(collection, docs):
+    # Dates an import chunk wrote, dropped from the caches and rollups like
+    # after any other write
+    dates = {doc.get("date") for doc in docs if doc.get("date")}
+    if collection == "tasks":
+        tasks_changed(g.user_id, *dates)
+    else:
+        for date in dates:
+            invalidate(collection, (g.user_id, date))
+        schedule_rollup(g.user_id, *dates)
+    publish_reload(g.user_id, KINDS[collection], *dates)
+
+
+@export_bp.route("/import", methods=["POST"])
+def import_history():
+    # Imports an export (its plans and tasks) as the user's own. Progress is
+    # reported in lines: after a failure, resending the body with
+    # ?skip=<data.lines> resumes after what was written.
+    mode = request.args.get("mode", "insert")
+    if mode not in MODES:
+        return (
+            jsonify(
+                {
+                    "data": None,
+                    "success": False,
+                    "error": f"mode must be one of {', '.join(MODES)}",
+                }
+            ),
+            400,
+        )
+    try:
+        skip = int(request.args.get("skip", 0))
+        if skip < 0:
+            raise ValueError
+    except ValueError:
+        return (
+            jsonify(
+                {
+                    "data": None,
+                    "success": False,
+                    "error": "skip must be a non-negative integer",
+                }
+            ),
+            400,
+        )
+
+    progress = {"lines": skip}
+    try:
+        stats = import_lines(
+            db,
+            request.stream,
+            mode,
+            g.user_id,
+            skip,
+            on_write=imported,
+            on_checkpoint=progress.update,
+        )
+        return jsonify({"data": stats, "success": True, "error": None})
+    except ValueError as e:
+        return jsonify({"data": progress, "success": False, "error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"data": progress, "success": False, "error": str(e)}), 500
@@ -0,0 +1,42 @@
+# system_routes.py
+from flask import Blueprint, Response, jsonify
+from auth import authenticate_system
+from cache import cache_stats
+from compression import compression_stats
+from db import pool_metrics
+from events import event_stats
+from metrics import registry
+from passwords import hash_metrics
+
+system_bp = Blueprint("system", __name__, url_prefix="/api/system")
+system_bp.before_request(authenticate_system)
+
+
+@system_bp.route("/cache", methods=["GET"])
+def get_cache_stats():
+    return jsonify({"data": cache_stats(), "success": True, "error": None})
+
+
+@system_bp.route("/pool", methods=["GET"])
+def get_pool_stats():
+    return jsonify({"data": pool_metrics.stats(), "success": True, "error": None})
+
+
+@system_bp.route("/passwords", methods=["GET"])
+def get_password_stats():
+    return jsonify({"data": hash_metrics.stats(), "success": True, "error": None})
+
+
+@system_bp.route("/events", methods=["GET"])
+def get_event_stats():
+    return jsonify({"data": event_stats(), "success": True, "error": None})
+
+
+@system_bp.route("/compression", methods=["GET"])
+def get_compression_stats():
+    return jsonify({"data": compression_stats(), "success": True, "error": None})
+
+
+@system_bp.route("/metrics", methods=["GET"])
+def get_metrics():
+    return Response(registry.render(), mimetype="text/plain; version=0.0.4")
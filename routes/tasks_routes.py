@@ -1,30 +1,328 @@
 # tasks.py (Flask Blueprint)
-from flask import Blueprint, jsonify, request
+from flask import Blueprint, g, jsonify, request
 from datetime import datetime
 from bson import ObjectId
-from db import db
+from bson.errors import InvalidId
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+import os
+import threading
+from pymongo import ReturnDocument, UpdateOne
+from auth import authenticate
+from ratelimit import limit_reads
+from db import db, read_db
+from cache import cached, invalidate, is_cached
+from conditional import (
+    conditional_jsonify,
+    is_not_modified,
+    make_etag,
+    not_modified_response,
+)
+from fields import parse_fields, project
+from streaming import date_range_query, stream_documents, stream_keyed_by_date
+from events import publish, publish_deleted, publish_reload
+from rollups import schedule_rollup
+from ranking import rank_between, rebalanced_ranks
+from validation import (
+    decode_cursor,
+    encode_cursor,
+    has_date_range,
+    parse_date_range,
+    parse_limit,
+)
+
+load_dotenv()
 
 tasks_bp = Blueprint("tasks", __name__, url_prefix="/api/tasks")
+tasks_bp.before_request(authenticate)
+tasks_bp.before_request(limit_reads)
+
+# Within a day tasks are ordered by their rank key, see ranking.py
+TASK_ORDER = [("date", 1), ("rank", 1), ("_id", 1)]
+
+# Keys longer than this get the whole day re-ranked in the background
+MAX_RANK_LENGTH = int(os.getenv("MAX_RANK_LENGTH", 16))
+
+# Fields a client may not overwrite through update_task
+PROTECTED_FIELDS = ("_id", "id", "user_id")
+
+# Fields a client may ask for with ?fields=, the required ones are always sent
+TASK_FIELDS = ("date", "title", "description", "completed", "rank")
+TASK_REQUIRED_FIELDS = ("date", "rank")
+
+# Formats for ?stream=, which sends every task instead of one page
+STREAM_FORMATS = ("ndjson", "array")
 
 
 @tasks_bp.route("", methods=["GET"])
 def get_tasks():
     date_str = request.args.get("date")
+    if not date_str and has_date_range(request.args):
+        return get_tasks_in_range()
+
+    try:
+        projection = parse_task_fields(request.args)
+    except ValueError as e:
+        return jsonify({"data": None, "success": False, "error": str(e)}), 400
+
+    if not date_str:
+        if "stream" in request.args:
+            return stream_all_tasks(projection)
+        return get_tasks_page(projection)
+
+    try:
+        # The per-date version is read first, a write landing in between
+        # only makes the ETag older than the tasks, never newer
+        version = load_task_version(g.user_id, date_str)
+        etag = make_etag(
+            "tasks", g.user_id, date_str, version["version"], *(projection or ())
+        )
+        if is_not_modified(etag, version.get("updatedAt")):
+            return not_modified_response(etag, version.get("updatedAt"))
+
+        # Find tasks for specific date
+        tasks = load_tasks_for_date(g.user_id, date_str, projection)
+        return conditional_jsonify(
+            {"data": tasks, "success": True, "error": None},
+            etag,
+            version.get("updatedAt"),
+        )
+    except Exception as e:
+        return jsonify({"data": None, "success": False, "error": str(e)}), 500
+
+
+def parse_task_cursor(token):
+    # (date, rank, _id) of the last task of the previous page
+    if token is None:
+        return None
+    date, rank, task_id = decode_cursor(token, 3)
+    try:
+        return date, rank, ObjectId(task_id)
+    except (InvalidId, TypeError):
+        raise ValueError("Invalid cursor")
+
+
+def task_cursor(task):
+    return encode_cursor(task["date"], task.get("rank"), str(task["_id"]))
+
+
+def task_page_query(user_id, after):
+    # Keyset condition for the tasks sorting after `after` in TASK_ORDER, so
+    # a page costs the same however deep into the list it is
+    if after is None:
+        return {"user_id": user_id}
+
+    date, rank, task_id = after
+    if rank is None:
+        # Unranked tasks sort before every ranked one of their day
+        same_day = [
+            {"date": date, "rank": {"$type": "string"}},
+            {"date": date, "rank": None, "_id": {"$gt": task_id}},
+        ]
+    else:
+        same_day = [
+            {"date": date, "rank": {"$gt": rank}},
+            {"date": date, "rank": rank, "_id": {"$gt": task_id}},
+        ]
+    # The $gte bound keeps the index scan starting at the cursor's day
+    return {
+        "user_id": user_id,
+        "date": {"$gte": date},
+        "$or": [{"date": {"$gt": date}}, *same_day],
+    }
+
+
+def get_tasks_page(projection):
+    try:
+        limit = parse_limit(request.args.get("limit"))
+        after = parse_task_cursor(request.args.get("cursor"))
+    except ValueError as e:
+        return jsonify({"data": None, "success": False, "error": str(e)}), 400
+
+    try:
+        # One extra task tells whether another page exists
+        tasks = load_tasks(task_page_query(g.user_id, after), limit + 1, projection)
+        next_cursor = None
+        if len(tasks) > limit:
+            tasks = tasks[:limit]
+            next_cursor = task_cursor(tasks[-1])
+
+        return jsonify(
+            {"data": tasks, "next": next_cursor, "success": True, "error": None}
+        )
+    except Exception as e:
+        return jsonify({"data": None, "success": False, "error": str(e)}), 500
+
+
+def stream_all_tasks(projection):
+    stream_format = request.args.get("stream") or "ndjson"
+    if stream_format not in STREAM_FORMATS:
+        return (
+            jsonify(
+                {
+                    "data": None,
+                    "success": False,
+                    "error": "stream must be ndjson or array",
+                }
+            ),
+            400,
+        )
+
+    try:
+        cursor = read_db.tasks.find({"user_id": g.user_id}, projection=projection)
+        return stream_documents(
+            cursor.sort(TASK_ORDER), prepare_task, stream_format == "ndjson"
+        )
+    except Exception as e:
+        return jsonify({"data": None, "success": False, "error": str(e)}), 500
+
+
+def prepare_task(task):
+    task["id"] = task["_id"]  # Add id field for frontend compatibility
+    return task
+
+
+def parse_task_fields(args):
+    return parse_fields(args.get("fields"), TASK_FIELDS, TASK_REQUIRED_FIELDS)
+
+
+def task_pipeline(query, limit=0, projection=None):
+    # Task lists get their id field from the server rather than a loop here
+    pipeline = [{"$match": query}, {"$sort": dict(TASK_ORDER)}]
+    if limit:
+        pipeline.append({"$limit": limit})
+    if projection is not None:
+        pipeline.append({"$project": projection})
+    pipeline.append({"$addFields": {"id": "$_id"}})
+    return pipeline
+
+
+def load_tasks(query, limit=0, projection=None):
+    return list(read_db.tasks.aggregate(task_pipeline(query, limit, projection)))
+
+
+def load_tasks_for_date(user_id, date_str, projection=None):
+    query = {"user_id": user_id, "date": date_str}
+    if projection is not None and not is_cached("tasks", (user_id, date_str)):
+        # Only the requested fields go over the wire, partial lists are not
+        # cached
+        return list(db.tasks.aggregate(task_pipeline(query, projection=projection)))
+
+    tasks = cached(
+        "tasks",
+        (user_id, date_str),
+        lambda: list(db.tasks.aggregate(task_pipeline(query))),
+    )
+    if projection is not None:
+        tasks = [prepare_task(project(task, projection)) for task in tasks]
+    return tasks
+
+
+def load_task_version(user_id, date_str):
+    version = cached(
+        "task_versions",
+        (user_id, date_str),
+        lambda: db.task_versions.find_one(
+            {"user_id": user_id, "date": date_str},
+            projection={"_id": 0, "version": 1, "updatedAt": 1},
+        ),
+    )
+    return version or {"version": 0}
+
+
+def tasks_changed(user_id, *dates):
+    # Bumps the per-date version behind the tasks ETag and drops cached reads
+    now = datetime.utcnow()
+    for date in {date for date in dates if date}:
+        db.task_versions.update_one(
+            {"user_id": user_id, "date": date},
+            {"$inc": {"version": 1}, "$set": {"updatedAt": now}},
+            upsert=True,
+        )
+        invalidate("tasks", (user_id, date))
+        invalidate("task_versions", (user_id, date))
+    schedule_rollup(user_id, *dates)
+
+
+def neighbour_ranks(query, index):
+    # Ranks of the tasks that will sit before and after position `index`
+    cursor = db.tasks.find(query, projection={"rank": 1}).sort(TASK_ORDER)
+    if index == 0:
+        after = next(cursor.limit(1), None)
+        return None, after and after.get("rank", "")
+
+    window = list(cursor.skip(index - 1).limit(2))
+    if not window:
+        # Past the end of the list
+        last = db.tasks.find_one(
+            query, projection={"rank": 1}, sort=[("rank", -1), ("_id", -1)]
+        )
+        return (last and last.get("rank", "")), None
+
+    # Unranked tasks map to "", which rank_between rejects as an upper bound
+    before = window[0].get("rank", "")
+    after = window[1].get("rank", "") if len(window) > 1 else None
+    if not before:
+        raise ValueError("Unranked task")
+    return before, after
+
+
+def rebalance_tasks(user_id, date_str):
+    # Rewrites every rank of one day with short, evenly spaced keys,
+    # keeping the current order
+    tasks = list(
+        db.tasks.find(
+            {"user_id": user_id, "date": date_str}, projection={"_id": 1}
+        ).sort(TASK_ORDER)
+    )
+    if tasks:
+        db.tasks.bulk_write(
+            [
+                UpdateOne({"_id": task["_id"]}, {"$set": {"rank": rank}})
+                for task, rank in zip(tasks, rebalanced_ranks(len(tasks)))
+            ],
+            ordered=False,
+        )
+    tasks_changed(user_id, date_str)
+    publish_reload(user_id, "tasks", date_str)
+
+
+rebalancer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="task-rebalance")
+pending_rebalances = set()
+pending_rebalances_lock = threading.Lock()
+
+
+def schedule_rebalance(user_id, date_str):
+    key = (user_id, date_str)
+    with pending_rebalances_lock:
+        if key in pending_rebalances:
+            return
+        pending_rebalances.add(key)
+
+    def run():
+        with pending_rebalances_lock:
+            pending_rebalances.discard(key)
+        rebalance_tasks(user_id, date_str)
+
+    rebalancer.submit(run)
+
+
+def get_tasks_in_range():
+    try:
+        start, end, limit = parse_date_range(request.args)
+        projection = parse_task_fields(request.args)
+    except ValueError as e:
+        return jsonify({"data": None, "success": False, "error": str(e)}), 400
 
     try:
-        if date_str:
-            # Find tasks for specific date
-            tasks = list(db.tasks.find({"date": date_str}))
-        else:
-            # Find all tasks
-            tasks = list(db.tasks.find({}))
-
-        # Convert ObjectId to string
-        for task in tasks:
-            task["_id"] = str(task["_id"])
-            task["id"] = str(task["_id"])  # Add id field for frontend compatibility
-
-        return jsonify({"data": tasks, "success": True, "error": None})
+        cursor = (
+            read_db.tasks.find(
+                date_range_query(g.user_id, start, end), projection=projection
+            )
+            .sort(TASK_ORDER)
+            .batch_size(limit + 1)
+        )
+        return stream_keyed_by_date(cursor, limit, prepare_task, grouped=True)
     except Exception as e:
         return jsonify({"data": None, "success": False, "error": str(e)}), 500
 
@@ -45,11 +343,23 @@ def create_task():
                 400,
             )
 
-        # Insert new task
-        result = db.tasks.insert_one(data)
-        new_task = db.tasks.find_one({"_id": result.inserted_id})
-        new_task["_id"] = str(new_task["_id"])
-        new_task["id"] = str(new_task["_id"])
+        # New tasks go to the end of their day
+        last = db.tasks.find_one(
+            {"user_id": g.user_id, "date": data["date"]},
+            projection={"rank": 1},
+            sort=[("rank", -1), ("_id", -1)],
+        )
+        data["rank"] = rank_between(last.get("rank") if last else None, None)
+
+        # Insert new task, insert_one adds the generated _id to data so the
+        # stored document does not need to be read back
+        data["user_id"] = g.user_id
+        db.tasks.insert_one(data)
+        if len(data["rank"]) > MAX_RANK_LENGTH:
+            schedule_rebalance(g.user_id, data["date"])
+        tasks_changed(g.user_id, data["date"])
+        new_task = prepare_task(data)
+        publish(g.user_id, "tasks", data["date"], task=new_task)
 
         return jsonify({"data": new_task, "success": True, "error": None})
     except Exception as e:
@@ -59,32 +369,47 @@ def create_task():
 @tasks_bp.route("/<task_id>", methods=["PUT"])
 def update_task(task_id):
     try:
-        data = request.json
-        if not data:
+        data = request.json or {}
+        changes = {
+            key: value for key, value in data.items() if key not in PROTECTED_FIELDS
+        }
+        if not changes:
             return (
                 jsonify({"data": None, "success": False, "error": "No data provided"}),
                 400,
             )
 
-        # Update task
-        result = db.tasks.update_one({"_id": ObjectId(task_id)}, {"$set": data})
+        # Update task in one round trip. When the task moves to another date
+        # the previous document is returned instead, so that both dates can be
+        # invalidated, and the update is applied to it locally.
+        moves = "date" in changes
+        updated_task = db.tasks.find_one_and_update(
+            {"_id": ObjectId(task_id), "user_id": g.user_id},
+            {"$set": changes},
+            return_document=ReturnDocument.BEFORE if moves else ReturnDocument.AFTER,
+        )
 
-        if result.modified_count == 0:
+        if updated_task is None:
             return (
                 jsonify(
                     {
                         "data": None,
                         "success": False,
-                        "error": "Task not found or no changes made",
+                        "error": "Task not found",
                     }
                 ),
                 404,
             )
 
+        previous_date = updated_task.get("date")
+        if moves:
+            updated_task.update(changes)
+
         # Return updated task
-        updated_task = db.tasks.find_one({"_id": ObjectId(task_id)})
-        updated_task["_id"] = str(updated_task["_id"])
-        updated_task["id"] = str(updated_task["_id"])
+        tasks_changed(g.user_id, previous_date, updated_task.get("date"))
+        updated_task = prepare_task(updated_task)
+        # A moved task is sent once, with its new date
+        publish(g.user_id, "tasks", updated_task.get("date"), task=updated_task)
 
         return jsonify({"data": updated_task, "success": True, "error": None})
     except Exception as e:
@@ -94,14 +419,18 @@ def update_task(task_id):
 @tasks_bp.route("/<task_id>", methods=["DELETE"])
 def delete_task(task_id):
     try:
-        result = db.tasks.delete_one({"_id": ObjectId(task_id)})
+        deleted = db.tasks.find_one_and_delete(
+            {"_id": ObjectId(task_id), "user_id": g.user_id}, projection={"date": 1}
+        )
 
-        if result.deleted_count == 0:
+        if deleted is None:
             return (
                 jsonify({"data": None, "success": False, "error": "Task not found"}),
                 404,
             )
 
+        tasks_changed(g.user_id, deleted.get("date"))
+        publish_deleted(g.user_id, "tasks", deleted.get("date"), deletedTask=task_id)
         return jsonify({"data": None, "success": True, "error": None})
     except Exception as e:
         return jsonify({"data": None, "success": False, "error": str(e)}), 500
@@ -124,20 +453,22 @@ def toggle_task_completion(task_id):
             )
 
         # Update completion status
-        result = db.tasks.update_one(
-            {"_id": ObjectId(task_id)}, {"$set": {"completed": data["completed"]}}
+        updated_task = db.tasks.find_one_and_update(
+            {"_id": ObjectId(task_id), "user_id": g.user_id},
+            {"$set": {"completed": data["completed"]}},
+            return_document=ReturnDocument.AFTER,
         )
 
-        if result.modified_count == 0:
+        if updated_task is None:
             return (
                 jsonify({"data": None, "success": False, "error": "Task not found"}),
                 404,
             )
 
         # Return updated task
-        updated_task = db.tasks.find_one({"_id": ObjectId(task_id)})
-        updated_task["_id"] = str(updated_task["_id"])
-        updated_task["id"] = str(updated_task["_id"])
+        tasks_changed(g.user_id, updated_task.get("date"))
+        updated_task = prepare_task(updated_task)
+        publish(g.user_id, "tasks", updated_task.get("date"), task=updated_task)
 
         return jsonify({"data": updated_task, "success": True, "error": None})
     except Exception as e:
@@ -160,10 +491,58 @@ def reorder_tasks():
                 400,
             )
 
-        # In a real implementation, you would update the order field in the database
-        # This is a simplified version that just acknowledges the reorder request
-        # You might want to implement a proper ordering system with position fields
+        try:
+            task_id = ObjectId(data["taskId"])
+            new_index = int(data["newIndex"])
+            if new_index < 0:
+                raise ValueError
+        except (InvalidId, TypeError, ValueError):
+            return (
+                jsonify(
+                    {
+                        "data": None,
+                        "success": False,
+                        "error": "Invalid task ID or new index",
+                    }
+                ),
+                400,
+            )
 
-        return jsonify({"data": None, "success": True, "error": None})
+        task = db.tasks.find_one(
+            {"_id": task_id, "user_id": g.user_id}, projection={"date": 1}
+        )
+        if task is None:
+            return (
+                jsonify({"data": None, "success": False, "error": "Task not found"}),
+                404,
+            )
+
+        # Only the moved task is written, with a key between its new neighbours
+        siblings = {"user_id": g.user_id, "date": task["date"], "_id": {"$ne": task_id}}
+        try:
+            rank = rank_between(*neighbour_ranks(siblings, new_index))
+        except ValueError:
+            # Unranked (older) tasks or a tie left by concurrent moves
+            rebalance_tasks(g.user_id, task["date"])
+            rank = rank_between(*neighbour_ranks(siblings, new_index))
+
+        moved = db.tasks.find_one_and_update(
+            {"_id": task_id},
+            {"$set": {"rank": rank}},
+            return_document=ReturnDocument.AFTER,
+        )
+        tasks_changed(g.user_id, task["date"])
+        if moved is not None:
+            publish(g.user_id, "tasks", task["date"], task=prepare_task(moved))
+        if len(rank) > MAX_RANK_LENGTH:
+            schedule_rebalance(g.user_id, task["date"])
+
+        return jsonify(
+            {
+                "data": {"id": str(task_id), "rank": rank},
+                "success": True,
+                "error": None,
+            }
+        )
     except Exception as e:
         return jsonify({"data": None, "success": False, "error": str(e)}), 500
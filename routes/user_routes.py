@@ -1,10 +1,12 @@
 # user_routes.py
 from flask import Blueprint, request, jsonify
-from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime, timedelta
 import jwt
 from bson import ObjectId
+from pymongo.errors import DuplicateKeyError
 from db import db
+from passwords import PoolBusy, hash_password, verify_password
+from ratelimit import TOO_MANY_REQUESTS, retry_headers, take
 from dotenv import load_dotenv
 import os
 
@@ -17,32 +19,71 @@ user_bp = Blueprint("user", __name__, url_prefix="/api/user")
 JWT_SECRET = os.getenv("JWT_SECRET")
 JWT_EXPIRATION = os.getenv("JWT_EXPIRATION_DAYS", 7)
 
+REQUIRED_FIELDS = [
+    "email",
+    "firstName",
+    "lastName",
+    "age",
+    "birthDate",
+    "weight",
+    "height",
+    "username",
+    "password",
+]
+
+
+def new_user(data, hashed_password):
+    # Create user document
+    return {
+        "email": data["email"],
+        "firstName": data["firstName"],
+        "lastName": data["lastName"],
+        "age": int(data["age"]),
+        "birthDate": data["birthDate"],
+        "weight": float(data["weight"]),
+        "height": float(data["height"]),
+        "username": data["username"],
+        "password": hashed_password,
+        "createdAt": datetime.utcnow(),
+        "updatedAt": datetime.utcnow(),
+    }
+
+
+def issue_token(user_id):
+    # Generate JWT token
+    return jwt.encode(
+        {
+            "user_id": str(user_id),
+            "exp": datetime.utcnow() + timedelta(days=int(JWT_EXPIRATION)),
+        },
+        JWT_SECRET,
+        algorithm="HS256",
+    )
+
+
+def user_summary(user_id, user):
+    return {
+        "id": str(user_id),
+        "email": user["email"],
+        "firstName": user["firstName"],
+        "lastName": user["lastName"],
+        "username": user["username"],
+    }
+
 
 @user_bp.route("/register", methods=["POST"])
 def register():
     data = request.json
 
     # Validate required fields
-    required_fields = [
-        "email",
-        "firstName",
-        "lastName",
-        "age",
-        "birthDate",
-        "weight",
-        "height",
-        "username",
-        "password",
-    ]
-
-    if not all(field in data for field in required_fields):
+    if not all(field in data for field in REQUIRED_FIELDS):
         return (
             jsonify(
                 {
                     "success": False,
                     "error": "All fields are required",
                     "missing_fields": [
-                        field for field in required_fields if field not in data
+                        field for field in REQUIRED_FIELDS if field not in data
                     ],
                 }
             ),
@@ -64,49 +105,35 @@ def register():
         )
 
     # Hash the password
-    hashed_password = generate_password_hash(data["password"])
-
-    # Create user document
-    user = {
-        "email": data["email"],
-        "firstName": data["firstName"],
-        "lastName": data["lastName"],
-        "age": int(data["age"]),
-        "birthDate": data["birthDate"],
-        "weight": float(data["weight"]),
-        "height": float(data["height"]),
-        "username": data["username"],
-        "password": hashed_password,
-        "createdAt": datetime.utcnow(),
-        "updatedAt": datetime.utcnow(),
-    }
-
-    # Insert user into database
-    result = db.users.insert_one(user)
-
-    # Generate JWT token
-    token = jwt.encode(
-        {
-            "user_id": str(result.inserted_id),
-            "exp": datetime.utcnow() + timedelta(days=int(JWT_EXPIRATION)),
-        },
-        JWT_SECRET,
-        algorithm="HS256",
-    )
+    try:
+        hashed_password = hash_password(data["password"])
+    except PoolBusy as e:
+        return jsonify({"success": False, "error": str(e)}), 503, {"Retry-After": "1"}
+
+    user = new_user(data, hashed_password)
+
+    # Insert user into database. The unique indexes decide between two
+    # registrations racing past the check above.
+    try:
+        result = db.users.insert_one(user)
+    except DuplicateKeyError:
+        return (
+            jsonify(
+                {
+                    "success": False,
+                    "error": "User with this email or username already exists",
+                }
+            ),
+            409,
+        )
 
     # Return success response with token
     return (
         jsonify(
             {
                 "success": True,
-                "token": token,
-                "user": {
-                    "id": str(result.inserted_id),
-                    "email": user["email"],
-                    "firstName": user["firstName"],
-                    "lastName": user["lastName"],
-                    "username": user["username"],
-                },
+                "token": issue_token(result.inserted_id),
+                "user": user_summary(result.inserted_id, user),
             }
         ),
         201,
@@ -124,6 +151,15 @@ def login():
             400,
         )
 
+    # Every attempt costs a password hash, limit them per client
+    allowed, retry_after = take("login", request.remote_addr)
+    if not allowed:
+        return (
+            jsonify({"success": False, "error": TOO_MANY_REQUESTS}),
+            429,
+            retry_headers(retry_after),
+        )
+
     # Find user by email
     user = db.users.find_one({"email": data["email"]})
 
@@ -131,32 +167,28 @@ def login():
         return jsonify({"success": False, "error": "Email not registered"}), 401
 
     # Check password
-    if not check_password_hash(user["password"], data["password"]):
+    try:
+        matches, rehashed = verify_password(user["password"], data["password"])
+    except PoolBusy as e:
+        return jsonify({"success": False, "error": str(e)}), 503, {"Retry-After": "1"}
+
+    if not matches:
         return jsonify({"success": False, "error": "Invalid email or password"}), 401
 
-    # Generate JWT token
-    token = jwt.encode(
-        {
-            "user_id": str(user["_id"]),
-            "exp": datetime.utcnow() + timedelta(days=int(JWT_EXPIRATION)),
-        },
-        JWT_SECRET,
-        algorithm="HS256",
-    )
+    if rehashed:
+        # Only replaces the hash that was checked, not a concurrent change
+        db.users.update_one(
+            {"_id": user["_id"], "password": user["password"]},
+            {"$set": {"password": rehashed, "updatedAt": datetime.utcnow()}},
+        )
 
     # Return success response with token
     return (
         jsonify(
             {
                 "success": True,
-                "token": token,
-                "user": {
-                    "id": str(user["_id"]),
-                    "email": user["email"],
-                    "firstName": user["firstName"],
-                    "lastName": user["lastName"],
-                    "username": user["username"],
-                },
+                "token": issue_token(user["_id"]),
+                "user": user_summary(user["_id"], user),
             }
         ),
         200,
@@ -1,15 +1,62 @@
 # workout_api.py
-from flask import Blueprint, jsonify, request
+from flask import Blueprint, g, jsonify, request
 from datetime import datetime
 from bson import ObjectId
-from db import db
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError, OperationFailure
+from auth import authenticate
+from ratelimit import limit_reads
+from db import db, read_db
+from cache import cached, invalidate, is_cached
+from conditional import (
+    conditional_jsonify,
+    is_conditional,
+    is_not_modified,
+    make_etag,
+    not_modified_response,
+)
+from events import completion_event, publish, publish_reload
+from rollups import schedule_rollup
+from fields import parse_fields, project
+from patches import MISSING_TARGET, workout_patch
+from streaming import date_range_query, stream_keyed_by_date
+from validation import has_date_range, parse_date_range
+from workout_templates import (
+    exercise_ids,
+    plan_from_template,
+    template_day,
+    template_version,
+    virtual_workout_plan,
+)
 
 workout_bp = Blueprint("workout", __name__, url_prefix="/api/workout")
+workout_bp.before_request(authenticate)
+workout_bp.before_request(limit_reads)
+
+# Fields a client may ask for with ?fields=, the required ones are always sent
+WORKOUT_PLAN_FIELDS = (
+    "date",
+    "workouts",
+    "workouts.exercises",
+    "workouts.exercises.id",
+    "workouts.exercises.completed",
+    "createdAt",
+    "updatedAt",
+)
+WORKOUT_PLAN_REQUIRED_FIELDS = ("date", "updatedAt")
+COMPLETION_PROJECTION = {
+    "_id": 0,
+    "workouts.exercises.id": 1,
+    "workouts.exercises.completed": 1,
+}
+PLAN_CHANGED = "Workout plan was changed since it was read"
 
 
 @workout_bp.route("", methods=["GET"])
 def get_workout_plan():
     date_str = request.args.get("date")
+    if not date_str and has_date_range(request.args):
+        return get_workout_plans_in_range()
     if not date_str:
         return (
             jsonify(
@@ -19,30 +66,166 @@ def get_workout_plan():
         )
 
     try:
-        # Find workout plan for the date
-        workout_plan = db.workout_plans.find_one({"date": date_str})
+        projection = parse_workout_plan_fields(request.args)
+    except ValueError as e:
+        return jsonify({"data": None, "success": False, "error": str(e)}), 400
+
+    try:
+        # Revalidations that miss the cache are decided from updatedAt alone,
+        # the workouts are only fetched when the client's copy is stale
+        if is_conditional() and not is_cached("workout_plans", (g.user_id, date_str)):
+            version = load_workout_plan_version(g.user_id, date_str)
+            if version is not None:
+                etag = workout_plan_etag(version["_id"], version, projection)
+                if is_not_modified(etag, version.get("updatedAt")):
+                    return not_modified_response(etag, version.get("updatedAt"))
 
+        workout_plan = load_workout_plan(g.user_id, date_str, projection)
         if not workout_plan:
-            # Return default workout template if none exists for this date
-            day_of_week = datetime.strptime(date_str, "%Y-%m-%d").strftime("%A")
-            template = db.workout_templates.find_one({"day": day_of_week})
+            return jsonify({"data": None, "success": True, "error": None})
 
-            if not template:
-                return jsonify({"data": None, "success": True, "error": None})
+        # A virtual plan is versioned by its template until it is stored
+        template = workout_plan.pop("template", None)
+        if template is not None:
+            etag = virtual_plan_etag(template, projection)
+        else:
+            etag = workout_plan_etag(workout_plan["id"], workout_plan, projection)
+        return conditional_jsonify(
+            {"data": workout_plan, "success": True, "error": None},
+            etag,
+            workout_plan.get("updatedAt"),
+        )
 
-            # Create a new workout plan from template
-            workout_plan = {
-                "date": date_str,
-                "workouts": template["categories"],
-                "createdAt": datetime.utcnow(),
-                "updatedAt": datetime.utcnow(),
-            }
-            db.workout_plans.insert_one(workout_plan)
+    except Exception as e:
+        return jsonify({"data": None, "success": False, "error": str(e)}), 500
+
+
+def parse_workout_plan_fields(args):
+    return parse_fields(
+        args.get("fields"), WORKOUT_PLAN_FIELDS, WORKOUT_PLAN_REQUIRED_FIELDS
+    )
+
+
+def workout_plan_etag(plan_id, workout_plan, projection=None):
+    # Every fieldset is a representation of its own
+    return make_etag(plan_id, workout_plan.get("updatedAt"), *(projection or ()))
+
+
+def load_template(date_str):
+    day_of_week = template_day(date_str)
+    return cached(
+        "workout_templates",
+        day_of_week,
+        lambda: db.workout_templates.find_one({"day": day_of_week}),
+    )
+
+
+def load_workout_plan_version(user_id, date_str):
+    # Single-flight and cached like the plans themselves
+    return cached(
+        "workout_plan_versions",
+        (user_id, date_str),
+        lambda: db.workout_plans.find_one(
+            {"user_id": user_id, "date": date_str}, projection={"updatedAt": 1}
+        ),
+    )
+
+
+def load_workout_plan(user_id, date_str, projection=None):
+    if projection is not None and not is_cached("workout_plans", (user_id, date_str)):
+        # Only the requested fields go over the wire, partial documents are
+        # not cached. A missing plan still comes from the template below.
+        workout_plan = db.workout_plans.find_one(
+            {"user_id": user_id, "date": date_str}, projection=projection
+        )
+        if workout_plan:
+            return prepare_workout_plan(workout_plan)
+
+    # Find workout plan for the date
+    workout_plan = cached(
+        "workout_plans",
+        (user_id, date_str),
+        lambda: db.workout_plans.find_one({"user_id": user_id, "date": date_str}),
+    )
+
+    if not workout_plan:
+        # Without a plan the date shows its template's, stored only by the
+        # first write that changes it
+        template = load_template(date_str)
+        if not template:
+            return None
+        return virtual_plan(user_id, date_str, template, projection)
 
-        # Convert ObjectId to string and remove MongoDB _id
-        workout_plan["id"] = str(workout_plan.pop("_id"))
-        return jsonify({"data": workout_plan, "success": True, "error": None})
+    return prepare_workout_plan(project(workout_plan, projection))
 
+
+def virtual_plan(user_id, date_str, template, projection=None):
+    workout_plan = prepare_workout_plan(
+        project(virtual_workout_plan(user_id, date_str, template), projection)
+    )
+    workout_plan["virtual"] = True
+    # Taken out again before the plan is sent
+    workout_plan["template"] = template
+    return workout_plan
+
+
+def virtual_plan_etag(template, projection=None):
+    # The ETag a GET sent for the template's plan of a date, which changes
+    # with the template's contents
+    return make_etag(template["_id"], template_version(template), *(projection or ()))
+
+
+def materialize_workout_plan(user_id, date_str):
+    # Stores the template's plan of a date without a plan, for a write that
+    # changes it. Returns the stored plan, or None without a template.
+    template = load_template(date_str)
+    if not template:
+        return None
+    query = {"user_id": user_id, "date": date_str}
+    try:
+        return db.workout_plans.find_one_and_update(
+            query,
+            plan_from_template(template, datetime.utcnow()),
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+    except DuplicateKeyError:
+        # Two upserts raced to insert, the unique index let one through
+        return db.workout_plans.find_one(query)
+
+
+def prepare_workout_plan(workout_plan):
+    # The plan's _id is sent as "id"
+    workout_plan["id"] = workout_plan.pop("_id")
+    return workout_plan
+
+
+def load_workout_plans_in_range(user_id, start, end):
+    cursor = read_db.workout_plans.find(date_range_query(user_id, start, end))
+    return [
+        prepare_workout_plan(workout_plan) for workout_plan in cursor.sort("date", 1)
+    ]
+
+
+def get_workout_plans_in_range():
+    # Only stored plans are returned here, dates without one get no virtual
+    # plan from the templates
+    try:
+        start, end, limit = parse_date_range(request.args)
+        projection = parse_workout_plan_fields(request.args)
+    except ValueError as e:
+        return jsonify({"data": None, "success": False, "error": str(e)}), 400
+
+    try:
+        cursor = (
+            read_db.workout_plans.find(
+                date_range_query(g.user_id, start, end), projection=projection
+            )
+            .sort("date", 1)
+            .limit(limit + 1)
+            .batch_size(limit + 1)
+        )
+        return stream_keyed_by_date(cursor, limit, prepare_workout_plan)
     except Exception as e:
         return jsonify({"data": None, "success": False, "error": str(e)}), 500
 
@@ -66,17 +249,33 @@ def create_workout_plan():
         # Insert new workout plan
         result = db.workout_plans.insert_one(
             {
+                "user_id": g.user_id,
                 "date": data["date"],
                 "workouts": data["workouts"],
                 "createdAt": datetime.utcnow(),
                 "updatedAt": datetime.utcnow(),
             }
         )
+        invalidate("workout_plans", (g.user_id, data["date"]))
+        schedule_rollup(g.user_id, data["date"])
+        publish_reload(g.user_id, "workout", data["date"])
 
         return jsonify(
             {"data": str(result.inserted_id), "success": True, "error": None}
         )
 
+    except DuplicateKeyError:
+        # The unique (user_id, date) index, use PUT or PATCH to change it
+        return (
+            jsonify(
+                {
+                    "data": None,
+                    "success": False,
+                    "error": "A workout plan for this date already exists",
+                }
+            ),
+            409,
+        )
     except Exception as e:
         return jsonify({"data": None, "success": False, "error": str(e)}), 500
 
@@ -99,10 +298,13 @@ def update_workout_plan():
     try:
         # Update existing workout plan
         result = db.workout_plans.update_one(
-            {"date": data["date"]},
+            {"user_id": g.user_id, "date": data["date"]},
             {"$set": {"workouts": data["workouts"], "updatedAt": datetime.utcnow()}},
             upsert=True,
         )
+        invalidate("workout_plans", (g.user_id, data["date"]))
+        schedule_rollup(g.user_id, data["date"])
+        publish_reload(g.user_id, "workout", data["date"])
 
         return jsonify({"data": data["date"], "success": True, "error": None})
 
@@ -110,6 +312,128 @@ def update_workout_plan():
         return jsonify({"data": None, "success": False, "error": str(e)}), 500
 
 
+@workout_bp.route("", methods=["PATCH"])
+def patch_workout_plan():
+    # Applies a list of operations (see patches.py) to the plan of ?date=.
+    # With If-Match, only to the version that ETag was given for.
+    date_str = request.args.get("date")
+    if not date_str:
+        return (
+            jsonify(
+                {"data": None, "success": False, "error": "Date parameter is required"}
+            ),
+            400,
+        )
+
+    try:
+        update, array_filters, required = workout_patch(
+            request.get_json(silent=True), datetime.utcnow()
+        )
+    except ValueError as e:
+        return jsonify({"data": None, "success": False, "error": str(e)}), 400
+
+    query = {"user_id": g.user_id, "date": date_str}
+    try:
+        if request.if_match:
+            version = db.workout_plans.find_one(query, projection={"updatedAt": 1})
+            if version is not None:
+                matches = request.if_match.contains(
+                    workout_plan_etag(version["_id"], version)
+                )
+            else:
+                # A virtual plan is stored first, if the ETag is its own
+                template = load_template(date_str)
+                if not template:
+                    return (
+                        jsonify(
+                            {
+                                "data": None,
+                                "success": False,
+                                "error": "Workout plan not found",
+                            }
+                        ),
+                        404,
+                    )
+                matches = request.if_match.contains(virtual_plan_etag(template))
+                if matches:
+                    version = materialize_workout_plan(g.user_id, date_str)
+                    # Unless another write stored and changed it meanwhile
+                    matches = version.get("updatedAt") == version.get("createdAt")
+            if not matches:
+                return (
+                    jsonify({"data": None, "success": False, "error": PLAN_CHANGED}),
+                    412,
+                )
+            query["updatedAt"] = version.get("updatedAt")
+
+        def write():
+            return db.workout_plans.find_one_and_update(
+                {**query, **required},
+                update,
+                array_filters=array_filters or None,
+                projection={"updatedAt": 1},
+                return_document=ReturnDocument.AFTER,
+            )
+
+        workout_plan = write()
+        if workout_plan is None and not request.if_match:
+            # A virtual plan is stored by its first write
+            if materialize_workout_plan(g.user_id, date_str) is not None:
+                workout_plan = write()
+
+        if workout_plan is None:
+            # The plan is there but not all that the patch addresses
+            if required and db.workout_plans.find_one(query, projection={"_id": 1}):
+                return (
+                    jsonify({"data": None, "success": False, "error": MISSING_TARGET}),
+                    409,
+                )
+            if request.if_match:
+                return (
+                    jsonify({"data": None, "success": False, "error": PLAN_CHANGED}),
+                    412,
+                )
+            return (
+                jsonify(
+                    {"data": None, "success": False, "error": "Workout plan not found"}
+                ),
+                404,
+            )
+
+        invalidate("workout_plans", (g.user_id, date_str))
+        schedule_rollup(g.user_id, date_str)
+        publish_reload(g.user_id, "workout", date_str)
+
+        response = jsonify({"data": None, "success": True, "error": None})
+        response.set_etag(workout_plan_etag(workout_plan["_id"], workout_plan))
+        return response
+    except OperationFailure as e:
+        # Paths that do not fit the stored plan, or operations in conflict.
+        # A WriteError may come without details.
+        error = (e.details or {}).get("errmsg") or str(e)
+        return jsonify({"data": None, "success": False, "error": error}), 400
+    except Exception as e:
+        return jsonify({"data": None, "success": False, "error": str(e)}), 500
+
+
+def exercise_completion_write(user_id, date_str, exercise_id):
+    # (filter, update, array_filters) marking one exercise complete
+    return (
+        {
+            "user_id": user_id,
+            "date": date_str,
+            "workouts.exercises.id": exercise_id,
+        },
+        {
+            "$set": {
+                "workouts.$[].exercises.$[ex].completed": True,
+                "updatedAt": datetime.utcnow(),
+            }
+        },
+        [{"ex.id": exercise_id}],
+    )
+
+
 @workout_bp.route("/complete", methods=["POST"])
 def mark_exercise_complete():
     data = request.json
@@ -127,13 +451,31 @@ def mark_exercise_complete():
 
     try:
         # Mark exercise as complete
-        result = db.workout_plans.update_one(
-            {"date": data["date"], "workouts.exercises.id": data["exerciseId"]},
-            {"$set": {"workouts.$[].exercises.$[ex].completed": True}},
-            array_filters=[{"ex.id": data["exerciseId"]}],
+        query, update, array_filters = exercise_completion_write(
+            g.user_id, data["date"], data["exerciseId"]
         )
 
-        if result.modified_count == 0:
+        def write():
+            return db.workout_plans.find_one_and_update(
+                query,
+                update,
+                array_filters=array_filters,
+                projection=COMPLETION_PROJECTION,
+                return_document=ReturnDocument.AFTER,
+            )
+
+        workout_plan = write()
+        if workout_plan is None:
+            # A virtual plan is stored by its first write, unless the exercise
+            # is not in it and the write would not apply
+            template = load_template(data["date"])
+            if template and data["exerciseId"] in exercise_ids(template["categories"]):
+                if materialize_workout_plan(g.user_id, data["date"]) is not None:
+                    workout_plan = write()
+        invalidate("workout_plans", (g.user_id, data["date"]))
+        schedule_rollup(g.user_id, data["date"])
+
+        if workout_plan is None:
             return (
                 jsonify(
                     {"data": None, "success": False, "error": "Exercise not found"}
@@ -141,6 +483,12 @@ def mark_exercise_complete():
                 404,
             )
 
+        publish(
+            g.user_id,
+            "workout",
+            data["date"],
+            **completion_event("workout", workout_plan),
+        )
         return jsonify({"data": None, "success": True, "error": None})
 
     except Exception as e:
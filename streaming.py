@@ -0,0 +1,210 @@
+# streaming.py
+from itertools import chain, islice
+from flask import Response, current_app, stream_with_context
+from dotenv import load_dotenv
+import os
+
+load_dotenv()
+
+# Documents per cursor batch and per written chunk when streaming whole
+# collections, which bounds the memory a stream holds whatever its length
+STREAM_BATCH_SIZE = int(os.getenv("STREAM_BATCH_SIZE", 500))
+
+
+def date_range_query(user_id, start, end):
+    return {"user_id": user_id, "date": {"$gte": start, "$lte": end}}
+
+
+def open_cursor(cursor):
+    # Pull the first batch eagerly so that query errors surface before the
+    # response status has been sent
+    first = next(cursor, None)
+    if first is None:
+        return iter(())
+    return chain([first], cursor)
+
+
+class KeyedByDateEncoder:
+    # Turns date-sorted documents into the chunks of
+    # {"data": {date: doc}, "next": ..., "success": true, "error": null}
+    # (or {date: [docs]} when grouped). Shared by the WSGI and ASGI apps, which
+    # only differ in how they iterate their cursors.
+
+    def __init__(self, limit, prepare, grouped, dumps):
+        self.limit = limit
+        self.prepare = prepare
+        self.grouped = grouped
+        self.dumps = dumps
+        self.sent = 0
+        self.separator = ""
+        self.next_date = None
+        self.group_date = None
+        self.group = []
+
+    def _emit(self, date, value):
+        chunk = self.separator + self.dumps(date) + ": " + self.dumps(value)
+        self.separator = ", "
+        return chunk
+
+    def start(self):
+        return '{"data": {'
+
+    def feed(self, doc):
+        # Returns the chunks ready to send, or None once the page is full
+        if self.sent >= self.limit:
+            if not self.grouped or doc["date"] != self.group_date:
+                self.next_date = doc["date"]
+                return None
+            if self.separator:
+                # Never split a day across pages, resume from its start instead
+                self.group = []
+                self.next_date = self.group_date
+                return None
+            # A single day larger than a page is still returned whole
+        self.sent += 1
+        if self.prepare is not None:
+            self.prepare(doc)
+        if not self.grouped:
+            return [self._emit(doc["date"], doc)]
+
+        chunks = []
+        if doc["date"] != self.group_date:
+            if self.group:
+                chunks.append(self._emit(self.group_date, self.group))
+            self.group_date, self.group = doc["date"], []
+        self.group.append(doc)
+        return chunks
+
+    def finish(self):
+        chunks = []
+        if self.group:
+            chunks.append(self._emit(self.group_date, self.group))
+        chunks.append(
+            '}, "next": '
+            + self.dumps(self.next_date)
+            + ', "success": true, "error": null}'
+        )
+        return chunks
+
+
+class DocumentStreamEncoder:
+    # Turns batches of documents into NDJSON lines, or into the chunks of
+    # {"data": [...], "success": true, "error": null}
+
+    def __init__(self, prepare, dumps, ndjson=False):
+        self.prepare = prepare
+        self.dumps = dumps
+        self.ndjson = ndjson
+        self.separator = ""
+        self.mimetype = "application/x-ndjson" if ndjson else "application/json"
+
+    def start(self):
+        return "" if self.ndjson else '{"data": ['
+
+    def encode(self, docs):
+        if self.prepare is not None:
+            for doc in docs:
+                self.prepare(doc)
+        if self.ndjson:
+            return "".join(self.dumps(doc) + "\n" for doc in docs)
+        chunk = self.separator + ", ".join(self.dumps(doc) for doc in docs)
+        self.separator = ", "
+        return chunk
+
+    def finish(self):
+        return "" if self.ndjson else '], "success": true, "error": null}'
+
+
+def batches(docs, size):
+    docs = iter(docs)
+    while batch := list(islice(docs, size)):
+        yield batch
+
+
+def _documents(cursor, docs, encoder):
+    yield encoder.start()
+    try:
+        for batch in batches(docs, STREAM_BATCH_SIZE):
+            yield encoder.encode(batch)
+    finally:
+        cursor.close()
+    yield encoder.finish()
+
+
+def stream_documents(cursor, prepare, ndjson=False):
+    # Streams every document of a cursor, written one batch at a time
+    docs = open_cursor(cursor.batch_size(STREAM_BATCH_SIZE))
+    encoder = DocumentStreamEncoder(prepare, current_app.json.dumps, ndjson)
+    return Response(
+        stream_with_context(_documents(cursor, docs, encoder)),
+        mimetype=encoder.mimetype,
+    )
+
+
+def _keyed_by_date(cursor, docs, encoder):
+    yield encoder.start()
+    try:
+        for doc in docs:
+            chunks = encoder.feed(doc)
+            if chunks is None:
+                break
+            yield from chunks
+    finally:
+        cursor.close()
+    yield from encoder.finish()
+
+
+def stream_keyed_by_date(cursor, limit, prepare, grouped=False):
+    # Streams straight from a date-sorted cursor. One extra document is read
+    # to detect whether another page exists; "next" is the "from" to request
+    # it with.
+    docs = open_cursor(cursor)
+    encoder = KeyedByDateEncoder(limit, prepare, grouped, current_app.json.dumps)
+    return Response(
+        stream_with_context(_keyed_by_date(cursor, docs, encoder)),
+        mimetype="application/json",
+    )
+
+
+async def open_cursor_async(cursor):
+    # open_cursor for the ASGI app's AsyncCursor
+    first = await anext(cursor, None)
+
+    async def docs():
+        if first is not None:
+            yield first
+            async for doc in cursor:
+                yield doc
+
+    return docs()
+
+
+async def keyed_by_date_async(cursor, docs, encoder):
+    yield encoder.start()
+    try:
+        async for doc in docs:
+            chunks = encoder.feed(doc)
+            if chunks is None:
+                break
+            for chunk in chunks:
+                yield chunk
+    finally:
+        await cursor.close()
+    for chunk in encoder.finish():
+        yield chunk
+
+
+async def documents_async(cursor, docs, encoder):
+    yield encoder.start()
+    try:
+        batch = []
+        async for doc in docs:
+            batch.append(doc)
+            if len(batch) >= STREAM_BATCH_SIZE:
+                yield encoder.encode(batch)
+                batch = []
+        if batch:
+            yield encoder.encode(batch)
+    finally:
+        await cursor.close()
+    yield encoder.finish()
@@ -0,0 +1,62 @@
+# test_events.py
+import pytest
+
+import events
+
+
+@pytest.fixture
+def subscription(monkeypatch):
+    # The change stream feed running, without pre-images
+    monkeypatch.setattr(events, "bus", events.EventBus())
+    monkeypatch.setattr(events.feed, "source", "changestream")
+    monkeypatch.setattr(events, "PRE_IMAGES", False)
+    subscription = events.Subscription("user")
+    events.bus.subscribe(subscription)
+    return subscription
+
+
+def test_writes_come_back_through_the_change_stream(subscription):
+    events.publish("user", "tasks", "2024-01-02", task={"id": "task"})
+    assert subscription.drain() == (False, [])
+
+
+def test_deletes_reach_subscribers_without_pre_images(subscription):
+    events.publish_deleted("user", "tasks", "2024-01-02", deletedTask="task")
+    events.publish_deleted("user", "diet", "2024-01-02", reload=True)
+    assert subscription.drain() == (
+        False,
+        [
+            {"kind": "tasks", "date": "2024-01-02", "deletedTask": "task"},
+            {"kind": "diet", "date": "2024-01-02", "reload": True},
+        ],
+    )
+
+
+def test_deletes_without_pre_images_are_dropped_from_the_change_stream():
+    change = {
+        "ns": {"coll": "tasks"},
+        "operationType": "delete",
+        "documentKey": {"_id": "task"},
+    }
+    assert events.change_event(change) is None
+
+
+def test_deletes_come_back_through_the_change_stream_with_pre_images(
+    subscription, monkeypatch
+):
+    monkeypatch.setattr(events, "PRE_IMAGES", True)
+    events.publish_deleted("user", "tasks", "2024-01-02", deletedTask="task")
+    assert subscription.drain() == (False, [])
+    change = {
+        "ns": {"coll": "tasks"},
+        "operationType": "delete",
+        "fullDocumentBeforeChange": {
+            "_id": "task",
+            "user_id": "user",
+            "date": "2024-01-02",
+        },
+    }
+    assert events.change_event(change) == (
+        "user",
+        {"kind": "tasks", "date": "2024-01-02", "deletedTask": "task"},
+    )
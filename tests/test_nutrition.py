@@ -0,0 +1,73 @@
+# test_nutrition.py
+import random
+
+import pytest
+
+import nutrition
+
+
+def random_meals(rng):
+    meals = {}
+    for meal_time in ("breakfast", "lunch", "dinner", "snack")[: rng.randint(1, 4)]:
+        meals[meal_time] = {
+            "items": [
+                {
+                    name: rng.choice(
+                        [None, rng.randint(0, 900), round(rng.uniform(0, 900), 3)]
+                    )
+                    for name in nutrition.NUTRIENTS
+                }
+                for _ in range(rng.randint(1, 6))
+            ]
+        }
+    return meals
+
+
+PLANS = [random_meals(random.Random(seed)) for seed in range(300)] + [
+    # Sums whose grouping and rounding differ in the last digits
+    {
+        "breakfast": {"items": [{"calories": 0.1}, {"calories": 0.2}]},
+        "lunch": {"items": [{"calories": 0.3}, {"calories": 1.005}]},
+    },
+    {"breakfast": {"calories": 2.675}, "lunch": {"calories": 1e16}},
+    {"lunch": {"protein": 40}},
+    {"breakfast": {"items": []}},
+]
+
+
+@pytest.fixture(params=["numpy", "python"])
+def daily_totals(request, monkeypatch):
+    if request.param == "numpy":
+        if nutrition.numpy is None:
+            pytest.skip("numpy is not installed")
+    else:
+        monkeypatch.setattr(nutrition, "numpy", None)
+    return nutrition.daily_totals
+
+
+def test_daily_totals_match_plan_totals(daily_totals):
+    expected = []
+    for meals in PLANS:
+        totals = nutrition.plan_totals(meals)
+        expected.append(totals and totals[1])
+    assert daily_totals(PLANS) == expected
+
+
+def test_daily_totals_match_one_plan_at_a_time(daily_totals):
+    assert daily_totals(PLANS) == [daily_totals([meals])[0] for meals in PLANS]
+
+
+def test_daily_total_is_rounded_once():
+    meals = {
+        "breakfast": {"calories": 0.004},
+        "lunch": {"calories": 0.004},
+        "dinner": {"calories": 0.004},
+    }
+    meal_totals, daily = nutrition.plan_totals(meals)
+    assert meal_totals["lunch"]["calories"] == 0
+    assert daily["calories"] == 0.01
+
+
+def test_negative_values_are_rejected(daily_totals):
+    with pytest.raises(ValueError, match="calories must not be negative"):
+        daily_totals([{"lunch": {"calories": -1}}])
@@ -0,0 +1,149 @@
+# test_rollups.py
+import pytest
+
+import rollups
+
+mongomock = pytest.importorskip("mongomock")
+
+USER = "user"
+# Two days of one week, and a day of the next month
+DATES = ("2024-01-30", "2024-01-31", "2024-02-01")
+
+
+@pytest.fixture
+def db(monkeypatch):
+    # pymongo 4.11+ passes the sort of a ReplaceOne to bulk builders,
+    # which mongomock does not take yet
+    add_replace = mongomock.collection.BulkOperationBuilder.add_replace
+
+    def add_replace_without_sort(self, *args, sort=None, **kwargs):
+        return add_replace(self, *args, **kwargs)
+
+    monkeypatch.setattr(
+        mongomock.collection.BulkOperationBuilder,
+        "add_replace",
+        add_replace_without_sort,
+    )
+    return mongomock.MongoClient().db
+
+
+def diet_plan(date_str, *proteins):
+    return {
+        "user_id": USER,
+        "date": date_str,
+        "meals": {
+            "breakfast": {
+                "items": [
+                    {"calories": 100.1, "protein": protein} for protein in proteins
+                ]
+            },
+            "lunch": {"calories": 650, "protein": 0.7},
+        },
+        "completedMeals": ["breakfast"],
+    }
+
+
+def workout_plan(date_str, *completed):
+    return {
+        "user_id": USER,
+        "date": date_str,
+        "workouts": [
+            {
+                "exercises": [
+                    {"id": str(i), "completed": c} for i, c in enumerate(completed)
+                ]
+            }
+        ],
+    }
+
+
+def summaries(db):
+    return sorted(
+        (rollups.summarize(rollup) for rollup in db.rollups.find({"user_id": USER})),
+        key=lambda summary: (summary["period"], summary["key"]),
+    )
+
+
+def refreshed(db):
+    # The incremental rollups, and those of a rebuild of the same documents
+    incremental = summaries(db)
+    rollups.rebuild(db, USER)
+    return incremental, summaries(db)
+
+
+def test_refreshes_after_create_update_delete_match_a_rebuild(db):
+    db.diet_plans.insert_one(diet_plan(DATES[0], 0.1, 0.2))
+    db.diet_plans.insert_one(diet_plan(DATES[2], 1.1))
+    db.workout_plans.insert_one(workout_plan(DATES[1], True, False))
+    db.tasks.insert_many(
+        [
+            {"user_id": USER, "date": DATES[1], "completed": True},
+            {"user_id": USER, "date": DATES[1], "completed": False},
+        ]
+    )
+    rollups.refresh_days(db, USER, DATES)
+    incremental, rebuilt = refreshed(db)
+    assert incremental == rebuilt
+
+    db.diet_plans.replace_one({"date": DATES[0]}, diet_plan(DATES[0], 0.3, 0.6, 2.675))
+    db.workout_plans.update_one(
+        {"date": DATES[1]}, {"$set": {"workouts.0.exercises.1.completed": True}}
+    )
+    db.tasks.delete_one({"date": DATES[1], "completed": False})
+    for date_str in DATES[:2]:
+        rollups.refresh_day(db, USER, date_str)
+    incremental, rebuilt = refreshed(db)
+    assert incremental == rebuilt
+
+    db.diet_plans.delete_many({"date": {"$in": DATES[:1]}})
+    db.workout_plans.delete_many({})
+    db.tasks.delete_many({})
+    rollups.refresh_days(db, USER, DATES[:2])
+    incremental, rebuilt = refreshed(db)
+    assert incremental == rebuilt
+    assert [summary["key"] for summary in incremental] == [
+        "2024-02-01",
+        "2024-02",
+        "2024-W05",
+    ]
+
+
+def test_refreshing_a_day_again_leaves_its_week_and_month(db):
+    db.diet_plans.insert_one(diet_plan(DATES[0], 0.1, 0.2))
+    rollups.refresh_day(db, USER, DATES[0])
+    before = summaries(db)
+    rollups.refresh_day(db, USER, DATES[0])
+    rollups.refresh_days(db, USER, [DATES[0], DATES[0]])
+    assert summaries(db) == before
+    week = db.rollups.find_one({"period": "week"})
+    assert week["days"] == 1
+    assert week["meals"] == {"planned": 2, "completed": 1}
+
+
+def test_days_of_one_week_add_up(db):
+    db.diet_plans.insert_one(diet_plan(DATES[0], 0.1))
+    db.diet_plans.insert_one(diet_plan(DATES[1], 0.2))
+    rollups.refresh_days(db, USER, DATES[:2])
+    week = db.rollups.find_one({"period": "week", "key": "2024-W05"})
+    assert week["days"] == 2
+    assert week["nutrition"] == {"calories": 1500.2, "protein": 1.7}
+
+
+def test_deleting_the_only_plan_removes_its_rollups(db):
+    db.diet_plans.insert_one(diet_plan(DATES[0], 0.1, 0.2, 35.55))
+    rollups.refresh_day(db, USER, DATES[0])
+    db.diet_plans.delete_one({"date": DATES[0]})
+    rollups.refresh_day(db, USER, DATES[0])
+    assert list(db.rollups.find()) == []
+
+
+def test_summaries_round_and_drop_what_sums_to_zero():
+    summary = rollups.summarize(
+        {
+            "period": "week",
+            "key": "2024-W05",
+            "days": 1,
+            "nutrition": {"calories": 650.3000000000001, "protein": -3.55e-15},
+        }
+    )
+    assert summary["nutrition"] == {"calories": 650.3}
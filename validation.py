@@ -0,0 +1,71 @@
+# validation.py
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as Base64Error
+from datetime import datetime, timedelta
+from dotenv import load_dotenv
+import json
+import os
+
+load_dotenv()
+
+DATE_FORMAT = "%Y-%m-%d"
+
+# Range reads are bounded both by span and by number of documents per page
+MAX_RANGE_DAYS = int(os.getenv("MAX_RANGE_DAYS", 92))
+DEFAULT_PAGE_SIZE = int(os.getenv("DEFAULT_PAGE_SIZE", 100))
+MAX_PAGE_SIZE = int(os.getenv("MAX_PAGE_SIZE", 500))
+
+
+def parse_date(value):
+    # Normalise so that "2024-1-5" and "2024-01-05" hit the same documents
+    try:
+        return datetime.strptime(value, DATE_FORMAT).strftime(DATE_FORMAT)
+    except (TypeError, ValueError):
+        raise ValueError("Invalid date format. Use YYYY-MM-DD")
+
+
+def parse_limit(value, default=DEFAULT_PAGE_SIZE, maximum=MAX_PAGE_SIZE):
+    if value is None:
+        return default
+    try:
+        limit = int(value)
+    except ValueError:
+        raise ValueError("limit must be an integer")
+    if limit < 1:
+        raise ValueError("limit must be positive")
+    return min(limit, maximum)
+
+
+def has_date_range(args):
+    return "from" in args or "to" in args
+
+
+def parse_date_range(args):
+    if not args.get("from") or not args.get("to"):
+        raise ValueError("Both from and to parameters are required")
+
+    start = parse_date(args["from"])
+    end = parse_date(args["to"])
+    if end < start:
+        raise ValueError("to must not be before from")
+
+    span = datetime.strptime(end, DATE_FORMAT) - datetime.strptime(start, DATE_FORMAT)
+    if span >= timedelta(days=MAX_RANGE_DAYS):
+        raise ValueError(f"Date range cannot exceed {MAX_RANGE_DAYS} days")
+
+    return start, end, parse_limit(args.get("limit"))
+
+
+def encode_cursor(*values):
+    # Opaque page cursor holding the sort key of the last document sent
+    return urlsafe_b64encode(json.dumps(values).encode()).decode().rstrip("=")
+
+
+def decode_cursor(token, size):
+    try:
+        values = json.loads(urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+    except (Base64Error, UnicodeDecodeError, ValueError):
+        raise ValueError("Invalid cursor")
+    if not isinstance(values, list) or len(values) != size:
+        raise ValueError("Invalid cursor")
+    return values
@@ -0,0 +1,180 @@
+# workout_templates.py
+#
+# Workout plans derived from the weekday templates (workout_templates). A
+# date without a stored plan is answered with its template's plan, marked
+# "virtual": true and without an id, and nothing is written until the first
+# write that changes the plan stores it. Plans for the coming days can be
+# generated ahead in bulk, so that most days already have a stored plan:
+#
+#   python workout_templates.py [--days N] [--start DATE] [--user USER_ID]
+#   python workout_templates.py --every 3600      keep generating, hourly
+#
+# Generation only inserts, plans that already exist are left as they are.
+from bson import json_util
+from hashlib import blake2b
+import argparse
+import sys
+import time
+from datetime import datetime, timedelta
+from dotenv import load_dotenv
+import os
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from db import db
+from rollups import refresh_days
+
+load_dotenv()
+
+PREGENERATE_DAYS = int(os.getenv("WORKOUT_PREGENERATE_DAYS", 14))
+# Upserts per bulk write
+PREGENERATE_BATCH_SIZE = int(os.getenv("WORKOUT_PREGENERATE_BATCH_SIZE", 1000))
+
+DUPLICATE_KEY = 11000
+
+
+def template_day(date_str):
+    # The templates are keyed by weekday name, e.g. "Monday"
+    return datetime.strptime(date_str, "%Y-%m-%d").strftime("%A")
+
+
+def plan_from_template(template, now):
+    # Upsert that only writes when no plan exists yet
+    return {
+        "$setOnInsert": {
+            "workouts": template["categories"],
+            "createdAt": now,
+            "updatedAt": now,
+        }
+    }
+
+
+def template_version(template):
+    # Templates are edited in the database, without a version of their own,
+    # so they are versioned by a digest of their contents
+    return blake2b(
+        json_util.dumps(template["categories"], sort_keys=True).encode(),
+        digest_size=16,
+    ).hexdigest()
+
+
+def virtual_workout_plan(user_id, date_str, template):
+    # The plan a date has until one is stored, shaped like a stored one
+    return {
+        "_id": None,
+        "user_id": user_id,
+        "date": date_str,
+        "workouts": template["categories"],
+    }
+
+
+def exercise_ids(workouts):
+    # The ids of the exercises of a plan's (or a template's) workouts
+    return [
+        exercise.get("id")
+        for workout in workouts or []
+        for exercise in workout.get("exercises") or []
+        if isinstance(exercise, dict)
+    ]
+
+
+def horizon(start, days):
+    return [
+        (start + timedelta(days=offset)).strftime("%Y-%m-%d") for offset in range(days)
+    ]
+
+
+def _user_ids(db):
+    cursor = db.users.find({}, projection={"_id": 1}).batch_size(PREGENERATE_BATCH_SIZE)
+    return (str(user["_id"]) for user in cursor)
+
+
+def pregenerate(db, dates, user_ids=None):
+    # Stores the template plan of every date without a plan, for every user
+    # (or the given ones). Returns the number of plans created.
+    templates = {template["day"]: template for template in db.workout_templates.find()}
+    writes, keys, created = [], [], 0
+    now = datetime.utcnow()
+
+    def flush():
+        nonlocal created
+        if not writes:
+            return
+        try:
+            result = db.workout_plans.bulk_write(writes, ordered=False).bulk_api_result
+        except BulkWriteError as e:
+            # Plans a user's first write stored meanwhile
+            if any(
+                error["code"] != DUPLICATE_KEY for error in e.details["writeErrors"]
+            ):
+                raise
+            result = e.details
+        # The new plans count in their days' rollups like any other, each
+        # user's days refreshed together
+        days = {}
+        for upserted in result["upserted"]:
+            user_id, date_str = keys[upserted["index"]]
+            days.setdefault(user_id, []).append(date_str)
+            created += 1
+        for user_id, dates in days.items():
+            refresh_days(db, user_id, dates)
+        writes.clear()
+        keys.clear()
+
+    for user_id in user_ids or _user_ids(db):
+        for date_str in dates:
+            template = templates.get(template_day(date_str))
+            if template is None:
+                continue
+            writes.append(
+                UpdateOne(
+                    {"user_id": user_id, "date": date_str},
+                    plan_from_template(template, now),
+                    upsert=True,
+                )
+            )
+            keys.append((user_id, date_str))
+            if len(writes) >= PREGENERATE_BATCH_SIZE:
+                flush()
+    flush()
+    return created
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Generate workout plans from the templates ahead of time"
+    )
+    parser.add_argument(
+        "--days",
+        type=int,
+        default=PREGENERATE_DAYS,
+        help="number of days to generate, starting with --start",
+    )
+    parser.add_argument("--start", help="first date (YYYY-MM-DD), today by default")
+    parser.add_argument(
+        "--user", action="append", help="only generate for this user, repeatable"
+    )
+    parser.add_argument(
+        "--every",
+        type=float,
+        help="keep running, generating again every this many seconds",
+    )
+    args = parser.parse_args(argv)
+
+    while True:
+        start = (
+            datetime.strptime(args.start, "%Y-%m-%d")
+            if args.start
+            else datetime.utcnow()
+        )
+        created = pregenerate(db, horizon(start, args.days), args.user)
+        print(
+            f"Created {created} workout plans for {args.days} days from {start:%Y-%m-%d}"
+        )
+        if not args.every:
+            return 0
+        time.sleep(args.every)
+
+
+if __name__ == "__main__":
+    sys.exit(main())